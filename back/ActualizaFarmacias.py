@@ -1,10 +1,18 @@
-import requests
 import json
 import sqlite3
+import hashlib
+import time
+from collections import Counter
+from typing import Optional
 from datetime import datetime
 import logging
 import os  # Agregar esta importación al inicio del archivo
 
+from cliente_minsal import ClienteMinsal, DESCARGADO, NO_MODIFICADO
+from normalizacion import normalizar_texto, tokenizar
+from horarios import intervalo_apertura
+from busqueda_difusa import terminos_indexados, trigramas, TIPO_COMUNA, TIPO_FARMACIA
+
 # Configuración de logging
 logging.basicConfig(
     filename='actualizacion_farmacias.log',
@@ -14,10 +22,207 @@ logging.basicConfig(
 
 # https://midas.minsal.cl/farmacia_v2/WS/getLocales.php
 # https://midas.minsal.cl/farmacia_v2/WS/getLocalesTurnos.php
+# MINSAL_BASE_URL permite apuntar a servidor_minsal_local.py para pruebas offline
+MINSAL_BASE_URL = os.environ.get("MINSAL_BASE_URL", "https://midas.minsal.cl/farmacia_v2/WS")
+
+# Sufijo de las tablas donde se construye cada actualización completa antes
+# de reemplazar a las tablas en uso
+SUFIJO_STAGING = "_nueva"
+TABLA_STAGING = f"farmacias{SUFIJO_STAGING}"
+
+# Tablas que se derivan de farmacias (ver actualizar_tablas_derivadas); la
+# actualización completa también las construye con SUFIJO_STAGING
+TABLAS_DERIVADAS = ("regiones", "comunas", "farmacias_geo", "terminos_busqueda", "trigramas")
+
+# Fracción mínima de filas (respecto del snapshot anterior) que debe tener la
+# tabla nueva para aceptar el intercambio
+PROPORCION_MINIMA_FILAS = 0.8
+
+# Cantidad de filas por llamada a executemany
+TAMANO_LOTE = 500
+
+# Mapeo de regiones
+REGIONES = {
+    1: 'Arica y Parinacota',
+    2: 'Tarapacá',
+    3: 'Antofagasta',
+    4: 'Atacama',
+    5: 'Coquimbo',
+    6: 'Valparaíso',
+    7: 'Metropolitana de Santiago',
+    8: 'Libertador General Bernardo O\'Higgins',
+    9: 'Maule',
+    10: 'Biobío',
+    11: 'La Araucanía',
+    12: 'Los Ríos',
+    13: 'Los Lagos',
+    14: 'Aysén del General Carlos Ibáñez del Campo',
+    15: 'Magallanes y de la Antártica Chilena',
+    16: 'Ñuble'
+}
+
+CAMPOS_OBLIGATORIOS = ('local_id', 'local_nombre', 'comuna_nombre', 'local_direccion')
+
+CAMPOS_STRING = (
+    'local_nombre', 'comuna_nombre', 'localidad_nombre', 'local_direccion',
+    'funcionamiento_hora_apertura', 'funcionamiento_hora_cierre',
+    'local_telefono', 'funcionamiento_dia'
+)
+
+CAMPOS_NUMERICOS = ('local_id', 'fk_region', 'fk_comuna', 'fk_localidad')
+
+# Orden de las columnas en las filas que produce validar_farmacia
+COLUMNAS_FILA = (
+    'local_id', 'local_nombre', 'comuna_nombre', 'localidad_nombre',
+    'local_direccion', 'URL_direccion', 'funcionamiento_hora_apertura',
+    'funcionamiento_hora_cierre', 'local_telefono', 'local_lat', 'local_lng',
+    'funcionamiento_dia', 'fecha', 'de_turno', 'fk_region', 'fk_comuna',
+    'fk_localidad', 'nombre_region', 'comuna_clave', 'turno_hora_apertura',
+    'turno_hora_cierre', 'turno_dia', 'turno_fecha', 'horario_inicio', 'horario_fin'
+)
+
+# Columnas que se escriben en la tabla: la fila validada más su hash de contenido
+COLUMNAS_INSERCION = COLUMNAS_FILA + ('hash_contenido',)
+
+# Columnas agregadas después de la versión original del esquema; se crean
+# con ALTER TABLE en bases de datos existentes
+COLUMNAS_MIGRADAS = (
+    ('hash_contenido', 'TEXT'),
+    ('comuna_clave', 'TEXT'),
+    ('turno_hora_apertura', 'TEXT'),
+    ('turno_hora_cierre', 'TEXT'),
+    ('turno_dia', 'TEXT'),
+    ('turno_fecha', 'TEXT'),
+    ('horario_inicio', 'INTEGER'),
+    ('horario_fin', 'INTEGER'),
+)
+
+# Caja (lat_min, lat_max, lng_min, lng_max) que contiene a Chile, incluida
+# Isla de Pascua; las coordenadas fuera de ella se consideran inválidas
+LIMITES_CHILE = (-56.0, -17.0, -110.0, -66.0)
+
+# Campos del feed de turnos que se guardan en las columnas turno_*
+CAMPOS_TURNO = (
+    ('funcionamiento_hora_apertura', 'turno_hora_apertura'),
+    ('funcionamiento_hora_cierre', 'turno_hora_cierre'),
+    ('funcionamiento_dia', 'turno_dia'),
+    ('fecha', 'turno_fecha'),
+)
+
+# Versión del esquema guardada en PRAGMA user_version; ver migrar_esquema
+VERSION_ESQUEMA = 6
+
+# Estrategias para construir URL_direccion
+ESTRATEGIAS_URL = ('direccion', 'coordenadas', 'combinada')
+
+# Índices de la tabla farmacias: (sufijo del nombre, columnas). Ambos son
+# covering para las consultas de lectura, que se resuelven sin tocar la tabla.
+INDICES_FARMACIAS = [
+    # /search_farmacias: fk_comuna = ? [AND abierta] ORDER BY de_turno DESC, local_nombre
+    ("comuna_turno_horario",
+     "fk_comuna, de_turno DESC, local_nombre, localidad_nombre, local_direccion, URL_direccion, "
+     "horario_inicio, horario_fin"),
+    # consultar_farmacias (chat): comuna_clave = ? [AND de_turno = 1] [AND abierta]
+    # ORDER BY de_turno DESC, local_nombre LIMIT ? OFFSET ?, y su COUNT(*). El
+    # orden del índice evita ordenar y permite cortar en el LIMIT; el horario
+    # se filtra dentro del índice
+    ("clave_turno_nombre",
+     "comuna_clave, de_turno DESC, local_nombre, horario_inicio, horario_fin, local_direccion, "
+     "funcionamiento_hora_apertura, funcionamiento_hora_cierre, turno_hora_apertura, turno_hora_cierre, "
+     "local_telefono, URL_direccion"),
+]
+
+# Índices de versiones anteriores del esquema que ya no se usan
+INDICES_OBSOLETOS = (
+    "idx_farmacias_region_comuna",
+    "idx_farmacias_comuna_turno",
+    "idx_farmacias_clave_turno",
+    "idx_farmacias_comuna_turno_nombre",
+    "idx_farmacias_clave_turno_horario",
+    "idx_farmacias_clave_turno_abierta",
+)
+
+
+def calcular_hash_contenido(fila) -> str:
+    """Hash estable del contenido de una fila validada"""
+    return hashlib.sha1(repr(fila).encode('utf-8')).hexdigest()
+
+
+def clave_local(farmacia):
+    """local_id de un registro crudo del feed, normalizado para comparar"""
+    return str(farmacia.get('local_id') or '').strip()
+
+
+def combinar_feeds(farmacias_normal, farmacias_turno):
+    """
+    Combina ambos feeds en pares (farmacia, turno), uno por local_id.
+
+    El feed de turnos es pequeño y se indexa en memoria; el feed normal se
+    recorre en streaming. `turno` es el registro de turno de la farmacia o
+    None; las farmacias que solo aparecen en el feed de turnos se entregan
+    al final como (None, turno). Los local_id repetidos se ignoran.
+    """
+    turnos = {}
+    for turno in farmacias_turno:
+        turnos.setdefault(clave_local(turno), turno)
+
+    vistos = set()
+    for farmacia in farmacias_normal:
+        clave = clave_local(farmacia)
+        if clave in vistos:
+            continue
+        vistos.add(clave)
+        yield farmacia, turnos.pop(clave, None)
+
+    for turno in turnos.values():
+        yield None, turno
+
+
+def en_lotes(filas, tamano_lote):
+    """Agrupa un iterable de filas en listas de hasta `tamano_lote` elementos"""
+    lote = []
+    for fila in filas:
+        lote.append(fila)
+        if len(lote) >= tamano_lote:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def construir_url_maps(estrategia, direccion, comuna, region, lat, lng):
+    """
+    Construye la URL de Google Maps de una farmacia.
+
+    estrategia: 'direccion' (dirección, comuna y región), 'coordenadas'
+    (lat/lng) o 'combinada' (dirección más coordenadas). Sin coordenadas,
+    'coordenadas' retorna None y 'combinada' usa solo la dirección.
+    """
+    tiene_coordenadas = lat is not None and lng is not None and str(lat).strip() != '' and str(lng).strip() != ''
+    lat_formateada = str(lat)[:11] if tiene_coordenadas else ""
+    lng_formateada = str(lng)[:10] if tiene_coordenadas else ""
+
+    if estrategia == 'coordenadas':
+        if not tiene_coordenadas:
+            return None
+        return f"https://www.google.com/maps/@{lat_formateada},{lng_formateada},18z"
+
+    direccion_formateada = direccion.replace(" ", "+") if direccion else ""
+    comuna_formateada = comuna.replace(" ", "+") if comuna else ""
+    region_formateada = region.replace(" ", "+") if region else ""
+    url = f"https://www.google.com/maps/place/{direccion_formateada},+{comuna_formateada},+{region_formateada}"
+
+    if estrategia == 'combinada' and tiene_coordenadas:
+        url += f"/@{lat_formateada},{lng_formateada}"
+    return url
 
 
 class ActualizadorFarmacias:
-    def __init__(self):
+    def __init__(self, estrategia_url="combinada", db_path=None):
+        if estrategia_url not in ESTRATEGIAS_URL:
+            raise ValueError(f"Estrategia de URL desconocida: {estrategia_url}")
+        self.estrategia_url = estrategia_url
+        
         # Obtener el directorio donde se encuentra el archivo actual
         current_dir = os.path.dirname(os.path.abspath(__file__))
         
@@ -27,17 +232,43 @@ class ActualizadorFarmacias:
             os.makedirs(base_dir)
             
         # Definir la ruta de la base de datos dentro de la carpeta Base
-        self.db_path = os.path.join(base_dir, 'farmacias_turno.db')
+        # (o la indicada, p. ej. una copia para pruebas)
+        self.db_path = db_path or os.path.join(base_dir, 'farmacias_turno.db')
         # URLs de las farmacias
-        self.url_farmacias_normal = "https://midas.minsal.cl/farmacia_v2/WS/getLocales.php"
-        self.url_farmacias_turno = "https://midas.minsal.cl/farmacia_v2/WS/getLocalesTurnos.php"
+        self.url_farmacias_normal = f"{MINSAL_BASE_URL}/getLocales.php"
+        self.url_farmacias_turno = f"{MINSAL_BASE_URL}/getLocalesTurnos.php"
+        # Métricas de la última carga completa
+        self.metricas_ingesta = {}
+        # Conteo de cambios de la última sincronización incremental
+        self.metricas_sincronizacion = {}
         try:
             # Conectar a la base de datos SQLite
             self.connection = sqlite3.connect(self.db_path)
             self.cursor = self.connection.cursor()
+
+            # WAL permite que los lectores sigan viendo el snapshot anterior
+            # mientras se construye e intercambia la tabla nueva
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            self.cursor.execute("PRAGMA synchronous=NORMAL")
             
-            # Crear la tabla si no existe
+            # Permite regenerar URLs con un único UPDATE (ver actualizar_urls)
+            self.connection.create_function("url_maps", 6, construir_url_maps, deterministic=True)
+            self.connection.create_function("normalizar", 1, normalizar_texto, deterministic=True)
+            
+            # Crear las tablas si no existen y migrar bases de datos anteriores
             self.crear_tabla()
+            self.crear_tablas_referencia()
+            self.crear_tabla_estado_feeds()
+            self.migrar_esquema()
+            self.crear_indices()
+            self.connection.commit()
+            
+            # Cliente HTTP con los validadores (ETag/Last-Modified) de la última
+            # actualización aplicada
+            self.cliente = ClienteMinsal(
+                validadores=self.cargar_estado_feeds(),
+                directorio_grabacion=os.environ.get("MINSAL_GRABACIONES")
+            )
             
             print("Conexión y estructura de base de datos inicializada correctamente")
             
@@ -45,11 +276,11 @@ class ActualizadorFarmacias:
             print(f"Error al inicializar la base de datos: {err}")
             raise
 
-    def crear_tabla(self):
-        """Crea la tabla farmacias si no existe"""
+    def crear_tabla(self, nombre_tabla="farmacias"):
+        """Crea la tabla farmacias (o la tabla indicada) si no existe"""
         try:
-            crear_tabla_sql = """
-            CREATE TABLE IF NOT EXISTS farmacias (
+            crear_tabla_sql = f"""
+            CREATE TABLE IF NOT EXISTS {nombre_tabla} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 local_id INTEGER NOT NULL,
                 local_nombre TEXT,
@@ -69,26 +300,415 @@ class ActualizadorFarmacias:
                 fk_comuna INTEGER,
                 fk_localidad INTEGER,
                 nombre_region TEXT,
-                fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                hash_contenido TEXT,
+                comuna_clave TEXT,
+                turno_hora_apertura TEXT,
+                turno_hora_cierre TEXT,
+                turno_dia TEXT,
+                turno_fecha TEXT,
+                horario_inicio INTEGER,
+                horario_fin INTEGER
             );
             """
             self.cursor.execute(crear_tabla_sql)
+            self.migrar_columnas(nombre_tabla)
             self.connection.commit()
-            print("Tabla farmacias creada o verificada correctamente")
+            print(f"Tabla {nombre_tabla} creada o verificada correctamente")
             
         except sqlite3.Error as err:
-            print(f"Error al crear la tabla farmacias: {err}")
+            print(f"Error al crear la tabla {nombre_tabla}: {err}")
+            raise
+
+    def migrar_columnas(self, nombre_tabla="farmacias"):
+        """Agrega a una tabla existente las columnas nuevas del esquema"""
+        existentes = {
+            fila[1] for fila in self.cursor.execute(f"PRAGMA table_info({nombre_tabla})")
+        }
+        for columna, tipo in COLUMNAS_MIGRADAS:
+            if columna not in existentes:
+                self.cursor.execute(f"ALTER TABLE {nombre_tabla} ADD COLUMN {columna} {tipo}")
+                logging.info(f"Columna {columna} agregada a la tabla {nombre_tabla}")
+
+    def crear_indice(self, nombre, tabla, columnas, unico=False):
+        """Crea el índice sobre la tabla, si esta aún no lo tiene.
+
+        Los nombres de índice son globales en SQLite y un RENAME los
+        conserva, así que la tabla staging no puede usar el nombre que ya
+        tiene el índice de la tabla en uso: se alterna entre `nombre` y
+        `nombre`_b, el que esté libre.
+        """
+        alternativas = (nombre, f"{nombre}_b")
+        tablas_por_indice = dict(self.cursor.execute(
+            "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' AND name IN (?, ?)", alternativas
+        ).fetchall())
+        if tabla in tablas_por_indice.values():
+            return
+        libre = next(alternativa for alternativa in alternativas if alternativa not in tablas_por_indice)
+        self.cursor.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX {libre} ON {tabla} ({columnas})")
+
+    def crear_indices(self, nombre_tabla="farmacias"):
+        """Crea los índices de consulta sobre la tabla indicada (ver crear_indice)"""
+        self.crear_indice("idx_farmacias_local_id", nombre_tabla, "local_id", unico=True)
+        for sufijo, columnas in INDICES_FARMACIAS:
+            self.crear_indice(f"idx_farmacias_{sufijo}", nombre_tabla, columnas)
+
+    def crear_tablas_referencia(self, sufijo=""):
+        """Crea las tablas de regiones y comunas usadas por los selectores y búsquedas.
+
+        Con `sufijo` (SUFIJO_STAGING) crea las copias en que se construye
+        una actualización completa.
+        """
+        self.cursor.executescript(f"""
+            CREATE TABLE IF NOT EXISTS regiones{sufijo} (
+                id INTEGER PRIMARY KEY,
+                nombre TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS comunas{sufijo} (
+                id INTEGER PRIMARY KEY,
+                fk_region INTEGER NOT NULL REFERENCES regiones{sufijo} (id),
+                nombre TEXT NOT NULL,
+                clave TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS farmacias_geo{sufijo} USING rtree (
+                id, min_lat, max_lat, min_lng, max_lng
+            );
+            CREATE TABLE IF NOT EXISTS terminos_busqueda{sufijo} (
+                id INTEGER PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                texto TEXT NOT NULL,
+                nombre TEXT NOT NULL,
+                num_trigramas INTEGER NOT NULL,
+                distancia_maxima INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS trigramas{sufijo} (
+                trigrama TEXT NOT NULL,
+                termino_id INTEGER NOT NULL,
+                PRIMARY KEY (trigrama, termino_id)
+            ) WITHOUT ROWID;
+        """)
+        self.crear_indice("idx_regiones_nombre", f"regiones{sufijo}", "nombre")
+        self.crear_indice("idx_comunas_region_nombre", f"comunas{sufijo}", "fk_region, nombre")
+        self.crear_indice("idx_comunas_clave", f"comunas{sufijo}", "clave")
+
+    def actualizar_tablas_derivadas(self, sufijo=""):
+        """Reconstruye todo lo que se deriva de farmacias (sin commit).
+
+        Con `sufijo` (SUFIJO_STAGING) lee la tabla staging y escribe en las
+        copias staging de las tablas derivadas.
+        """
+        self.actualizar_tablas_referencia(sufijo=sufijo)
+        self.actualizar_indice_espacial(sufijo=sufijo)
+        self.actualizar_indice_difuso(sufijo)
+
+    def actualizar_tablas_derivadas_parcial(self, ids_actualizados, ids_eliminados, nombres_afectados):
+        """Actualiza lo que se deriva de farmacias solo para las filas que cambiaron (sin commit).
+
+        Args:
+            ids_actualizados: ids de las farmacias agregadas o modificadas
+            ids_eliminados: ids de las farmacias eliminadas
+            nombres_afectados: local_nombre anteriores y nuevos de esas farmacias
+
+        Regiones y comunas se reescriben solo si cambiaron; en ese caso
+        también se reconstruye el índice difuso, que indexa las comunas.
+        """
+        self.actualizar_indice_espacial(ids_actualizados, ids_eliminados)
+        if self.actualizar_tablas_referencia(solo_si_cambiaron=True):
+            self.actualizar_indice_difuso()
+        else:
+            self.actualizar_terminos_farmacia(nombres_afectados)
+
+    def actualizar_indice_difuso(self, sufijo=""):
+        """Reconstruye el índice de trigramas de comunas y nombres de farmacia.
+
+        Se indexan las comunas de la tabla comunas (ya actualizada) y los
+        nombres de farmacia distintos; para cada nombre normalizado se usa
+        la grafía más frecuente. No hace commit.
+        """
+        nombres = [(TIPO_COMUNA, nombre) for (nombre,) in self.cursor.execute(f"SELECT nombre FROM comunas{sufijo}")]
+        nombres.extend(
+            (TIPO_FARMACIA, nombre) for (nombre,) in self.cursor.execute(f"""
+                SELECT local_nombre FROM farmacias{sufijo}
+                WHERE local_nombre IS NOT NULL
+                GROUP BY local_nombre
+                ORDER BY COUNT(*) DESC
+            """)
+        )
+
+        self.cursor.execute(f"DELETE FROM trigramas{sufijo}")
+        self.cursor.execute(f"DELETE FROM terminos_busqueda{sufijo}")
+        filas_trigramas = []
+        for termino, gramas in terminos_indexados(nombres):
+            self.cursor.execute(f"""
+                INSERT INTO terminos_busqueda{sufijo} (tipo, texto, nombre, num_trigramas, distancia_maxima)
+                VALUES (?, ?, ?, ?, ?)
+            """, termino)
+            filas_trigramas.extend((grama, self.cursor.lastrowid) for grama in gramas)
+        self.cursor.executemany(f"INSERT INTO trigramas{sufijo} (trigrama, termino_id) VALUES (?, ?)", filas_trigramas)
+        logging.info(f"Índice difuso reconstruido: {len(filas_trigramas)} trigramas")
+
+    def actualizar_terminos_farmacia(self, nombres):
+        """Reindexa en el índice difuso solo los nombres de farmacia indicados.
+
+        Para cada nombre normalizado se agrega el término si falta, se
+        borra con sus trigramas si ya ninguna farmacia lo usa o se actualiza
+        su grafía más frecuente. No hace commit.
+        """
+        textos = {" ".join(tokenizar(nombre)) for nombre in nombres if nombre} - {""}
+        if not textos:
+            return
+
+        grafias = {}
+        for nombre, cuenta in self.cursor.execute("""
+            SELECT local_nombre, COUNT(*) FROM farmacias
+            WHERE local_nombre IS NOT NULL
+            GROUP BY local_nombre
+        """):
+            texto = " ".join(tokenizar(nombre))
+            if texto in textos:
+                grafias.setdefault(texto, []).append((cuenta, nombre))
+
+        indexados = {
+            texto: (id_termino, nombre)
+            for id_termino, texto, nombre in self.cursor.execute(
+                "SELECT id, texto, nombre FROM terminos_busqueda WHERE tipo = ?", (TIPO_FARMACIA,)
+            )
+            if texto in textos
+        }
+
+        agregados = borrados = 0
+        for texto in textos:
+            actual = indexados.get(texto)
+            candidatos = grafias.get(texto)
+            if not candidatos:
+                if actual is not None:
+                    self.cursor.executemany(
+                        "DELETE FROM trigramas WHERE trigrama = ? AND termino_id = ?",
+                        [(grama, actual[0]) for grama in trigramas(texto)]
+                    )
+                    self.cursor.execute("DELETE FROM terminos_busqueda WHERE id = ?", (actual[0],))
+                    borrados += 1
+                continue
+
+            nombre = max(candidatos)[1]
+            if actual is None:
+                for termino, gramas in terminos_indexados([(TIPO_FARMACIA, nombre)]):
+                    self.cursor.execute("""
+                        INSERT INTO terminos_busqueda (tipo, texto, nombre, num_trigramas, distancia_maxima)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, termino)
+                    id_termino = self.cursor.lastrowid
+                    self.cursor.executemany(
+                        "INSERT INTO trigramas (trigrama, termino_id) VALUES (?, ?)",
+                        [(grama, id_termino) for grama in gramas]
+                    )
+                    agregados += 1
+            elif actual[1] != nombre:
+                self.cursor.execute("UPDATE terminos_busqueda SET nombre = ? WHERE id = ?", (nombre, actual[0]))
+        logging.info(f"Índice difuso actualizado: {agregados} términos agregados, {borrados} eliminados")
+
+    def actualizar_indice_espacial(self, ids_actualizados=None, ids_eliminados=(), sufijo=""):
+        """Reconstruye el R*Tree farmacias_geo con las coordenadas de farmacias.
+
+        Cada farmacia es un punto (min = max). Las coordenadas vacías o fuera
+        de LIMITES_CHILE (por ejemplo sin punto decimal) quedan fuera del
+        índice. Con `ids_actualizados` solo se reemplazan los puntos de esas
+        farmacias y se borran los de `ids_eliminados`. No hace commit, igual
+        que actualizar_tablas_referencia.
+        """
+        lat_min, lat_max, lng_min, lng_max = LIMITES_CHILE
+        sql_insertar = f"""
+            INSERT INTO farmacias_geo{sufijo} (id, min_lat, max_lat, min_lng, max_lng)
+            SELECT id, lat, lat, lng, lng
+            FROM (
+                SELECT id, CAST(local_lat AS REAL) AS lat, CAST(local_lng AS REAL) AS lng
+                FROM farmacias{sufijo}
+                WHERE TRIM(local_lat) <> '' AND TRIM(local_lng) <> '' {{filtro}}
+            )
+            WHERE lat BETWEEN ? AND ? AND lng BETWEEN ? AND ?
+        """
+        if ids_actualizados is None:
+            self.cursor.execute(f"DELETE FROM farmacias_geo{sufijo}")
+            self.cursor.execute(sql_insertar.format(filtro=""), (lat_min, lat_max, lng_min, lng_max))
+            logging.info(f"Índice espacial reconstruido: {self.cursor.rowcount} farmacias con coordenadas")
+            return
+
+        self.cursor.executemany(
+            "DELETE FROM farmacias_geo WHERE id = ?",
+            [(id_farmacia,) for id_farmacia in list(ids_actualizados) + list(ids_eliminados)]
+        )
+        self.cursor.executemany(
+            sql_insertar.format(filtro="AND id = ?"),
+            [(id_farmacia, lat_min, lat_max, lng_min, lng_max) for id_farmacia in ids_actualizados]
+        )
+
+    def actualizar_tablas_referencia(self, solo_si_cambiaron=False, sufijo="") -> bool:
+        """Reconstruye regiones y comunas a partir de la tabla farmacias.
+
+        Con `solo_si_cambiaron` no se escribe nada si ambas tablas ya tienen
+        esas mismas filas. Retorna si se reescribieron. No hace commit: se
+        ejecuta dentro de la transacción que modifica farmacias, para que
+        ambas cambien juntas.
+        """
+        regiones = self.cursor.execute(f"""
+            SELECT fk_region, MAX(nombre_region)
+            FROM farmacias{sufijo}
+            WHERE fk_region IS NOT NULL AND nombre_region IS NOT NULL
+            GROUP BY fk_region
+        """).fetchall()
+        comunas = self.cursor.execute(f"""
+            SELECT fk_comuna, MAX(fk_region), MAX(comuna_nombre), MAX(comuna_clave)
+            FROM farmacias{sufijo}
+            WHERE fk_comuna IS NOT NULL AND fk_region IS NOT NULL AND comuna_nombre IS NOT NULL
+            GROUP BY fk_comuna
+        """).fetchall()
+
+        if solo_si_cambiaron:
+            regiones_actuales = self.cursor.execute("SELECT id, nombre FROM regiones ORDER BY id").fetchall()
+            comunas_actuales = self.cursor.execute(
+                "SELECT id, fk_region, nombre, clave FROM comunas ORDER BY id"
+            ).fetchall()
+            if regiones == regiones_actuales and comunas == comunas_actuales:
+                return False
+
+        self.cursor.execute(f"DELETE FROM comunas{sufijo}")
+        self.cursor.execute(f"DELETE FROM regiones{sufijo}")
+        self.cursor.executemany(f"INSERT INTO regiones{sufijo} (id, nombre) VALUES (?, ?)", regiones)
+        self.cursor.executemany(
+            f"INSERT INTO comunas{sufijo} (id, fk_region, nombre, clave) VALUES (?, ?, ?, ?)", comunas
+        )
+        return True
+
+    def migrar_esquema(self):
+        """Lleva una base de datos existente a VERSION_ESQUEMA.
+
+        Las columnas nuevas ya las agrega migrar_columnas; aquí se rellenan,
+        se reemplazan los índices antiguos y se pueblan las tablas de
+        referencia, todo en una transacción.
+
+        - Versión 1: comuna_clave y tablas regiones/comunas.
+        - Versión 2: una fila por local_id; las copias de turno se fusionan
+          en la fila normal de la misma farmacia (columnas turno_*).
+        - Versión 3: índice espacial farmacias_geo.
+        - Versión 4: horario en minutos (horario_inicio, horario_fin).
+        - Versión 5: índice de trigramas para búsquedas con errores de tipeo.
+        - Versión 6: índice del chat ordenado por turno y nombre, para paginar.
+        """
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version >= VERSION_ESQUEMA:
+            return
+
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            # También la variante _b que pudo crear crear_indice en una staging
+            for indice in INDICES_OBSOLETOS:
+                self.cursor.execute(f"DROP INDEX IF EXISTS {indice}")
+                self.cursor.execute(f"DROP INDEX IF EXISTS {indice}_b")
+
+            if version < 1:
+                self.cursor.execute(
+                    "UPDATE farmacias SET comuna_clave = normalizar(comuna_nombre) WHERE comuna_clave IS NULL"
+                )
+
+            if version < 2:
+                self.fusionar_duplicados_turno()
+
+            if version < 4:
+                self.calcular_horarios()
+
+            self.actualizar_tablas_derivadas()
+            self.cursor.execute(f"PRAGMA user_version = {VERSION_ESQUEMA}")
+            self.connection.commit()
+            logging.info(f"Esquema migrado de la versión {version} a la {VERSION_ESQUEMA}")
+        except sqlite3.Error as err:
+            self.connection.rollback()
+            logging.error(f"Error al migrar el esquema: {err}")
             raise
 
+    def fusionar_duplicados_turno(self):
+        """Deja una sola fila por local_id en una tabla con copias de turno.
+
+        No hace commit; se usa dentro de la transacción de migrar_esquema.
+        Los hashes se borran para que la próxima sincronización reescriba las
+        filas con el formato nuevo.
+        """
+        asignaciones_propias = ', '.join(
+            f"{destino} = {origen}" for origen, destino in CAMPOS_TURNO
+        )
+        self.cursor.execute(f"UPDATE farmacias SET {asignaciones_propias} WHERE de_turno = 1")
+
+        asignaciones_turno = ', '.join(
+            f"{destino} = (SELECT t.{origen} FROM farmacias t "
+            f"WHERE t.local_id = farmacias.local_id AND t.de_turno = 1)"
+            for origen, destino in CAMPOS_TURNO
+        )
+        self.cursor.execute(f"""
+            UPDATE farmacias
+            SET {asignaciones_turno}, de_turno = 1
+            WHERE de_turno = 0 AND EXISTS (
+                SELECT 1 FROM farmacias t
+                WHERE t.local_id = farmacias.local_id AND t.de_turno = 1
+            )
+        """)
+
+        # La fila normal se insertó antes que la de turno, así que es la de menor id
+        self.cursor.execute("""
+            DELETE FROM farmacias
+            WHERE id NOT IN (SELECT MIN(id) FROM farmacias GROUP BY local_id)
+        """)
+        logging.info(f"Filas de turno duplicadas fusionadas: {self.cursor.rowcount}")
+        self.cursor.execute("UPDATE farmacias SET hash_contenido = NULL")
+
+    def calcular_horarios(self):
+        """Rellena horario_inicio/horario_fin de las filas existentes (sin commit)"""
+        filas = self.cursor.execute("""
+            SELECT id,
+                   COALESCE(turno_hora_apertura, funcionamiento_hora_apertura),
+                   COALESCE(turno_hora_cierre, funcionamiento_hora_cierre)
+            FROM farmacias
+        """).fetchall()
+        self.cursor.executemany(
+            "UPDATE farmacias SET horario_inicio = ?, horario_fin = ? WHERE id = ?",
+            [intervalo_apertura(apertura, cierre) + (id_farmacia,) for id_farmacia, apertura, cierre in filas]
+        )
+
+    def crear_tabla_estado_feeds(self):
+        """Crea la tabla con los validadores HTTP de cada feed"""
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS estado_feeds (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.connection.commit()
+
+    def cargar_estado_feeds(self) -> dict:
+        """Retorna url -> (etag, last_modified) de la última actualización aplicada"""
+        return {
+            url: (etag, last_modified)
+            for url, etag, last_modified in self.cursor.execute(
+                "SELECT url, etag, last_modified FROM estado_feeds"
+            )
+        }
+
+    def guardar_estado_feeds(self, resultados):
+        """Confirma los validadores de las descargas ya aplicadas a la base"""
+        with self.connection:
+            for resultado in resultados:
+                if resultado.estado != DESCARGADO:
+                    continue
+                self.cliente.confirmar(resultado)
+                self.cursor.execute("""
+                    INSERT OR REPLACE INTO estado_feeds (url, etag, last_modified, fecha_actualizacion)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                """, (resultado.url, resultado.etag, resultado.last_modified))
+
     def obtener_datos_api(self, url):
         """Obtiene datos de la API especificada"""
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error obteniendo datos de {url}: {str(e)}")
-            return None
+        resultado = self.cliente.obtener(url, condicional=False)
+        return resultado.datos if resultado.estado == DESCARGADO else None
 
     def limpiar_tabla(self):
         """Limpia todos los registros de la tabla farmacias"""
@@ -100,191 +720,469 @@ class ActualizadorFarmacias:
             print(f"Error al limpiar la tabla: {err}")
             raise
 
+    def preparar_tabla_staging(self):
+        """Crea la tabla staging vacía, ya con sus índices, y las copias staging
+        de las tablas derivadas; ahí se cargará la nueva actualización"""
+        try:
+            self.eliminar_tablas_staging()
+            self.crear_tabla(TABLA_STAGING)
+            self.crear_indices(TABLA_STAGING)
+            self.crear_tablas_referencia(SUFIJO_STAGING)
+            self.connection.commit()
+        except sqlite3.Error as err:
+            print(f"Error al preparar la tabla {TABLA_STAGING}: {err}")
+            raise
+
+    def validar_tabla_staging(self) -> bool:
+        """Compara la cantidad de filas de la tabla staging con el snapshot actual"""
+        filas_nuevas = self.cursor.execute(
+            f"SELECT COUNT(*) FROM {TABLA_STAGING}"
+        ).fetchone()[0]
+        filas_previas = self.cursor.execute(
+            "SELECT COUNT(*) FROM farmacias"
+        ).fetchone()[0]
+
+        logging.info(f"Filas en snapshot anterior: {filas_previas}, filas nuevas: {filas_nuevas}")
+
+        if filas_nuevas == 0:
+            logging.error("La tabla staging quedó vacía, se mantiene el snapshot anterior")
+            return False
+        if filas_nuevas < filas_previas * PROPORCION_MINIMA_FILAS:
+            logging.error(
+                f"La tabla staging tiene {filas_nuevas} filas, menos del "
+                f"{PROPORCION_MINIMA_FILAS:.0%} de las {filas_previas} anteriores; "
+                "se mantiene el snapshot anterior"
+            )
+            return False
+        return True
+
+    def construir_derivadas_staging(self):
+        """Llena las copias staging de las tablas derivadas desde la tabla staging"""
+        try:
+            self.actualizar_tablas_derivadas(SUFIJO_STAGING)
+            self.connection.commit()
+        except sqlite3.Error as err:
+            self.connection.rollback()
+            logging.error(f"Error al construir las tablas derivadas staging: {err}")
+            raise
+
+    def intercambiar_tablas(self):
+        """Reemplaza farmacias y sus tablas derivadas por las staging en una sola transacción.
+
+        Índices y tablas derivadas ya se construyeron sobre las staging, así
+        que el intercambio solo hace DROP y RENAME. Los lectores (en modo
+        WAL) siguen viendo las tablas anteriores hasta el COMMIT y nunca
+        observan una tabla vacía o a medio cargar.
+        """
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            for tabla in ("farmacias",) + TABLAS_DERIVADAS:
+                self.cursor.execute(f"DROP TABLE IF EXISTS {tabla}")
+                self.cursor.execute(f"ALTER TABLE {tabla}{SUFIJO_STAGING} RENAME TO {tabla}")
+            self.connection.commit()
+            logging.info("Tabla farmacias reemplazada por la nueva actualización")
+        except sqlite3.Error as err:
+            self.connection.rollback()
+            logging.error(f"Error al intercambiar tablas: {err}")
+            raise
+
+    def eliminar_tablas_staging(self):
+        """DROP de la tabla staging y de las copias staging de las derivadas (sin commit)"""
+        for tabla in ("farmacias",) + TABLAS_DERIVADAS:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {tabla}{SUFIJO_STAGING}")
+
+    def descartar_tabla_staging(self):
+        """Elimina las tablas staging sin tocar las tablas en uso"""
+        self.eliminar_tablas_staging()
+        self.connection.commit()
+
     def cerrar_conexion(self):
         """Cierra la conexión a la base de datos"""
+        if hasattr(self, 'cliente'):
+            self.cliente.cerrar()
         if hasattr(self, 'connection') and self.connection:
             self.connection.close()
             print("Conexión a la base de datos cerrada")
 
-    def validar_farmacia(self, farmacia: dict) -> tuple[bool, str]:
-        """Valida los datos críticos de una farmacia antes de insertarla"""
-        try:
-            print("Iniciando validación de farmacia:", farmacia)  # Debug log
-            
-            # Mapeo de regiones
-            regiones = {
-                1: 'Arica y Parinacota',
-                2: 'Tarapacá',
-                3: 'Antofagasta',
-                4: 'Atacama',
-                5: 'Coquimbo',
-                6: 'Valparaíso',
-                7: 'Metropolitana de Santiago',
-                8: 'Libertador General Bernardo O\'Higgins',
-                9: 'Maule',
-                10: 'Biobío',
-                11: 'La Araucanía',
-                12: 'Los Ríos',
-                13: 'Los Lagos',
-                14: 'Aysén del General Carlos Ibáñez del Campo',
-                15: 'Magallanes y de la Antártica Chilena',
-                16: 'Ñuble'
-            }
+    def validar_farmacia(self, farmacia: Optional[dict], turno: Optional[dict] = None) -> tuple[Optional[tuple], str]:
+        """Valida los datos críticos de una farmacia y la convierte en una fila.
+
+        `farmacia` es el registro del feed normal y `turno` el del feed de
+        turnos para el mismo local_id (cualquiera de los dos puede faltar).
+        Los datos generales salen del registro normal si existe; el horario
+        de turno queda en las columnas turno_*.
 
+        Retorna (fila, mensaje): la fila es una tupla lista para INSERT en el
+        orden de COLUMNAS_FILA, o None si la farmacia no es válida. Los
+        diccionarios recibidos no se modifican.
+        """
+        if farmacia is None:
+            farmacia = turno
+        try:
             # Validaciones de campos obligatorios
-            campos_obligatorios = ['local_id', 'local_nombre', 'comuna_nombre', 'local_direccion']
-            for campo in campos_obligatorios:
+            for campo in CAMPOS_OBLIGATORIOS:
                 if not farmacia.get(campo):
-                    print(f"Error: Campo obligatorio '{campo}' está vacío")  # Debug log
-                    return False, f"Campo obligatorio '{campo}' está vacío"
-
-            # Limpiar y validar todos los campos string
-            campos_string = [
-                'local_nombre', 'comuna_nombre', 'localidad_nombre', 'local_direccion',
-                'funcionamiento_hora_apertura', 'funcionamiento_hora_cierre',
-                'local_telefono', 'funcionamiento_dia'
-            ]
-            for campo in campos_string:
-                if campo in farmacia and farmacia[campo]:
-                    farmacia[campo] = str(farmacia[campo]).strip()
-                    print(f"Campo {campo} limpiado: {farmacia[campo]}")  # Debug log
-
-            # Validación y conversión de campos numéricos
-            campos_numericos = ['local_id', 'fk_region', 'fk_comuna', 'fk_localidad']
-            for campo in campos_numericos:
-                if campo in farmacia and farmacia[campo]:
+                    return None, f"Campo obligatorio '{campo}' está vacío"
+
+            # Limpiar campos string
+            texto = {}
+            for campo in CAMPOS_STRING:
+                valor = farmacia.get(campo)
+                texto[campo] = str(valor).strip() if valor else valor
+
+            # Conversión de campos numéricos
+            numeros = {}
+            for campo in CAMPOS_NUMERICOS:
+                valor = farmacia.get(campo)
+                if valor:
                     try:
-                        valor_original = farmacia[campo]
-                        farmacia[campo] = int(str(farmacia[campo]).strip())
-                        print(f"Campo {campo} convertido: {valor_original} -> {farmacia[campo]}")  # Debug log
-                        if campo == 'local_id' and farmacia[campo] <= 0:
-                            print(f"Error: local_id inválido: {farmacia[campo]}")  # Debug log
-                            return False, f"local_id debe ser mayor que 0: {farmacia[campo]}"
-                    except (ValueError, TypeError) as e:
-                        print(f"Error al convertir {campo}: {e}")  # Debug log
-                        return False, f"{campo} no es un número válido: {farmacia[campo]}"
-
-            # Agregar nombre_region basado en fk_region
-            if 'fk_region' in farmacia and farmacia['fk_region']:
-                farmacia['nombre_region'] = regiones.get(farmacia['fk_region'], 'Región no encontrada')
-                print(f"Nombre región asignado: {farmacia['nombre_region']}")  # Debug log
-
-            print("Validación exitosa")  # Debug log
-            return True, "Validación exitosa"
+                        valor = int(str(valor).strip())
+                    except (ValueError, TypeError):
+                        return None, f"{campo} no es un número válido: {valor}"
+                numeros[campo] = valor
+
+            if numeros['local_id'] <= 0:
+                return None, f"local_id debe ser mayor que 0: {numeros['local_id']}"
+
+            # Nombre de región basado en fk_region
+            fk_region = numeros['fk_region']
+            nombre_region = REGIONES.get(fk_region, 'Región no encontrada') if fk_region else None
+
+            comuna_clave = normalizar_texto(texto['comuna_nombre'])
+
+            # Horario del feed de turnos, si la farmacia está de turno
+            datos_turno = {}
+            for origen, destino in CAMPOS_TURNO:
+                valor = turno.get(origen) if turno else None
+                datos_turno[destino] = str(valor).strip() if valor else valor
+
+            # Intervalo en minutos del horario vigente (el de turno si lo hay)
+            horario_inicio, horario_fin = intervalo_apertura(
+                datos_turno['turno_hora_apertura'] or texto['funcionamiento_hora_apertura'],
+                datos_turno['turno_hora_cierre'] or texto['funcionamiento_hora_cierre']
+            )
+
+            url_direccion = construir_url_maps(
+                self.estrategia_url,
+                texto['local_direccion'],
+                texto['comuna_nombre'],
+                nombre_region,
+                farmacia.get('local_lat'),
+                farmacia.get('local_lng')
+            )
+
+            fila = (
+                numeros['local_id'],
+                texto['local_nombre'],
+                texto['comuna_nombre'],
+                texto['localidad_nombre'],
+                texto['local_direccion'],
+                url_direccion,
+                texto['funcionamiento_hora_apertura'],
+                texto['funcionamiento_hora_cierre'],
+                texto['local_telefono'],
+                farmacia.get('local_lat'),
+                farmacia.get('local_lng'),
+                texto['funcionamiento_dia'],
+                farmacia.get('fecha'),
+                1 if turno else 0,
+                fk_region,
+                numeros['fk_comuna'],
+                numeros['fk_localidad'],
+                nombre_region,
+                comuna_clave
+            ) + tuple(datos_turno.values()) + (horario_inicio, horario_fin)
+            return fila, "Validación exitosa"
             
         except Exception as e:
-            print(f"Error en validación: {str(e)}")  # Debug log
-            return False, f"Error en validación: {str(e)}"
+            return None, f"Error en validación: {str(e)}"
+
+    def filas_validadas(self, farmacias_normal, farmacias_turno, motivos_invalidas):
+        """Combina ambos feeds y entrega una fila por farmacia con su hash.
+
+        Las farmacias inválidas no se entregan; solo se cuentan por motivo en
+        `motivos_invalidas` (un Counter).
+        """
+        for farmacia, turno in combinar_feeds(farmacias_normal, farmacias_turno):
+            fila, mensaje = self.validar_farmacia(farmacia, turno)
+            if fila is None:
+                motivos_invalidas[mensaje.split(':')[0]] += 1
+                continue
+            yield fila + (calcular_hash_contenido(fila),)
+
+    def insertar_farmacias(self, farmacias_normal, farmacias_turno, tabla="farmacias",
+                           tamano_lote=TAMANO_LOTE) -> bool:
+        """Inserta ambos feeds en la tabla indicada, una fila por farmacia.
+
+        Las filas válidas se insertan con executemany en lotes de
+        `tamano_lote`, todas dentro de una única transacción. Los errores de
+        validación solo se cuentan por motivo y se registran al final.
+        """
+        farmacias_validas = 0
+        motivos_invalidas = Counter()
 
-    def insertar_farmacias(self, farmacias, de_turno) -> bool:
-        """Inserta las farmacias en la base de datos"""
+        sql = f"""
+        INSERT INTO {tabla} ({', '.join(COLUMNAS_INSERCION)})
+        VALUES ({', '.join('?' * len(COLUMNAS_INSERCION))})
+        """
+
+        inicio = time.perf_counter()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            farmacias_validas = 0
-            farmacias_invalidas = 0
-
-            sql = """
-            INSERT INTO farmacias (
-                local_id, local_nombre, comuna_nombre, localidad_nombre,
-                local_direccion, URL_direccion, funcionamiento_hora_apertura,
-                funcionamiento_hora_cierre, local_telefono, local_lat, local_lng,
-                funcionamiento_dia, fecha, de_turno, fk_region, fk_comuna,
-                fk_localidad, nombre_region
-            ) VALUES (
-                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-            )
-            """
-            
-            for farmacia in farmacias:
-                # Validar la farmacia antes de insertarla
-                es_valida, mensaje = self.validar_farmacia(farmacia)
-                if es_valida:
-                    valores = (
-                        farmacia.get('local_id'),
-                        farmacia.get('local_nombre'),
-                        farmacia.get('comuna_nombre'),
-                        farmacia.get('localidad_nombre'),
-                        farmacia.get('local_direccion'),
-                        farmacia.get('URL_direccion'),
-                        farmacia.get('funcionamiento_hora_apertura'),
-                        farmacia.get('funcionamiento_hora_cierre'),
-                        farmacia.get('local_telefono'),
-                        farmacia.get('local_lat'),
-                        farmacia.get('local_lng'),
-                        farmacia.get('funcionamiento_dia'),
-                        farmacia.get('fecha'),
-                        de_turno,
-                        farmacia.get('fk_region'),
-                        farmacia.get('fk_comuna'),
-                        farmacia.get('fk_localidad'),
-                        farmacia.get('nombre_region')
-                    )
-                    
-                    cursor.execute(sql, valores)
-                    farmacias_validas += 1
-                else:
-                    print(f"Farmacia inválida: {mensaje}")
-                    farmacias_invalidas += 1
-            
-            conn.commit()
-
-            # Registro de resultados
-            tipo_farmacia = "de turno" if de_turno else "normales"
-            print(f"Farmacias {tipo_farmacia} procesadas:")
-            print(f"- Válidas: {farmacias_validas}")
-            print(f"- Inválidas: {farmacias_invalidas}")
-            print(f"- Total: {farmacias_validas + farmacias_invalidas}")
-
-            # Registro en archivo de log
-            logging.info(f"Farmacias {tipo_farmacia} procesadas:")
-            logging.info(f"- Válidas: {farmacias_validas}")
-            logging.info(f"- Inválidas: {farmacias_invalidas}")
-            logging.info(f"- Total: {farmacias_validas + farmacias_invalidas}")
-            
-            return True
-            
+            with self.connection:
+                filas = self.filas_validadas(farmacias_normal, farmacias_turno, motivos_invalidas)
+                for lote in en_lotes(filas, tamano_lote):
+                    self.cursor.executemany(sql, lote)
+                    farmacias_validas += len(lote)
+
         except sqlite3.Error as e:
             print(f"Error al insertar farmacias: {e}")
             logging.error(f"Error al insertar farmacias: {e}")
-            farmacias_invalidas += 1
             return False
-        finally:
-            if conn:
-                conn.close()
 
-    def actualizar_farmacias(self):
-        """Proceso principal de actualización"""
+        duracion = time.perf_counter() - inicio
+        farmacias_invalidas = sum(motivos_invalidas.values())
+        total = farmacias_validas + farmacias_invalidas
+        filas_por_segundo = farmacias_validas / duracion if duracion > 0 else 0.0
+
+        self.metricas_ingesta = {
+            'validas': farmacias_validas,
+            'invalidas': farmacias_invalidas,
+            'duracion_s': duracion,
+            'filas_por_segundo': filas_por_segundo,
+        }
+
+        # Registro de resultados
+        print(
+            f"Farmacias: {farmacias_validas} válidas, "
+            f"{farmacias_invalidas} inválidas en {duracion * 1000:.1f} ms"
+        )
+        logging.info("Farmacias procesadas:")
+        logging.info(f"- Válidas: {farmacias_validas}")
+        logging.info(f"- Inválidas: {farmacias_invalidas}")
+        logging.info(f"- Total: {total}")
+        logging.info(f"- Tiempo de ingesta: {duracion * 1000:.1f} ms ({filas_por_segundo:.0f} filas/s)")
+        for motivo, cantidad in motivos_invalidas.most_common():
+            logging.warning(f"- {cantidad} farmacias inválidas: {motivo}")
+
+        return True
+
+    def sincronizar_incremental(self, farmacias_normal, farmacias_turno,
+                                tamano_lote=TAMANO_LOTE) -> bool:
+        """Aplica sobre la tabla farmacias solo las diferencias con los feeds.
+
+        Cada fila se identifica por local_id (los feeds ya vienen combinados,
+        ver combinar_feeds). Se compara el hash de contenido de cada fila
+        contra el guardado y se aplican los INSERT/UPDATE/DELETE necesarios
+        en una sola transacción.
+        """
+        inicio = time.perf_counter()
+        motivos_invalidas = Counter()
+
+        existentes = {
+            local_id: (id_farmacia, hash_contenido, local_nombre)
+            for id_farmacia, local_id, hash_contenido, local_nombre in self.cursor.execute(
+                "SELECT id, local_id, hash_contenido, local_nombre FROM farmacias"
+            )
+        }
+
+        nuevas = []
+        modificadas = []
+        vistas = set()
+        for fila in self.filas_validadas(farmacias_normal, farmacias_turno, motivos_invalidas):
+            clave = fila[0]
+            vistas.add(clave)
+
+            anterior = existentes.get(clave)
+            if anterior is None:
+                nuevas.append(fila)
+            elif anterior[1] != fila[-1]:
+                modificadas.append(fila + (anterior[0],))
+
+        eliminadas = [
+            (anterior[0],) for clave, anterior in existentes.items()
+            if clave not in vistas
+        ]
+
+        if not vistas:
+            logging.error("Los feeds no entregaron farmacias válidas, no se aplican cambios")
+            return False
+        if existentes and len(eliminadas) > len(existentes) * (1 - PROPORCION_MINIMA_FILAS):
+            logging.error(
+                f"La sincronización eliminaría {len(eliminadas)} de {len(existentes)} "
+                "farmacias; se mantiene el snapshot anterior"
+            )
+            return False
+
+        sql_insertar = f"""
+        INSERT INTO farmacias ({', '.join(COLUMNAS_INSERCION)})
+        VALUES ({', '.join('?' * len(COLUMNAS_INSERCION))})
+        """
+        sql_actualizar = f"""
+        UPDATE farmacias
+        SET {', '.join(f'{columna} = ?' for columna in COLUMNAS_INSERCION)},
+            fecha_actualizacion = CURRENT_TIMESTAMP
+        WHERE id = ?
+        """
+
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE")
+            for lote in en_lotes(nuevas, tamano_lote):
+                self.cursor.executemany(sql_insertar, lote)
+            for lote in en_lotes(modificadas, tamano_lote):
+                self.cursor.executemany(sql_actualizar, lote)
+            for lote in en_lotes(eliminadas, tamano_lote):
+                self.cursor.executemany("DELETE FROM farmacias WHERE id = ?", lote)
+            if existentes:
+                self.actualizar_derivadas_de_cambios(existentes, nuevas, modificadas, eliminadas)
+            else:
+                self.actualizar_tablas_derivadas()
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"Error al sincronizar farmacias: {e}")
+            logging.error(f"Error al sincronizar farmacias: {e}")
+            return False
+
+        duracion = time.perf_counter() - inicio
+        self.metricas_sincronizacion = {
+            'agregadas': len(nuevas),
+            'modificadas': len(modificadas),
+            'eliminadas': len(eliminadas),
+            'sin_cambios': len(vistas) - len(nuevas) - len(modificadas),
+            'invalidas': sum(motivos_invalidas.values()),
+            'duracion_s': duracion,
+            'feeds_no_modificados': False,
+        }
+
+        print(
+            f"Sincronización incremental: {len(nuevas)} agregadas, "
+            f"{len(modificadas)} modificadas, {len(eliminadas)} eliminadas "
+            f"en {duracion * 1000:.1f} ms"
+        )
+        logging.info("Sincronización incremental completada:")
+        logging.info(f"- Agregadas: {len(nuevas)}")
+        logging.info(f"- Modificadas: {len(modificadas)}")
+        logging.info(f"- Eliminadas: {len(eliminadas)}")
+        logging.info(f"- Sin cambios: {self.metricas_sincronizacion['sin_cambios']}")
+        for motivo, cantidad in motivos_invalidas.most_common():
+            logging.warning(f"- {cantidad} farmacias inválidas: {motivo}")
+
+        return True
+
+    def actualizar_derivadas_de_cambios(self, existentes, nuevas, modificadas, eliminadas):
+        """Llama a actualizar_tablas_derivadas_parcial con los ids y nombres que tocó la sincronización"""
+        nombre_anterior = {anterior[0]: anterior[2] for anterior in existentes.values()}
+        ids_nuevos = [
+            self.cursor.execute("SELECT id FROM farmacias WHERE local_id = ?", (fila[0],)).fetchone()[0]
+            for fila in nuevas
+        ]
+        ids_modificados = [fila[-1] for fila in modificadas]
+
+        nombres = {fila[1] for fila in nuevas} | {fila[1] for fila in modificadas}
+        nombres.update(nombre_anterior[id_farmacia] for id_farmacia in ids_modificados)
+        nombres.update(nombre_anterior[id_farmacia] for (id_farmacia,) in eliminadas)
+
+        self.actualizar_tablas_derivadas_parcial(
+            ids_nuevos + ids_modificados, [id_farmacia for (id_farmacia,) in eliminadas], nombres
+        )
+
+    def actualizar_farmacias(self, modo="incremental", streaming=True):
+        """Proceso principal de actualización.
+
+        modo="incremental" aplica solo las diferencias sobre la tabla en uso;
+        modo="completo" reconstruye la tabla en staging y la intercambia. Si
+        la tabla está vacía siempre se hace una carga completa.
+
+        Con streaming=True los feeds se parsean a medida que llegan y cada
+        farmacia validada pasa directo a los lotes de inserción, sin
+        materializar el feed completo en memoria.
+        """
+        inicio = time.perf_counter()
+        # Las métricas describen solo la última ejecución, aunque falle
+        self.metricas_sincronizacion = {}
         try:
             # Crear tabla si no existe
             self.crear_tabla()
             
-            # Obtener datos de ambas APIs
-            farmacias_normal = self.obtener_datos_api(self.url_farmacias_normal)
-            farmacias_turno = self.obtener_datos_api(self.url_farmacias_turno)
+            tabla_con_datos = self.cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM farmacias)"
+            ).fetchone()[0]
+            incremental = modo == "incremental" and tabla_con_datos
             
-            if farmacias_normal is None or farmacias_turno is None:
+            # Obtener datos de ambas APIs en paralelo; en modo incremental los
+            # feeds que no cambiaron desde la última actualización responden 304
+            urls = [self.url_farmacias_normal, self.url_farmacias_turno]
+            resultados = self.cliente.obtener_varios(urls, condicional=incremental, streaming=streaming)
+            
+            if any(resultado.estado not in (DESCARGADO, NO_MODIFICADO) for resultado in resultados.values()):
                 logging.error("No se pudieron obtener los datos de las APIs")
                 return False
             
-            # Limpiar tabla antes de insertar nuevos datos
-            self.limpiar_tabla()
+            if incremental:
+                if all(resultado.estado == NO_MODIFICADO for resultado in resultados.values()):
+                    logging.info("Los feeds no cambiaron desde la última actualización")
+                    filas = self.cursor.execute("SELECT COUNT(*) FROM farmacias").fetchone()[0]
+                    self.metricas_sincronizacion = {
+                        'agregadas': 0,
+                        'modificadas': 0,
+                        'eliminadas': 0,
+                        'sin_cambios': filas,
+                        'invalidas': 0,
+                        'duracion_s': time.perf_counter() - inicio,
+                        'feeds_no_modificados': True,
+                    }
+                    return True
+                
+                # Para combinar las farmacias por local_id se necesitan ambos
+                # feeds, así que el que respondió 304 se descarga completo
+                for url, resultado in resultados.items():
+                    if resultado.estado == NO_MODIFICADO:
+                        resultados[url] = self.cliente.obtener(url, condicional=False, streaming=streaming)
+                        if resultados[url].estado != DESCARGADO:
+                            logging.error("No se pudieron obtener los datos de las APIs")
+                            return False
+                
+                if not self.sincronizar_incremental(
+                    resultados[self.url_farmacias_normal].datos,
+                    resultados[self.url_farmacias_turno].datos
+                ):
+                    return False
+                
+                self.guardar_estado_feeds(resultados.values())
+                
+                logging.info("Actualización incremental de farmacias completada exitosamente")
+                return True
             
-            # Insertar farmacias normales
-            self.insertar_farmacias(farmacias_normal, False)
+            farmacias_normal = resultados[self.url_farmacias_normal].datos
+            farmacias_turno = resultados[self.url_farmacias_turno].datos
             
-            # Insertar farmacias de turno
-            self.insertar_farmacias(farmacias_turno, True)
+            # Construir la nueva versión en una tabla staging; la tabla en uso
+            # no se modifica hasta el intercambio final
+            self.preparar_tabla_staging()
             
-            # Actualizar URLs usando el método combinado
-            self.actualizar_url_combinada()
+            # Insertar ambos feeds combinados por local_id
+            if not self.insertar_farmacias(farmacias_normal, farmacias_turno, tabla=TABLA_STAGING):
+                self.descartar_tabla_staging()
+                return False
+            self.construir_derivadas_staging()
+            
+            # Validar contra el snapshot anterior antes de publicar
+            if not self.validar_tabla_staging():
+                self.descartar_tabla_staging()
+                return False
+            
+            self.intercambiar_tablas()
+            self.guardar_estado_feeds(resultados.values())
             
             logging.info("Actualización de farmacias completada exitosamente")
             return True
             
         except Exception as e:
             logging.error(f"Error en el proceso de actualización: {str(e)}")
+            try:
+                self.descartar_tabla_staging()
+            except sqlite3.Error:
+                pass
             return False
 
     def consultar_farmacias(self, limit=10):
@@ -323,188 +1221,52 @@ class ActualizadorFarmacias:
         finally:
             conn.close()
 
-    def actualizar_url_direccion(self) -> bool:
-        """Actualiza el campo URL_direccion para todas las farmacias"""
+    def actualizar_urls(self, estrategia=None, tabla="farmacias", solo_pendientes=False) -> bool:
+        """Regenera URL_direccion con una sola sentencia UPDATE.
+
+        Normalmente las URLs ya se calculan durante la ingesta; este método
+        sirve para cambiar de estrategia sobre datos existentes sin recorrer
+        las filas sin URL. La estrategia 'coordenadas' no toca las filas sin
+        coordenadas, que conservan la URL que tenían.
+        """
+        estrategia = estrategia or self.estrategia_url
+        condiciones = []
+        if solo_pendientes:
+            condiciones.append("URL_direccion IS NULL")
+        if estrategia == 'coordenadas':
+            condiciones.append(
+                "local_lat IS NOT NULL AND local_lng IS NOT NULL "
+                "AND TRIM(local_lat) <> '' AND TRIM(local_lng) <> ''"
+            )
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Obtener todas las farmacias que necesitan URL
-            cursor.execute("""
-                SELECT id, local_direccion, comuna_nombre, nombre_region 
-                FROM farmacias
-            """)
-            farmacias = cursor.fetchall()
-            
-            actualizadas = 0
-            con_error = 0
-            
-            for farmacia in farmacias:
-                try:
-                    id_farmacia, direccion, comuna, region = farmacia
-                    
-                    # Construir la URL reemplazando espacios por +
-                    url_base = "https://www.google.com/maps/place/"
-                    direccion_formateada = direccion.replace(" ", "+") if direccion else ""
-                    comuna_formateada = comuna.replace(" ", "+") if comuna else ""
-                    region_formateada = region.replace(" ", "+") if region else ""
-                    
-                    url_completa = f"{url_base}{direccion_formateada},+{comuna_formateada},+{region_formateada}"
-                    
-                    # Actualizar el registro
-                    cursor.execute("""
-                        UPDATE farmacias 
-                        SET URL_direccion = ? 
-                        WHERE id = ?
-                    """, (url_completa, id_farmacia))
-                    
-                    actualizadas += 1
-                    
-                except Exception as e:
-                    logging.error(f"Error procesando farmacia {id_farmacia}: {str(e)}")
-                    con_error += 1
-                    continue
-            
-            conn.commit()
-            
-            # Registrar resultados
-            logging.info("Actualización de URLs completada:")
-            logging.info(f"- Farmacias actualizadas: {actualizadas}")
-            logging.info(f"- Farmacias con error: {con_error}")
-            logging.info(f"- Total procesadas: {actualizadas + con_error}")
-            
+            with self.connection:
+                self.cursor.execute(f"""
+                    UPDATE {tabla}
+                    SET URL_direccion = url_maps(
+                        ?, local_direccion, comuna_nombre, nombre_region, local_lat, local_lng
+                    )
+                    {"WHERE " + " AND ".join(condiciones) if condiciones else ""}
+                """, (estrategia,))
+                actualizadas = self.cursor.rowcount
+
+            logging.info(f"URLs '{estrategia}' actualizadas en {tabla}: {actualizadas} farmacias")
             return True
-            
+
         except sqlite3.Error as e:
             logging.error(f"Error en la base de datos: {e}")
             return False
-        finally:
-            if conn:
-                conn.close()
 
-    def actualizar_url_coordenadas(self) -> bool:
+    def actualizar_url_direccion(self, tabla="farmacias") -> bool:
+        """Actualiza el campo URL_direccion para todas las farmacias"""
+        return self.actualizar_urls("direccion", tabla)
+
+    def actualizar_url_coordenadas(self, tabla="farmacias") -> bool:
         """Actualiza el campo URL_direccion usando las coordenadas geográficas"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Obtener todas las farmacias con coordenadas
-            cursor.execute("""
-                SELECT id, local_lat, local_lng 
-                FROM farmacias
-                WHERE local_lat IS NOT NULL AND local_lng IS NOT NULL
-            """)
-            farmacias = cursor.fetchall()
-            
-            actualizadas = 0
-            con_error = 0
-            
-            for farmacia in farmacias:
-                try:
-                    id_farmacia, lat, lng = farmacia
-                    
-                    # Construir la URL con coordenadas
-                    url_base = "https://www.google.com/maps/@"
-                    lat_formateada = str(lat)[:11] if lat else ""
-                    lng_formateada = str(lng)[:10] if lng else ""
-                    
-                    url_completa = f"{url_base}{lat_formateada},{lng_formateada},18z"
-                    
-                    # Actualizar el registro
-                    cursor.execute("""
-                        UPDATE farmacias 
-                        SET URL_direccion = ? 
-                        WHERE id = ?
-                    """, (url_completa, id_farmacia))
-                    
-                    actualizadas += 1
-                    
-                except Exception as e:
-                    logging.error(f"Error procesando coordenadas de farmacia {id_farmacia}: {str(e)}")
-                    con_error += 1
-                    continue
-            
-            conn.commit()
-            
-            # Registrar resultados
-            logging.info("Actualización de URLs por coordenadas completada:")
-            logging.info(f"- Farmacias actualizadas: {actualizadas}")
-            logging.info(f"- Farmacias con error: {con_error}")
-            logging.info(f"- Total procesadas: {actualizadas + con_error}")
-            
-            return True
-            
-        except sqlite3.Error as e:
-            logging.error(f"Error en la base de datos: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
+        return self.actualizar_urls("coordenadas", tabla)
 
-    def actualizar_url_combinada(self) -> bool:
+    def actualizar_url_combinada(self, tabla="farmacias", solo_pendientes=False) -> bool:
         """Actualiza el campo URL_direccion combinando dirección y coordenadas"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Obtener todas las farmacias con sus datos
-            cursor.execute("""
-                SELECT id, local_direccion, comuna_nombre, nombre_region, local_lat, local_lng 
-                FROM farmacias
-                WHERE local_lat IS NOT NULL AND local_lng IS NOT NULL
-            """)
-            farmacias = cursor.fetchall()
-            
-            actualizadas = 0
-            con_error = 0
-            
-            for farmacia in farmacias:
-                try:
-                    id_farmacia, direccion, comuna, region, lat, lng = farmacia
-                    
-                    # Construir la primera parte de la URL (dirección)
-                    url_base = "https://www.google.com/maps/place/"
-                    direccion_formateada = direccion.replace(" ", "+") if direccion else ""
-                    comuna_formateada = comuna.replace(" ", "+") if comuna else ""
-                    region_formateada = region.replace(" ", "+") if region else ""
-                    
-                    # Construir la segunda parte (coordenadas)
-                    lat_formateada = str(lat)[:11] if lat else ""
-                    lng_formateada = str(lng)[:10] if lng else ""
-                    
-                    # Combinar ambas partes
-                    url_completa = f"{url_base}{direccion_formateada},+{comuna_formateada},+{region_formateada}/@{lat_formateada},{lng_formateada}"
-                    
-                    # Actualizar el registro
-                    cursor.execute("""
-                        UPDATE farmacias 
-                        SET URL_direccion = ? 
-                        WHERE id = ?
-                    """, (url_completa, id_farmacia))
-                    
-                    actualizadas += 1
-                    
-                except Exception as e:
-                    logging.error(f"Error procesando farmacia {id_farmacia}: {str(e)}")
-                    con_error += 1
-                    continue
-            
-            conn.commit()
-            
-            # Registrar resultados
-            logging.info("Actualización de URLs combinadas completada:")
-            logging.info(f"- Farmacias actualizadas: {actualizadas}")
-            logging.info(f"- Farmacias con error: {con_error}")
-            logging.info(f"- Total procesadas: {actualizadas + con_error}")
-            
-            return True
-            
-        except sqlite3.Error as e:
-            logging.error(f"Error en la base de datos: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
+        return self.actualizar_urls("combinada", tabla, solo_pendientes)
 
 # Agregar código para ejecutar el proceso
 if __name__ == "__main__":
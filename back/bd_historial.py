@@ -0,0 +1,169 @@
+"""
+Acceso a la base de historial de consultas y usuarios (historial_consultas.db).
+
+BaseHistorial crea el esquema una sola vez al abrirse y entrega a cada hilo
+su propia conexión de larga vida en modo WAL, así que los lectores no
+bloquean al escritor y las sentencias preparadas quedan en el caché de la
+conexión entre llamadas. Las escrituras usan BEGIN IMMEDIATE con
+busy_timeout y se reintentan si la base sigue bloqueada. Con `diferir` las
+escrituras pasan por una EscrituraDiferida y se aplican por lotes en segundo
+plano.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from escritura_diferida import EscrituraDiferida
+
+RUTA_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Base', 'historial_consultas.db')
+
+# Milisegundos que SQLite espera un lock antes de fallar, y reintentos extra
+ESPERA_BLOQUEO_MS = 5000
+REINTENTOS_BLOQUEO = 3
+
+ESQUEMA = """
+    CREATE TABLE IF NOT EXISTS historial (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id TEXT NOT NULL,
+        consulta TEXT NOT NULL,
+        respuesta TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_historial_usuario_timestamp ON historial (usuario_id, timestamp);
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id TEXT PRIMARY KEY,
+        nombre TEXT,
+        fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        ultima_actividad TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+SQL_GUARDAR_USUARIO = """
+    INSERT INTO usuarios (id, nombre, fecha_creacion, ultima_actividad) VALUES (?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        nombre = COALESCE(excluded.nombre, usuarios.nombre),
+        ultima_actividad = excluded.ultima_actividad
+"""
+
+# El timestamp se fija al encolar (mismo formato que CURRENT_TIMESTAMP), no al escribir
+SQL_GUARDAR_HISTORIAL = "INSERT INTO historial (usuario_id, consulta, respuesta, timestamp) VALUES (?, ?, ?, ?)"
+
+
+class BaseHistorial:
+    """Conexiones por hilo a la base de historial, con el esquema ya creado"""
+
+    def __init__(self, ruta=RUTA_POR_DEFECTO, diferir=False):
+        self.ruta = ruta
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._local = threading.local()
+        self._conexiones = []
+        self._lock = threading.Lock()
+        self.errores = 0
+
+        conn = self.conexion()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(ESQUEMA)
+
+        self.escrituras = EscrituraDiferida(self.escritura, nombre="historial") if diferir else None
+
+    def conexion(self):
+        """Conexión del hilo actual; se abre la primera vez que el hilo la pide"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: las transacciones se abren explícitamente
+            conn = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None,
+                                   cached_statements=64)
+            conn.execute(f"PRAGMA busy_timeout={ESPERA_BLOQUEO_MS}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+            with self._lock:
+                self._conexiones.append(conn)
+        return conn
+
+    @contextmanager
+    def escritura(self):
+        """
+        Transacción de escritura (BEGIN IMMEDIATE): toma el lock de escritura
+        al comenzar, en vez de fallar a mitad de camino al pasar de lector a
+        escritor. Si la base sigue bloqueada tras busy_timeout, reintenta.
+        """
+        conn = self.conexion()
+        for intento in range(REINTENTOS_BLOQUEO + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or intento == REINTENTOS_BLOQUEO:
+                    raise
+                logging.warning(f"Base de historial bloqueada, reintento {intento + 1}")
+                time.sleep(0.05 * (intento + 1))
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _ejecutar(self, sql, parametros):
+        if self.escrituras is not None:
+            self.escrituras.encolar(sql, parametros)
+        else:
+            with self.escritura() as conn:
+                conn.execute(sql, parametros)
+
+    def guardar_usuario(self, usuario_id, nombre=None):
+        """Registra al usuario o actualiza su última actividad (y su nombre, si viene)"""
+        ahora = datetime.now().isoformat()
+        self._ejecutar(SQL_GUARDAR_USUARIO, (usuario_id, nombre, ahora, ahora))
+
+    def obtener_usuario(self, usuario_id):
+        return self.conexion().execute(
+            "SELECT nombre, fecha_creacion, ultima_actividad FROM usuarios WHERE id = ?", (usuario_id,)
+        ).fetchone()
+
+    def guardar_historial(self, usuario_id, consulta, respuesta):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._ejecutar(SQL_GUARDAR_HISTORIAL, (usuario_id, consulta, respuesta, timestamp))
+
+    def obtener_historial(self, usuario_id, limite=10):
+        sql = "SELECT consulta, respuesta, timestamp FROM historial WHERE usuario_id = ? ORDER BY timestamp DESC LIMIT ?"
+        if self.escrituras is None:
+            return self.conexion().execute(sql, (usuario_id, limite)).fetchall()
+
+        # Quien pide su historial espera ver también lo que aún está en cola:
+        # se agregan sus filas pendientes en vez de esperar a vaciar la cola
+        # completa, que incluye las escrituras de todos los demás usuarios
+        with self.escrituras.instantanea() as pendientes:
+            filas = self.conexion().execute(sql, (usuario_id, limite)).fetchall()
+        en_cola = [
+            tuple(parametros[1:]) for sentencia, parametros in pendientes
+            if sentencia is SQL_GUARDAR_HISTORIAL and parametros[0] == usuario_id
+        ]
+        if not en_cola:
+            return filas
+        # Las encoladas son más recientes: van primero entre timestamps iguales
+        filas = list(reversed(en_cola)) + filas
+        filas.sort(key=lambda fila: fila[2], reverse=True)
+        return filas[:limite]
+
+    def registrar_error(self, operacion, error):
+        """Deja en el log (no solo en consola) una escritura o lectura fallida"""
+        self.errores += 1
+        logging.error(f"Error en la base de historial ({operacion}): {error}")
+
+    def cerrar(self):
+        """Escribe lo pendiente y cierra las conexiones de todos los hilos"""
+        if self.escrituras is not None:
+            self.escrituras.cerrar()
+        with self._lock:
+            for conn in self._conexiones:
+                conn.close()
+            self._conexiones = []
+        self._local = threading.local()
@@ -0,0 +1,438 @@
+"""
+Benchmark de punta a punta del chat, sin red: mide el rendimiento (consultas
+por segundo) y la latencia p50/p95/p99 de procesar_consulta,
+aprocesar_consulta y la ruta /chat de Flask bajo concurrencia.
+
+OpenAI y Qdrant se reemplazan en el registro de recursos por dobles
+deterministas con latencia configurable:
+- ChatSimulado: modelo de chat de LangChain que responde según el prompt
+  (respuesta RAG, JSON del modo inline o revisión de seguridad) y emite la
+  respuesta palabra a palabra con stream()
+- EmbeddingsSimulados: vectores derivados del hash del texto
+- AlmacenSimulado: InMemoryVectorStore con un corpus fijo de medicamentos
+El resto del camino es el real: router de intenciones, SQLite de farmacias,
+caché de embeddings, historial con escritura diferida y trazas por etapa.
+Los archivos que escribe (historial, cachés, chat_history) y una copia
+migrada de farmacias_turno.db van a un directorio temporal.
+
+Cada trabajador recorre la mezcla de consultas en orden con su propio
+usuario (así "ver más" continúa su búsqueda anterior). /chat se llama con
+el cliente de pruebas de Flask, sin pasar por un socket.
+
+Uso:
+    python benchmark_chat.py
+    python benchmark_chat.py --concurrencia 16 --rondas 5 --latencia-llm 0.2
+    python benchmark_chat.py --salida base.json
+    python benchmark_chat.py --comparar base.json --tolerancia 0.2
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.vectorstores import InMemoryVectorStore
+
+# Antes de importar el front: su basicConfig escribiría chat_history.log
+logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+
+import consultas_llm
+from ActualizaFarmacias import ActualizadorFarmacias
+from bd_historial import BaseHistorial
+from benchmark_seguridad import percentil
+from cache_embeddings import EmbeddingsConCache
+from cache_semantico import CacheSemantico
+from clasificador_seguridad import EDUCATIVA, PRESCRIPCION
+from recursos_llm import recursos
+from trazas import latencias
+
+OBJETIVOS = ("procesar_consulta", "aprocesar_consulta", "chat")
+
+# Mezcla grabada de consultas (tipo, consulta), en el orden en que la recorre
+# cada trabajador
+MEZCLA_POR_DEFECTO = [
+    ("farmacia", "farmacias en santiago"),
+    ("farmacia", "ver más"),
+    ("farmacia", "farmacia de turno en providencia"),
+    ("farmacia", "farmacias abiertas ahora en las condes"),
+    ("farmacia", "dónde hay una farmacia en puente alto"),
+    ("farmacia", "farmacias en valparaizo"),
+    ("medicamento", "¿Para qué sirve el paracetamol?"),
+    ("medicamento", "¿Cuáles son los efectos secundarios del ibuprofeno?"),
+    ("medicamento", "dosis de amoxicilina para adultos"),
+    ("medicamento", "Recétame un antibiótico para la garganta"),
+    ("medicamento", "contraindicaciones del omeprazol"),
+    ("otra", "hola, ¿cómo estás?"),
+    ("otra", "¿cuál es la capital de Francia?"),
+]
+
+# Corpus del almacén vectorial simulado
+DOCUMENTOS = [
+    "El paracetamol es un analgésico y antipirético indicado para el dolor leve a moderado y la fiebre.",
+    "El ibuprofeno es un antiinflamatorio no esteroideo; puede causar molestias gástricas y acidez.",
+    "La amoxicilina es un antibiótico betalactámico que requiere receta médica.",
+    "El omeprazol reduce la producción de ácido gástrico y se usa en la gastritis y el reflujo.",
+    "La loratadina es un antihistamínico usado en rinitis alérgica y urticaria.",
+    "El salbutamol es un broncodilatador de acción corta indicado en crisis de asma.",
+    "La metformina es un antidiabético oral de primera línea en la diabetes tipo 2.",
+    "El losartán es un antagonista de la angiotensina II usado en la hipertensión arterial.",
+    "La cetirizina puede causar somnolencia en algunas personas.",
+    "El diclofenaco es un antiinflamatorio; no se recomienda en personas con úlcera gástrica.",
+    "La clorfenamina es un antihistamínico de primera generación con efecto sedante.",
+    "El ácido acetilsalicílico inhibe la agregación plaquetaria y puede aumentar el riesgo de sangrado.",
+]
+
+RESPUESTA_RAG = (
+    "Según la información disponible, este medicamento se usa principalmente para aliviar los "
+    "síntomas descritos. Sus efectos adversos más comunes son leves y transitorios, como molestias "
+    "gástricas o somnolencia. Es importante respetar la dosis indicada en el envase y no combinarlo "
+    "con otros medicamentos sin consultar."
+)
+
+
+class ChatSimulado(BaseChatModel):
+    """Modelo de chat determinista que tarda `latencia` segundos por llamada"""
+
+    latencia: float = 0.05
+    latencia_token: float = 0.0
+    llamadas: int = 0
+
+    @property
+    def _llm_type(self):
+        return "chat_simulado"
+
+    def _responder(self, messages):
+        texto = str(messages[-1].content)
+        self.llamadas += 1
+        if "Tu tarea:" in texto:
+            # Revisión de seguridad (armar_prompt_revision)
+            consulta = texto.split("Consulta:", 1)[-1].split("\n", 1)[0].lower()
+            return PRESCRIPCION if "receta" in consulta or "recétame" in consulta else EDUCATIVA
+        if "objeto JSON" in texto:
+            # Modo inline: responde y clasifica en la misma llamada
+            return json.dumps({"respuesta": RESPUESTA_RAG, "clasificacion": EDUCATIVA}, ensure_ascii=False)
+        return RESPUESTA_RAG
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latencia)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._responder(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latencia)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._responder(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # La latencia fija es la espera hasta el primer token
+        time.sleep(self.latencia)
+        for palabra in self._responder(messages).split(" "):
+            if self.latencia_token:
+                time.sleep(self.latencia_token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=palabra + " "))
+
+
+class EmbeddingsSimulados(Embeddings):
+    """Vectores unitarios derivados del hash del texto, `latencia` segundos por llamada"""
+
+    def __init__(self, dimension=256, latencia=0.01):
+        self.dimension = dimension
+        self.latencia = latencia
+        self.llamadas = 0
+        self.model = f"simulado-{dimension}"
+
+    def _vector(self, texto):
+        semilla = int.from_bytes(hashlib.sha1(texto.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(semilla).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        time.sleep(self.latencia)
+        self.llamadas += 1
+        return [self._vector(texto) for texto in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latencia)
+        self.llamadas += 1
+        return [self._vector(texto) for texto in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class AlmacenSimulado(InMemoryVectorStore):
+    """Almacén vectorial en memoria con `latencia` segundos extra por búsqueda, como la ida a Qdrant"""
+
+    def __init__(self, embedding, latencia=0.005):
+        super().__init__(embedding)
+        self.latencia = latencia
+
+    def similarity_search(self, query, k=4, **kwargs):
+        time.sleep(self.latencia)
+        return super().similarity_search(query, k=k, **kwargs)
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        await asyncio.sleep(self.latencia)
+        return await super().asimilarity_search(query, k=k, **kwargs)
+
+
+def preparar_farmacias(directorio):
+    """
+    Copia farmacias_turno.db al directorio temporal, la lleva al esquema
+    actual y apunta a ella las consultas y el detector de comunas. La base
+    del repositorio puede venir sin migrar y no se modifica.
+    """
+    copia = os.path.join(directorio, 'farmacias_turno.db')
+    shutil.copyfile(consultas_llm.DB_FARMACIAS_PATH, copia)
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        actualizador = ActualizadorFarmacias(db_path=copia)
+        actualizador.cerrar_conexion()
+    consultas_llm.DB_FARMACIAS_PATH = copia
+    recursos.invalidar('detector_comunas')
+
+
+def verificar_farmacias(mezcla):
+    """
+    Falla si alguna consulta de farmacias de la mezcla no llega a filas de
+    SQLite: sin eso se estaría midiendo solo la respuesta de error.
+    """
+    for tipo, consulta in mezcla:
+        if tipo != "farmacia" or consulta == "ver más":
+            continue
+        comuna = consultas_llm.detectar_comuna(consulta)
+        if comuna is None:
+            raise RuntimeError(f"No se detectó la comuna en {consulta!r}")
+        farmacias, total = consultas_llm.consultar_farmacias(comuna)
+        if not farmacias:
+            raise RuntimeError(f"Sin farmacias para {consulta!r} (comuna {comuna})")
+
+
+def usar_simulados(args, directorio):
+    """
+    Registra los dobles en lugar de OpenAI y Qdrant, y mueve el historial,
+    los cachés y la base de farmacias al directorio temporal. Retorna los
+    dobles del LLM y de los embeddings, que cuentan sus llamadas.
+    """
+    embeddings_simulados = EmbeddingsSimulados(args.dimension, args.latencia_embeddings)
+    embeddings = EmbeddingsConCache(embeddings_simulados, ruta=os.path.join(directorio, 'cache_embeddings.db'))
+    almacen = AlmacenSimulado(embeddings, args.latencia_busqueda)
+    almacen.add_texts(DOCUMENTOS)
+    llm = ChatSimulado(latencia=args.latencia_llm, latencia_token=args.latencia_token)
+
+    recursos.registrar('llm', lambda config: llm)
+    recursos.registrar('embeddings', lambda config: embeddings, cerrar=lambda e: e.cerrar())
+    recursos.registrar('qdrant', lambda config: almacen)
+    recursos.registrar(
+        'cache_semantico',
+        lambda config: CacheSemantico(ruta=os.path.join(directorio, 'cache_semantico.db'), coleccion='benchmark'),
+        cerrar=lambda cache: cache.cerrar()
+    )
+
+    consultas_llm.historial_bd.cerrar()
+    consultas_llm.historial_bd = BaseHistorial(os.path.join(directorio, 'historial.db'), diferir=True)
+    preparar_farmacias(directorio)
+    return llm, embeddings_simulados
+
+
+def cargar_front(directorio):
+    """Importa la aplicación Flask con chat_history en el directorio temporal"""
+    front_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'front')
+    sys.path.append(front_dir)
+    import WebPharmaGo
+    WebPharmaGo.DB_FARMACIAS = os.path.join(directorio, 'chat_history.db')
+    return WebPharmaGo
+
+
+def crear_llamada(objetivo, web=None):
+    """Función (usuario, consulta) -> respuesta para un objetivo síncrono"""
+    if objetivo == "procesar_consulta":
+        return consultas_llm.procesar_consulta
+
+    locales = threading.local()
+
+    def llamar_chat(usuario, consulta):
+        # Un cliente de pruebas por hilo
+        cliente = getattr(locales, 'cliente', None)
+        if cliente is None:
+            cliente = locales.cliente = web.app.test_client()
+        respuesta = cliente.post('/chat', json={'message': consulta, 'user_id': usuario})
+        if respuesta.status_code != 200:
+            raise RuntimeError(f"/chat respondió {respuesta.status_code}")
+        return respuesta.get_json()['response']
+    return llamar_chat
+
+
+def ejecutar_hilos(llamada, mezcla, concurrencia, rondas):
+    """Cada hilo recorre la mezcla `rondas` veces; retorna ([(tipo, ms)], segundos)"""
+    def trabajador(numero):
+        usuario = f"benchmark-{numero}"
+        medidas = []
+        for _ in range(rondas):
+            for tipo, consulta in mezcla:
+                inicio = time.perf_counter()
+                llamada(usuario, consulta)
+                medidas.append((tipo, (time.perf_counter() - inicio) * 1000))
+        return medidas
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+        resultados = list(pool.map(trabajador, range(concurrencia)))
+    return [medida for medidas in resultados for medida in medidas], time.perf_counter() - inicio
+
+
+def ejecutar_async(mezcla, concurrencia, rondas):
+    """Como ejecutar_hilos, con `concurrencia` corrutinas de aprocesar_consulta en un event loop"""
+    async def trabajador(numero):
+        usuario = f"benchmark-{numero}"
+        medidas = []
+        for _ in range(rondas):
+            for tipo, consulta in mezcla:
+                inicio = time.perf_counter()
+                await consultas_llm.aprocesar_consulta(usuario, consulta)
+                medidas.append((tipo, (time.perf_counter() - inicio) * 1000))
+        return medidas
+
+    async def principal():
+        return await asyncio.gather(*(trabajador(numero) for numero in range(concurrencia)))
+
+    inicio = time.perf_counter()
+    resultados = asyncio.run(principal())
+    return [medida for medidas in resultados for medida in medidas], time.perf_counter() - inicio
+
+
+def resumir(medidas_ms, segundos):
+    return {
+        'n': len(medidas_ms),
+        'consultas_por_segundo': round(len(medidas_ms) / segundos, 1) if segundos else 0.0,
+        'media_ms': round(statistics.mean(medidas_ms), 2),
+        'p50_ms': round(percentil(medidas_ms, 50), 2),
+        'p95_ms': round(percentil(medidas_ms, 95), 2),
+        'p99_ms': round(percentil(medidas_ms, 99), 2),
+        'max_ms': round(max(medidas_ms), 2),
+    }
+
+
+def medir(objetivo, mezcla, args, web=None):
+    """Resumen por tipo de consulta ('todas' incluida) y latencia por etapa de un objetivo"""
+    if objetivo == "aprocesar_consulta":
+        ejecutar = lambda concurrencia, rondas: ejecutar_async(mezcla, concurrencia, rondas)
+    else:
+        llamada = crear_llamada(objetivo, web)
+        ejecutar = lambda concurrencia, rondas: ejecutar_hilos(llamada, mezcla, concurrencia, rondas)
+
+    # Una pasada sin medir: construye los recursos, el router y los índices
+    ejecutar(1, 1)
+    consultas_llm.ultimas_busquedas.clear()
+    latencias.reiniciar()
+
+    medidas, segundos = ejecutar(args.concurrencia, args.rondas)
+    resumen = {'todas': resumir([ms for _, ms in medidas], segundos)}
+    for tipo in dict.fromkeys(tipo for tipo, _ in mezcla):
+        resumen[tipo] = resumir([ms for t, ms in medidas if t == tipo], segundos)
+    etapas = {
+        etapa: {clave: datos[clave] for clave in ('cuenta', 'p50_ms', 'p99_ms')}
+        for etapa, datos in latencias.estadisticas()['etapas'].items()
+    }
+    return {'resumen': resumen, 'etapas': etapas, 'segundos': round(segundos, 3)}
+
+
+def imprimir(objetivo, resultado):
+    print(f"\n== {objetivo} ({resultado['segundos']} s)")
+    print(f"{'tipo':<12} {'n':>6} {'cons/s':>8} {'media ms':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for tipo, datos in resultado['resumen'].items():
+        print(
+            f"{tipo:<12} {datos['n']:>6} {datos['consultas_por_segundo']:>8.1f} {datos['media_ms']:>10.2f} "
+            f"{datos['p50_ms']:>9.2f} {datos['p95_ms']:>9.2f} {datos['p99_ms']:>9.2f} {datos['max_ms']:>9.2f}"
+        )
+    print(f"{'etapa':<16} {'n':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    for etapa, datos in resultado['etapas'].items():
+        print(f"{etapa:<16} {datos['cuenta']:>6} {datos['p50_ms']:>9.2f} {datos['p99_ms']:>9.2f}")
+
+
+def comparar(resultados, base, tolerancia, margen_ms):
+    """
+    Lista de regresiones: p95 por objetivo y tipo más de `tolerancia` (y de
+    `margen_ms`, para no alertar por el ruido de las consultas de pocos ms)
+    sobre la base
+    """
+    regresiones = []
+    for objetivo, resultado in resultados.items():
+        for tipo, datos in resultado['resumen'].items():
+            anterior = base.get(objetivo, {}).get('resumen', {}).get(tipo)
+            if anterior and datos['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia) + margen_ms:
+                regresiones.append(
+                    f"{objetivo}/{tipo}: p95 {anterior['p95_ms']:.2f} ms -> {datos['p95_ms']:.2f} ms"
+                )
+    return regresiones
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sin red del chat (procesar_consulta y /chat)")
+    parser.add_argument("--objetivos", nargs="+", default=list(OBJETIVOS), choices=OBJETIVOS)
+    parser.add_argument("--concurrencia", type=int, default=8)
+    parser.add_argument("--rondas", type=int, default=3, help="Veces que cada trabajador recorre la mezcla")
+    parser.add_argument("--consultas", help="Archivo JSONL con la mezcla: {\"tipo\": ..., \"consulta\": ...} por línea")
+    parser.add_argument("--modo", choices=consultas_llm.MODOS_SEGURIDAD, default=consultas_llm.MODO_SEGURIDAD_POR_DEFECTO)
+    parser.add_argument("--latencia-llm", type=float, default=0.05, help="Segundos por llamada al LLM simulado")
+    parser.add_argument("--latencia-token", type=float, default=0.0, help="Segundos entre tokens en streaming")
+    parser.add_argument("--latencia-embeddings", type=float, default=0.01, help="Segundos por llamada de embeddings")
+    parser.add_argument("--latencia-busqueda", type=float, default=0.005, help="Segundos extra por búsqueda vectorial")
+    parser.add_argument("--dimension", type=int, default=256, help="Dimensión de los embeddings simulados")
+    parser.add_argument("--cache-semantico", action="store_true",
+                        help="Activar el caché semántico (las repeticiones de la mezcla serían aciertos)")
+    parser.add_argument("--salida", help="Guardar los resultados en este archivo JSON")
+    parser.add_argument("--comparar", help="Resultados JSON de referencia; termina con código 1 si hay regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Aumento relativo de p95 tolerado al comparar")
+    parser.add_argument("--margen-ms", type=float, default=5.0, help="Aumento absoluto de p95 tolerado además")
+    args = parser.parse_args()
+
+    mezcla = MEZCLA_POR_DEFECTO
+    if args.consultas:
+        with open(args.consultas, encoding="utf-8") as archivo:
+            mezcla = [(d['tipo'], d['consulta']) for d in map(json.loads, archivo) if d]
+
+    os.environ["MODO_SEGURIDAD"] = args.modo
+    os.environ["CACHE_SEMANTICO"] = "1" if args.cache_semantico else "0"
+
+    resultados = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark_chat_") as directorio:
+        llm, embeddings_simulados = usar_simulados(args, directorio)
+        verificar_farmacias(mezcla)
+        web = cargar_front(directorio) if "chat" in args.objetivos else None
+        for objetivo in args.objetivos:
+            # procesar_consulta informa cada paso con print; no se muestra
+            with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+                resultados[objetivo] = medir(objetivo, mezcla, args, web)
+            imprimir(objetivo, resultados[objetivo])
+        if web is not None:
+            web.escrituras_chat.cerrar()
+        consultas_llm.historial_bd.cerrar()
+        recursos.cerrar()
+
+    # Las llamadas a embeddings son pocas: el caché de embeddings resuelve las repetidas
+    print(f"\nLlamadas simuladas: LLM {llm.llamadas}, embeddings {embeddings_simulados.llamadas}")
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, ensure_ascii=False, indent=2)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as archivo:
+            regresiones = comparar(resultados, json.load(archivo), args.tolerancia, args.margen_ms)
+        for regresion in regresiones:
+            print(f"REGRESIÓN {regresion}")
+        sys.exit(1 if regresiones else 0)
@@ -0,0 +1,121 @@
+"""
+Compara la latencia por consulta de los modos de revisión de seguridad
+(doble, inline y local) de consultas_llm.responder_medicamento.
+
+Por defecto usa OpenAI y Qdrant reales (requiere OPENAI_API_KEY y Qdrant
+corriendo). Con --simulado reemplaza el LLM y la cadena RAG por dobles con
+una latencia fija por llamada, para comparar la cantidad de idas y vueltas
+sin costo.
+
+Uso:
+    python benchmark_seguridad.py --repeticiones 3
+    python benchmark_seguridad.py --simulado --latencia 0.8
+"""
+import argparse
+import json
+import statistics
+import time
+
+import consultas_llm
+from clasificador_seguridad import EDUCATIVA
+from recursos_llm import recursos
+
+CONSULTAS_POR_DEFECTO = [
+    "¿Para qué sirve el paracetamol?",
+    "¿Cuáles son los efectos secundarios del ibuprofeno?",
+    "¿Qué medicamento debo tomar para el dolor de cabeza?",
+    "Recétame un antibiótico para la garganta",
+    "¿El omeprazol es un tratamiento para la gastritis?",
+    "Medicamento para la tos seca",
+]
+
+
+class RespuestaSimulada:
+    def __init__(self, content):
+        self.content = content
+
+
+class LLMSimulado:
+    """Responde la revisión de seguridad tras `latencia` segundos"""
+
+    def __init__(self, latencia, contador):
+        self.latencia = latencia
+        self.contador = contador
+
+    def invoke(self, prompt):
+        time.sleep(self.latencia)
+        self.contador['llamadas'] += 1
+        return RespuestaSimulada(EDUCATIVA)
+
+
+class CadenaSimulada:
+    """Cadena RAG que tarda `latencia` segundos; en modo inline responde JSON"""
+
+    def __init__(self, latencia, contador, inline=False):
+        self.latencia = latencia
+        self.contador = contador
+        self.inline = inline
+
+    def invoke(self, query):
+        time.sleep(self.latencia)
+        self.contador['llamadas'] += 1
+        texto = f"Información general sobre: {query}"
+        if self.inline:
+            texto = json.dumps({"respuesta": texto, "clasificacion": EDUCATIVA}, ensure_ascii=False)
+        return {'query': query, 'result': texto}
+
+
+def usar_simulados(latencia, contador):
+    """Reemplaza en el registro de recursos los clientes reales por dobles"""
+    recursos.registrar('llm', lambda config: LLMSimulado(latencia, contador))
+    recursos.registrar('cadena_rag', lambda config: CadenaSimulada(latencia, contador))
+    recursos.registrar('cadena_rag_inline', lambda config: CadenaSimulada(latencia, contador, inline=True))
+
+
+def medir(modo, consultas, repeticiones, contador):
+    """Retorna (latencias en ms, llamadas al LLM por consulta) de un modo"""
+    latencias = []
+    llamadas_inicio = contador['llamadas']
+    for _ in range(repeticiones):
+        for consulta in consultas:
+            inicio = time.perf_counter()
+            consultas_llm.responder_medicamento(consulta, modo=modo)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+    llamadas = (contador['llamadas'] - llamadas_inicio) / len(latencias) if contador['simulado'] else None
+    return latencias, llamadas
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latencia de los modos de seguridad de las respuestas")
+    parser.add_argument("--modos", nargs="+", default=list(consultas_llm.MODOS_SEGURIDAD),
+                        choices=consultas_llm.MODOS_SEGURIDAD)
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--consultas", help="Archivo con una consulta por línea")
+    parser.add_argument("--simulado", action="store_true", help="Usar dobles en vez de OpenAI/Qdrant")
+    parser.add_argument("--latencia", type=float, default=0.5, help="Segundos por llamada simulada")
+    args = parser.parse_args()
+
+    consultas = CONSULTAS_POR_DEFECTO
+    if args.consultas:
+        with open(args.consultas, encoding="utf-8") as archivo:
+            consultas = [linea.strip() for linea in archivo if linea.strip()]
+
+    contador = {'llamadas': 0, 'simulado': args.simulado}
+    if args.simulado:
+        usar_simulados(args.latencia, contador)
+    else:
+        consultas_llm.precalentar_recursos()
+
+    print(f"{'modo':<8} {'n':>4} {'media ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'llamadas':>9}")
+    for modo in args.modos:
+        latencias, llamadas = medir(modo, consultas, args.repeticiones, contador)
+        print(
+            f"{modo:<8} {len(latencias):>4} {statistics.mean(latencias):>10.1f} "
+            f"{percentil(latencias, 50):>10.1f} {percentil(latencias, 95):>10.1f} "
+            f"{format(llamadas, '.2f') if llamadas is not None else '-':>9}"
+        )
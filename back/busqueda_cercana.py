@@ -0,0 +1,171 @@
+import heapq
+import math
+
+from esquema import existe_tabla, origen_farmacias
+
+# Radio de búsqueda por defecto y máximo permitido, en kilómetros
+RADIO_POR_DEFECTO_KM = 5.0
+RADIO_MAXIMO_KM = 50.0
+
+# Radio inicial de la búsqueda por anillos y factor con que crece
+RADIO_INICIAL_KM = 0.5
+FACTOR_CRECIMIENTO_RADIO = 4
+
+# Cantidad de farmacias por defecto y máxima en una respuesta
+LIMITE_POR_DEFECTO = 10
+LIMITE_MAXIMO = 50
+
+RADIO_TIERRA_KM = 6371.0
+KM_POR_GRADO_LATITUD = 111.32
+
+
+def distancia_km(lat1, lng1, lat2, lng2):
+    """Distancia en kilómetros entre dos puntos (fórmula del haversine)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    delta_phi = phi2 - phi1
+    delta_lambda = math.radians(lng2 - lng1)
+    a = math.sin(delta_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(math.sqrt(a))
+
+
+def caja_envolvente(lat, lng, radio_km):
+    """
+    Retorna (lat_min, lat_max, lng_min, lng_max) de una caja que contiene el
+    círculo de `radio_km` alrededor del punto.
+    """
+    delta_lat = radio_km / KM_POR_GRADO_LATITUD
+    # Cerca de los polos el coseno tiende a 0; se acota para no dividir por 0
+    delta_lng = radio_km / (KM_POR_GRADO_LATITUD * max(math.cos(math.radians(lat)), 0.01))
+    return lat - delta_lat, lat + delta_lat, lng - delta_lng, lng + delta_lng
+
+
+def farmacias_cercanas(conn, lat, lng, radio_km=RADIO_POR_DEFECTO_KM,
+                       limite=LIMITE_POR_DEFECTO, solo_turno=False):
+    """
+    Busca las farmacias más cercanas a un punto usando el R*Tree farmacias_geo.
+
+    La búsqueda parte con RADIO_INICIAL_KM y agranda el radio hasta reunir
+    `limite` farmacias dentro del círculo o llegar a `radio_km`, así en
+    zonas densas el R*Tree entrega pocas filas. Sobre ellas se calcula la
+    distancia real con las coordenadas del índice y solo de las `limite` más
+    cercanas se leen los datos completos, ordenados de la más cercana a la
+    más lejana. En una base sin migrar (sin farmacias_geo ni columnas
+    turno_*) la caja se filtra directamente sobre farmacias.
+
+    Ambas pasadas leen el mismo snapshot de la base (una transacción de
+    lectura), así una sincronización que confirme entre ellas no deja ids
+    del índice sin fila en farmacias.
+
+    Args:
+        conn (sqlite3.Connection): Conexión a farmacias_turno.db
+        lat (float): Latitud del punto de búsqueda
+        lng (float): Longitud del punto de búsqueda
+        radio_km (float): Radio de búsqueda, acotado a RADIO_MAXIMO_KM
+        limite (int): Máximo de farmacias, acotado a LIMITE_MAXIMO
+        solo_turno (bool): Si es True, solo farmacias de turno
+
+    Returns:
+        list: Diccionarios con los datos de cada farmacia y `distancia_km`
+    """
+    radio_km = min(max(float(radio_km), 0.0), RADIO_MAXIMO_KM)
+    limite = min(max(int(limite), 1), LIMITE_MAXIMO)
+
+    # Si quien llama ya abrió una transacción, esa define el snapshot
+    propia = not conn.in_transaction
+    if propia:
+        conn.execute("BEGIN")
+    try:
+        cercanas = _mas_cercanas(conn, lat, lng, radio_km, limite, solo_turno)
+        filas = _datos_farmacias(conn, [id_farmacia for _, id_farmacia in cercanas])
+    finally:
+        if propia:
+            conn.commit()
+
+    return [
+        {
+            'local_nombre': fila[0],
+            'local_direccion': fila[1],
+            'comuna_nombre': fila[2],
+            'hora_apertura': fila[3],
+            'hora_cierre': fila[4],
+            'local_telefono': fila[5],
+            'url_direccion': fila[6],
+            'de_turno': fila[7],
+            'local_lat': fila[8],
+            'local_lng': fila[9],
+            'distancia_km': round(distancia, 3),
+        }
+        for distancia, fila in (
+            (distancia, filas.get(id_farmacia)) for distancia, id_farmacia in cercanas
+        )
+        # Por si el índice espacial quedó con un id que ya no está en farmacias
+        if fila is not None
+    ]
+
+
+def _mas_cercanas(conn, lat, lng, radio_km, limite, solo_turno):
+    """[(distancia_km, id)] de las `limite` farmacias más cercanas dentro de `radio_km`"""
+    # Primera pasada: solo id y coordenadas, leídas del propio R*Tree
+    if existe_tabla(conn, 'farmacias_geo'):
+        sql = """
+            SELECT g.id, g.min_lat, g.min_lng
+            FROM farmacias_geo g
+        """
+        if solo_turno:
+            sql += " JOIN farmacias f ON f.id = g.id AND f.de_turno = 1"
+        sql += """
+            WHERE g.max_lat >= ? AND g.min_lat <= ?
+              AND g.max_lng >= ? AND g.min_lng <= ?
+        """
+    else:
+        sql = f"""
+            SELECT id, lat, lng
+            FROM (
+                SELECT id, CAST(local_lat AS REAL) AS lat, CAST(local_lng AS REAL) AS lng
+                FROM farmacias
+                WHERE TRIM(local_lat) <> '' AND TRIM(local_lng) <> ''
+                {'AND de_turno = 1' if solo_turno else ''}
+            )
+            WHERE lat >= ? AND lat <= ? AND lng >= ? AND lng <= ?
+        """
+
+    radio_actual = min(RADIO_INICIAL_KM, radio_km)
+    while True:
+        candidatas = []
+        for id_farmacia, lat_farmacia, lng_farmacia in conn.execute(sql, caja_envolvente(lat, lng, radio_actual)):
+            distancia = distancia_km(lat, lng, lat_farmacia, lng_farmacia)
+            if distancia <= radio_actual:
+                candidatas.append((distancia, id_farmacia))
+        # Todo lo que está dentro del círculo actual ya se vio, así que si
+        # alcanzan `limite` son las más cercanas de todo el radio
+        if len(candidatas) >= limite or radio_actual >= radio_km:
+            break
+        radio_actual = min(radio_actual * FACTOR_CRECIMIENTO_RADIO, radio_km)
+    return heapq.nsmallest(limite, candidatas)
+
+
+def _datos_farmacias(conn, ids):
+    """Segunda pasada: datos completos solo de las farmacias elegidas, por id"""
+    if not ids:
+        return {}
+    return {
+        fila[0]: fila[1:]
+        for fila in conn.execute(f"""
+            SELECT
+                id,
+                local_nombre,
+                local_direccion,
+                comuna_nombre,
+                CASE WHEN de_turno = 1 THEN COALESCE(turno_hora_apertura, funcionamiento_hora_apertura)
+                     ELSE funcionamiento_hora_apertura END,
+                CASE WHEN de_turno = 1 THEN COALESCE(turno_hora_cierre, funcionamiento_hora_cierre)
+                     ELSE funcionamiento_hora_cierre END,
+                local_telefono,
+                URL_direccion,
+                de_turno,
+                CAST(local_lat AS REAL),
+                CAST(local_lng AS REAL)
+            FROM {origen_farmacias(conn)}
+            WHERE id IN ({', '.join('?' * len(ids))})
+        """, ids)
+    }
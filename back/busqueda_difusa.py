@@ -0,0 +1,242 @@
+"""
+Búsqueda tolerante a errores de tipeo sobre nombres de comunas y farmacias.
+
+ActualizadorFarmacias guarda en farmacias_turno.db los términos
+(terminos_busqueda) y sus trigramas (trigramas); IndiceDifuso los carga en
+memoria. Una búsqueda toma los trigramas del texto, cuenta cuántos comparte
+cada término (lema de q-gramas: cada edición destruye a lo más 3) y solo
+sobre esos pocos candidatos calcula la distancia de edición acotada.
+"""
+import sqlite3
+import threading
+
+from normalizacion import tokenizar
+
+# Tipos de término indexados
+TIPO_COMUNA = "comuna"
+TIPO_FARMACIA = "farmacia"
+
+# Candidatos que se verifican con distancia de edición por búsqueda
+MAXIMO_CANDIDATOS = 20
+
+def trigramas_token(token):
+    """Trigramas de una palabra rellenada con un espacio a cada lado"""
+    palabra = f" {token} "
+    return {palabra[posicion:posicion + 3] for posicion in range(len(palabra) - 2)}
+
+
+def trigramas(texto):
+    """Trigramas de todas las palabras del texto"""
+    resultado = set()
+    for token in tokenizar(texto):
+        resultado |= trigramas_token(token)
+    return resultado
+
+
+def distancia_maxima(texto):
+    """Errores tolerados según el largo: 0 hasta 4 letras, 1 hasta 8 y 2 desde 9"""
+    largo = sum(len(token) for token in tokenizar(texto))
+    if largo <= 4:
+        return 0
+    if largo <= 8:
+        return 1
+    return 2
+
+
+def levenshtein_acotada(a, b, maximo):
+    """
+    Distancia de edición entre a y b, o maximo + 1 si la supera. Solo
+    recorre la banda diagonal de ancho 2 * maximo + 1.
+    """
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    anterior = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        actual = [i] + [maximo + 1] * len(b)
+        desde = max(1, i - maximo)
+        hasta = min(len(b), i + maximo)
+        minimo_fila = actual[0] if desde == 1 else maximo + 1
+        for j in range(desde, hasta + 1):
+            costo = 0 if a[i - 1] == b[j - 1] else 1
+            actual[j] = min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + costo)
+            minimo_fila = min(minimo_fila, actual[j])
+        if minimo_fila > maximo:
+            return maximo + 1
+        anterior = actual
+    return min(anterior[len(b)], maximo + 1)
+
+
+def terminos_indexados(nombres):
+    """
+    Filas (tipo, texto, nombre, num_trigramas, distancia_maxima) y sus
+    trigramas para indexar; `nombres` es un iterable de (tipo, nombre). Los
+    nombres que normalizados quedan iguales se indexan una sola vez.
+    """
+    vistos = set()
+    for tipo, nombre in nombres:
+        texto = " ".join(tokenizar(nombre))
+        if not texto or (tipo, texto) in vistos:
+            continue
+        vistos.add((tipo, texto))
+        gramas = trigramas(texto)
+        yield (tipo, texto, nombre, len(gramas), distancia_maxima(texto)), gramas
+
+
+class IndiceDifuso:
+    """Índice de trigramas en memoria, cargado desde las tablas de la ingesta"""
+
+    def __init__(self, terminos=(), trigramas_por_termino=()):
+        """
+        Args:
+            terminos: Filas (id, tipo, texto, nombre, num_trigramas, distancia_maxima)
+            trigramas_por_termino: Pares (trigrama, id del término)
+        """
+        self.terminos = {fila[0]: fila[1:] for fila in terminos}
+        # (tipo, trigrama) -> ids de los términos que lo contienen
+        self.publicaciones = {}
+        # id del término -> sus trigramas
+        self.gramas = {}
+        for grama, id_termino in trigramas_por_termino:
+            termino = self.terminos.get(id_termino)
+            if termino:
+                self.publicaciones.setdefault((termino[0], grama), []).append(id_termino)
+                self.gramas.setdefault(id_termino, set()).add(grama)
+
+    @classmethod
+    def desde_bd(cls, conn):
+        terminos = conn.execute("""
+            SELECT id, tipo, texto, nombre, num_trigramas, distancia_maxima FROM terminos_busqueda
+        """).fetchall()
+        return cls(terminos, conn.execute("SELECT trigrama, termino_id FROM trigramas"))
+
+    @classmethod
+    def desde_nombres(cls, nombres):
+        """Índice armado en memoria a partir de pares (tipo, nombre)"""
+        terminos, trigramas_por_termino = [], []
+        for id_termino, (fila, gramas) in enumerate(terminos_indexados(nombres), start=1):
+            terminos.append((id_termino,) + fila)
+            trigramas_por_termino.extend((grama, id_termino) for grama in gramas)
+        return cls(terminos, trigramas_por_termino)
+
+    def _candidatos(self, gramas, tipo, distancia=None):
+        """
+        Términos del tipo que comparten al menos num_trigramas - 3 * distancia
+        trigramas con el texto, de los que más comparten a los que menos.
+        Sin `distancia` se usa la tolerancia de cada término.
+        """
+        compartidos = {}
+        for grama in gramas:
+            for id_termino in self.publicaciones.get((tipo, grama), ()):
+                compartidos[id_termino] = compartidos.get(id_termino, 0) + 1
+
+        candidatos = []
+        for id_termino, cantidad in compartidos.items():
+            _, texto, nombre, num_trigramas, maximo = self.terminos[id_termino]
+            if distancia is not None:
+                maximo = distancia
+            if cantidad >= max(num_trigramas - 3 * maximo, 1):
+                candidatos.append((cantidad, id_termino, texto, nombre, maximo))
+        candidatos.sort(key=lambda candidato: -candidato[0])
+        return candidatos[:MAXIMO_CANDIDATOS]
+
+    def buscar_similares(self, texto, tipo, limite=5):
+        """
+        Nombres del tipo cuyo texto completo está a distancia de edición
+        acotada de `texto` (por ejemplo "puerto mont" -> PUERTO MONTT).
+
+        Returns:
+            list: Tuplas (nombre, distancia), de la más parecida a la menos
+        """
+        consulta = " ".join(tokenizar(texto))
+        maximo = distancia_maxima(consulta)
+        resultados = []
+        for compartidos, _, texto_termino, nombre, _ in self._candidatos(trigramas(consulta), tipo, maximo):
+            distancia = levenshtein_acotada(consulta, texto_termino, maximo)
+            if distancia <= maximo:
+                resultados.append((distancia, -compartidos, nombre))
+        resultados.sort()
+        return [(nombre, distancia) for distancia, _, nombre in resultados[:limite]]
+
+    def buscar_en_texto(self, texto, tipo):
+        """
+        Busca un término del tipo escrito (quizás con errores) en alguna parte
+        de `texto`, comparando contra ventanas de palabras consecutivas de
+        largo similar. Útil para frases como "farmacias en penalolen". Entre
+        varios aciertos gana el que cubre más letras del texto. Cada ventana
+        pasa por el mismo filtro de trigramas antes de calcular la distancia.
+
+        Solo se toleran errores en términos de 9 o más letras: en texto libre
+        una palabra corta con un error suele ser otra palabra ("tengo" no es
+        RENGO).
+
+        Returns:
+            tuple: (nombre, distancia) del mejor término, o None
+        """
+        tokens = tokenizar(texto)
+        gramas_tokens = [trigramas_token(token) for token in tokens]
+        # Largo en caracteres de la ventana tokens[i:j] = inicios[j] - inicios[i] - 1
+        inicios = [0]
+        for token in tokens:
+            inicios.append(inicios[-1] + len(token) + 1)
+
+        gramas_ventana = {}
+        mejor = None
+        todos = set().union(*gramas_tokens)
+        for _, id_termino, texto_termino, nombre, maximo in self._candidatos(todos, tipo):
+            if maximo < 2:
+                maximo = 0
+            largo_termino = len(texto_termino)
+            gramas_termino = self.gramas[id_termino]
+            minimo_compartidos = len(gramas_termino) - 3 * maximo
+            for inicio in range(len(tokens)):
+                for fin in range(inicio + 1, len(tokens) + 1):
+                    largo_ventana = inicios[fin] - inicios[inicio] - 1
+                    if largo_ventana > largo_termino + maximo:
+                        break
+                    if largo_ventana < largo_termino - maximo:
+                        continue
+                    if (inicio, fin) not in gramas_ventana:
+                        gramas_ventana[inicio, fin] = set().union(*gramas_tokens[inicio:fin])
+                    if len(gramas_ventana[inicio, fin] & gramas_termino) < minimo_compartidos:
+                        continue
+                    ventana = " ".join(tokens[inicio:fin])
+                    distancia = levenshtein_acotada(ventana, texto_termino, maximo)
+                    if distancia <= maximo:
+                        clave = (distancia - largo_termino, distancia)
+                        if mejor is None or clave < mejor[0]:
+                            mejor = (clave, nombre, distancia)
+        return (mejor[1], mejor[2]) if mejor else None
+
+
+class IndiceDifusoBD:
+    """
+    IndiceDifuso de farmacias_turno.db que se recarga solo cuando la base
+    cambió (PRAGMA data_version) desde la última búsqueda.
+    """
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._version = None
+        self.indice = IndiceDifuso()
+
+    def actual(self) -> IndiceDifuso:
+        with self._lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._version:
+                try:
+                    self.indice = IndiceDifuso.desde_bd(self.conn)
+                except sqlite3.OperationalError:
+                    # Base aún sin índice (ActualizaFarmacias no ha corrido)
+                    self.indice = IndiceDifuso()
+                self._version = version
+            return self.indice
+
+    def buscar_similares(self, texto, tipo, limite=5):
+        return self.actual().buscar_similares(texto, tipo, limite)
+
+    def buscar_en_texto(self, texto, tipo):
+        return self.actual().buscar_en_texto(texto, tipo)
+
+    def cerrar(self):
+        self.conn.close()
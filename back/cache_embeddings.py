@@ -0,0 +1,176 @@
+"""
+Caché persistente de embeddings.
+
+EmbeddingsConCache envuelve cualquier objeto de embeddings de LangChain y
+memoriza sus vectores por (modelo, hash del texto normalizado): primero en
+un LRU en memoria y luego en SQLite, guardados como float32 binario. Lo usan
+la búsqueda en Qdrant, el caché semántico y la indexación de main.py, que
+así reutiliza los vectores de los fragmentos que no cambiaron.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+RUTA_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Base', 'cache_embeddings.db')
+
+# Vectores que se mantienen en memoria (1536 float32 = 6 KiB cada uno)
+CAPACIDAD_MEMORIA = 5000
+
+_ESPACIOS = re.compile(r"\s+")
+
+
+def clave_texto(texto):
+    """
+    Hash SHA-1 (20 bytes) del texto normalizado: forma Unicode NFC y
+    espacios colapsados. No cambia mayúsculas ni tildes, porque eso sí
+    cambia el embedding.
+    """
+    normalizado = _ESPACIOS.sub(" ", unicodedata.normalize("NFC", texto)).strip()
+    return hashlib.sha1(normalizado.encode("utf-8")).digest()
+
+
+def nombre_modelo(embeddings):
+    """Nombre del modelo de un objeto de embeddings, para separar sus vectores"""
+    for atributo in ("model", "model_name"):
+        valor = getattr(embeddings, atributo, None)
+        if isinstance(valor, str) and valor:
+            return valor
+    return type(embeddings).__name__
+
+
+class EmbeddingsConCache(Embeddings):
+    """Embeddings de LangChain con caché LRU en memoria y persistencia en SQLite"""
+
+    def __init__(self, embeddings, ruta=RUTA_POR_DEFECTO, capacidad=CAPACIDAD_MEMORIA):
+        self.embeddings = embeddings
+        self.modelo = nombre_modelo(embeddings)
+        self.capacidad = capacidad
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self.conn = sqlite3.connect(ruta, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                modelo TEXT NOT NULL,
+                clave BLOB NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (modelo, clave)
+            ) WITHOUT ROWID
+        """)
+
+        self.aciertos_memoria = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+
+    def embed_query(self, text):
+        return self._buscar_o_calcular([text], lambda textos: [self.embeddings.embed_query(textos[0])])[0]
+
+    def embed_documents(self, texts):
+        return self._buscar_o_calcular(list(texts), self.embeddings.embed_documents)
+
+    async def aembed_query(self, text):
+        async def calcular(textos):
+            return [await self.embeddings.aembed_query(textos[0])]
+        return (await self._abuscar_o_calcular([text], calcular))[0]
+
+    async def aembed_documents(self, texts):
+        return await self._abuscar_o_calcular(list(texts), self.embeddings.aembed_documents)
+
+    def _buscar_o_calcular(self, textos, calcular):
+        """
+        Retorna los vectores de `textos`, calculando con una sola llamada a
+        `calcular` solo los que no están en memoria ni en disco.
+        """
+        claves, vectores, faltantes = self._buscar(textos)
+        if faltantes:
+            self._guardar(claves, vectores, faltantes, calcular([textos[posicion] for posicion in faltantes]))
+        return [vector.tolist() for vector in vectores]
+
+    async def _abuscar_o_calcular(self, textos, calcular):
+        """
+        Como _buscar_o_calcular, con la llamada al modelo asíncrona. Las
+        lecturas y escrituras en SQLite van a un hilo para no bloquear el
+        event loop.
+        """
+        claves, vectores, faltantes = await asyncio.to_thread(self._buscar, textos)
+        if faltantes:
+            nuevos = await calcular([textos[posicion] for posicion in faltantes])
+            await asyncio.to_thread(self._guardar, claves, vectores, faltantes, nuevos)
+        return [vector.tolist() for vector in vectores]
+
+    def _buscar(self, textos):
+        """Retorna (claves, vectores encontrados o None, posiciones faltantes)"""
+        claves = [clave_texto(texto) for texto in textos]
+        vectores = [None] * len(textos)
+
+        with self._lock:
+            pendientes_disco = []
+            for posicion, clave in enumerate(claves):
+                vector = self._memoria.get(clave)
+                if vector is not None:
+                    self._memoria.move_to_end(clave)
+                    vectores[posicion] = vector
+                    self.aciertos_memoria += 1
+                else:
+                    pendientes_disco.append(posicion)
+
+            for posicion in pendientes_disco:
+                fila = self.conn.execute(
+                    "SELECT vector FROM embeddings WHERE modelo = ? AND clave = ?", (self.modelo, claves[posicion])
+                ).fetchone()
+                if fila:
+                    vectores[posicion] = np.frombuffer(fila[0], dtype=np.float32)
+                    self._recordar(claves[posicion], vectores[posicion])
+                    self.aciertos_disco += 1
+
+        # La llamada al modelo se hace fuera del lock para no bloquear a otros hilos
+        faltantes = [posicion for posicion, vector in enumerate(vectores) if vector is None]
+        return claves, vectores, faltantes
+
+    def _guardar(self, claves, vectores, faltantes, nuevos):
+        """Completa `vectores` con los recién calculados y los persiste"""
+        filas = []
+        with self._lock:
+            for posicion, nuevo in zip(faltantes, nuevos):
+                vector = np.asarray(nuevo, dtype=np.float32)
+                vectores[posicion] = vector
+                self._recordar(claves[posicion], vector)
+                filas.append((self.modelo, claves[posicion], vector.tobytes()))
+            self.fallos += len(faltantes)
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (modelo, clave, vector) VALUES (?, ?, ?)", filas
+                )
+
+    def _recordar(self, clave, vector):
+        self._memoria[clave] = vector
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.capacidad:
+            self._memoria.popitem(last=False)
+
+    def estadisticas(self):
+        consultas = self.aciertos_memoria + self.aciertos_disco + self.fallos
+        return {
+            'modelo': self.modelo,
+            'en_memoria': len(self._memoria),
+            'aciertos_memoria': self.aciertos_memoria,
+            'aciertos_disco': self.aciertos_disco,
+            'fallos': self.fallos,
+            'tasa_aciertos': (self.aciertos_memoria + self.aciertos_disco) / consultas if consultas else 0.0,
+        }
+
+    def cerrar(self):
+        self.conn.close()
@@ -0,0 +1,270 @@
+"""
+Caché semántico de respuestas sobre medicamentos.
+
+Guarda cada respuesta junto al embedding de su consulta; una consulta nueva
+cuyo embedding tiene similitud coseno >= umbral con una guardada reutiliza
+esa respuesta sin pasar por Qdrant ni el LLM. Solo se comparan consultas del
+mismo grupo: la clave que indica quien llama (por ejemplo el modo de
+seguridad) más los términos distintivos de la consulta, así "paracetamol" e
+"ibuprofeno" nunca comparten respuesta aunque sus embeddings se parezcan.
+Las entradas viven en SQLite
+(sobreviven reinicios), se descartan por LRU al superar la capacidad o al
+vencer su TTL, y se invalidan todas cuando main.py reindexa la colección
+(ver marcar_reindexado).
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from normalizacion import tokenizar
+
+RUTA_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Base', 'cache_semantico.db')
+
+# Similitud coseno mínima para considerar equivalentes dos consultas
+UMBRAL_SIMILITUD = 0.95
+CAPACIDAD = 2000
+TTL_SEGUNDOS = 7 * 24 * 3600
+
+# Palabras frecuentes en las preguntas que no distinguen una consulta de
+# otra; las de menos de 4 letras se descartan siempre (salvo los números)
+PALABRAS_GENERICAS = {
+    'para', 'sirve', 'sirven', 'como', 'cual', 'cuales', 'cuando', 'donde',
+    'puedo', 'puede', 'pueden', 'tomar', 'usar', 'sobre', 'tiene', 'tienen',
+    'esta', 'este', 'estos', 'estas', 'hace', 'hacer', 'saber', 'quiero',
+    'necesito', 'informacion', 'favor', 'hola', 'gracias', 'medicamento',
+    'medicamentos', 'remedio', 'remedios',
+}
+
+
+def terminos_distintivos(consulta):
+    """Términos normalizados que deben coincidir para reutilizar una respuesta"""
+    return " ".join(sorted({
+        token for token in tokenizar(consulta)
+        if token.isdigit() or (len(token) >= 4 and token not in PALABRAS_GENERICAS)
+    }))
+
+
+def conectar(ruta):
+    """Abre la base del caché y crea sus tablas si no existen"""
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+    conn = sqlite3.connect(ruta, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS respuestas_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            coleccion TEXT NOT NULL,
+            consulta TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            respuesta TEXT NOT NULL,
+            costo_ms REAL NOT NULL,
+            creado REAL NOT NULL,
+            ultimo_uso REAL NOT NULL,
+            grupo TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_respuestas_cache_coleccion ON respuestas_cache (coleccion);
+        CREATE TABLE IF NOT EXISTS versiones_indice (
+            coleccion TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            actualizado REAL NOT NULL
+        );
+    """)
+    columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(respuestas_cache)")}
+    if 'grupo' not in columnas:
+        # Las respuestas guardadas antes de separar por grupo no se sabe a
+        # qué grupo pertenecen: se descartan
+        with conn:
+            conn.execute("ALTER TABLE respuestas_cache ADD COLUMN grupo TEXT NOT NULL DEFAULT ''")
+            conn.execute("DELETE FROM respuestas_cache")
+    return conn
+
+
+def marcar_reindexado(coleccion, ruta=RUTA_POR_DEFECTO):
+    """
+    Registra que la colección se reindexó; los cachés abiertos (incluso en
+    otros procesos) descartan sus respuestas en la siguiente búsqueda.
+    """
+    conn = conectar(ruta)
+    try:
+        with conn:
+            conn.execute("""
+                INSERT INTO versiones_indice (coleccion, version, actualizado) VALUES (?, ?, ?)
+                ON CONFLICT (coleccion) DO UPDATE SET version = excluded.version, actualizado = excluded.actualizado
+            """, (coleccion, uuid.uuid4().hex, time.time()))
+            conn.execute("DELETE FROM respuestas_cache WHERE coleccion = ?", (coleccion,))
+    finally:
+        conn.close()
+
+
+def normalizar_vector(vector):
+    """Vector float32 de norma 1, para que el producto punto sea el coseno"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norma = np.linalg.norm(vector)
+    return vector / norma if norma else vector
+
+
+class CacheSemantico:
+    """Caché de respuestas indexado por el embedding de la consulta"""
+
+    def __init__(self, ruta=RUTA_POR_DEFECTO, coleccion="remedios_collection",
+                 umbral=UMBRAL_SIMILITUD, capacidad=CAPACIDAD, ttl_segundos=TTL_SEGUNDOS):
+        self.ruta = ruta
+        self.coleccion = coleccion
+        self.umbral = umbral
+        self.capacidad = capacidad
+        self.ttl_segundos = ttl_segundos
+        self.conn = conectar(ruta)
+        self._lock = threading.Lock()
+
+        # Estadísticas desde que se abrió el caché
+        self.aciertos = 0
+        self.fallos = 0
+        self.ms_ahorrados = 0.0
+
+        self._cargar()
+
+    def _leer_version(self):
+        fila = self.conn.execute(
+            "SELECT version FROM versiones_indice WHERE coleccion = ?", (self.coleccion,)
+        ).fetchone()
+        return fila[0] if fila else None
+
+    def _cargar(self):
+        """Carga en memoria las entradas vigentes, de la menos a la más usada"""
+        self.version = self._leer_version()
+        limite = time.time() - self.ttl_segundos
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM respuestas_cache WHERE coleccion = ? AND creado < ?", (self.coleccion, limite)
+            )
+        filas = self.conn.execute("""
+            SELECT id, vector, respuesta, costo_ms, creado, ultimo_uso, grupo
+            FROM respuestas_cache
+            WHERE coleccion = ?
+            ORDER BY ultimo_uso
+        """, (self.coleccion,)).fetchall()
+
+        self._ids = [fila[0] for fila in filas]
+        # id -> [respuesta, costo_ms, creado, ultimo_uso]
+        self._entradas = {fila[0]: [fila[2], fila[3], fila[4], fila[5]] for fila in filas}
+        # Grupo y fecha de creación de cada fila de la matriz, para filtrar
+        # antes de elegir la más similar
+        self._grupos = np.array([fila[6] for fila in filas], dtype=object)
+        self._creados = np.array([fila[4] for fila in filas], dtype=np.float64)
+        if filas:
+            self._matriz = np.vstack([np.frombuffer(fila[1], dtype=np.float32) for fila in filas])
+        else:
+            self._matriz = None
+
+    def _verificar_version(self):
+        """Descarta todo si la colección se reindexó desde la última carga"""
+        version = self._leer_version()
+        if version != self.version:
+            logging.info(f"Colección '{self.coleccion}' reindexada; se vacía el caché semántico")
+            with self.conn:
+                self.conn.execute("DELETE FROM respuestas_cache WHERE coleccion = ?", (self.coleccion,))
+            self._cargar()
+
+    def buscar(self, vector, grupo="") -> Optional[str]:
+        """
+        Retorna la respuesta vigente más similar del mismo grupo, o None si
+        ninguna supera el umbral
+        """
+        inicio = time.perf_counter()
+        with self._lock:
+            self._verificar_version()
+            ahora = time.time()
+            if self._matriz is None:
+                self.fallos += 1
+                return None
+            candidatas = np.flatnonzero(
+                (self._grupos == grupo) & (self._creados >= ahora - self.ttl_segundos)
+            )
+            if not len(candidatas):
+                self.fallos += 1
+                return None
+
+            similitudes = self._matriz[candidatas] @ normalizar_vector(vector)
+            mejor = int(np.argmax(similitudes))
+            if similitudes[mejor] < self.umbral:
+                self.fallos += 1
+                return None
+
+            id_entrada = self._ids[candidatas[mejor]]
+            entrada = self._entradas[id_entrada]
+
+            entrada[3] = ahora
+            with self.conn:
+                self.conn.execute("UPDATE respuestas_cache SET ultimo_uso = ? WHERE id = ?", (ahora, id_entrada))
+            self.aciertos += 1
+            self.ms_ahorrados += max(entrada[1] - (time.perf_counter() - inicio) * 1000, 0.0)
+            return entrada[0]
+
+    def guardar(self, consulta, vector, respuesta, costo_ms, grupo=""):
+        """
+        Guarda una respuesta nueva en el grupo indicado. `costo_ms` es lo que
+        tardó generarla y se usa para estimar la latencia ahorrada en cada
+        acierto.
+        """
+        vector = normalizar_vector(vector)
+        ahora = time.time()
+        with self._lock:
+            self._verificar_version()
+            with self.conn:
+                cursor = self.conn.execute("""
+                    INSERT INTO respuestas_cache (coleccion, consulta, vector, respuesta, costo_ms, creado, ultimo_uso, grupo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (self.coleccion, consulta, vector.tobytes(), respuesta, costo_ms, ahora, ahora, grupo))
+            self._ids.append(cursor.lastrowid)
+            self._entradas[cursor.lastrowid] = [respuesta, costo_ms, ahora, ahora]
+            self._grupos = np.append(self._grupos, np.array([grupo], dtype=object))
+            self._creados = np.append(self._creados, ahora)
+            fila = vector.reshape(1, -1)
+            self._matriz = fila if self._matriz is None else np.vstack([self._matriz, fila])
+
+            if len(self._ids) > self.capacidad:
+                self._desalojar(len(self._ids) - self.capacidad)
+
+    def _desalojar(self, cantidad):
+        """Elimina las `cantidad` entradas usadas hace más tiempo"""
+        por_uso = sorted(self._entradas, key=lambda id_entrada: self._entradas[id_entrada][3])
+        eliminar = set(por_uso[:cantidad])
+        with self.conn:
+            self.conn.executemany("DELETE FROM respuestas_cache WHERE id = ?", [(id_entrada,) for id_entrada in eliminar])
+        conservar = [posicion for posicion, id_entrada in enumerate(self._ids) if id_entrada not in eliminar]
+        self._ids = [self._ids[posicion] for posicion in conservar]
+        self._grupos = self._grupos[conservar]
+        self._creados = self._creados[conservar]
+        self._matriz = self._matriz[conservar] if conservar else None
+        for id_entrada in eliminar:
+            del self._entradas[id_entrada]
+
+    def invalidar(self):
+        """Vacía el caché de esta colección"""
+        with self._lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM respuestas_cache WHERE coleccion = ?", (self.coleccion,))
+            self._cargar()
+
+    def estadisticas(self):
+        """Aciertos, fallos, tasa de aciertos y latencia ahorrada estimada"""
+        consultas = self.aciertos + self.fallos
+        return {
+            'entradas': len(self._ids),
+            'consultas': consultas,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+            'ms_ahorrados': round(self.ms_ahorrados, 1),
+            'umbral': self.umbral,
+        }
+
+    def cerrar(self):
+        self.conn.close()
@@ -0,0 +1,112 @@
+"""
+Clasificación de respuestas sobre medicamentos: información educativa
+(permitida) o prescripción médica personalizada (bloqueada).
+
+Incluye el prompt para que el LLM responda y clasifique en una sola
+llamada, el parser de esa salida y un clasificador local por palabras clave
+que resuelve los casos evidentes sin llamar al LLM.
+"""
+import json
+import re
+
+from normalizacion import normalizar_texto
+
+PRESCRIPCION = "PRESCRIPCIÓN_MÉDICA"
+EDUCATIVA = "INFORMACIÓN_EDUCATIVA"
+
+# Prompt de la cadena RAG que responde y clasifica en la misma llamada.
+# Las llaves del JSON van dobles porque es un PromptTemplate.
+PROMPT_INLINE = """Usa el siguiente contexto para responder la pregunta del usuario sobre medicamentos.
+Si no sabes la respuesta, responde "No sé"; no inventes información.
+
+Contexto:
+{context}
+
+Pregunta: {question}
+
+Además clasifica tu respuesta:
+- "INFORMACIÓN_EDUCATIVA" si el usuario pide información general y la respuesta es educativa.
+- "PRESCRIPCIÓN_MÉDICA" si el usuario pide una receta personalizada o la respuesta le indica qué medicamento o dosis debe tomar.
+
+Responde ÚNICAMENTE con un objeto JSON de esta forma:
+{{"respuesta": "<tu respuesta>", "clasificacion": "INFORMACIÓN_EDUCATIVA" o "PRESCRIPCIÓN_MÉDICA"}}
+"""
+
+# Consultas que piden una indicación personal (se comparan sin tildes)
+_PATRONES_PRESCRIPCION_CONSULTA = [
+    r"\brecet(a|ame|arme|e)\b",
+    r"\bque (debo|deberia|puedo) tomar\b",
+    r"\bque me (tomo|recomiendas|recomienda|receta)\b",
+    r"\b(cuanto|cuanta|cuantas|cuantos) (debo|deberia|me) tom",
+    r"\bdosis (para mi|debo|deberia)\b",
+    r"\bme (recetas|recomiendas) (algo|un|una)\b",
+]
+
+# Respuestas que indican tomar algo concreto
+_PATRONES_PRESCRIPCION_RESPUESTA = [
+    r"\b(le|te) recomiendo (tomar|usar)\b",
+    r"\b(debe|debes|deberia|deberias) tomar\b",
+    r"\btome \d",
+    r"\btoma \d",
+    r"\btomar \d+ ?(mg|comprimidos?|pastillas?|capsulas?)\b.*\bcada\b",
+]
+
+# Consultas claramente informativas
+_PATRONES_EDUCATIVA_CONSULTA = [
+    r"\bpara que sirve\b",
+    r"\bque es (el|la|un|una)\b",
+    r"\befectos? (secundarios?|adversos?)\b",
+    r"\bcontraindicaciones\b",
+    r"\bcomo (actua|funciona)\b",
+    r"\binteracciones?\b",
+    r"\bcomposicion\b",
+]
+
+# Clasificaciones válidas, aceptadas también sin tildes o en minúsculas
+_CLASIFICACIONES = {normalizar_texto(valor): valor for valor in (PRESCRIPCION, EDUCATIVA)}
+
+_PRESCRIPCION_CONSULTA = [re.compile(patron) for patron in _PATRONES_PRESCRIPCION_CONSULTA]
+_PRESCRIPCION_RESPUESTA = [re.compile(patron) for patron in _PATRONES_PRESCRIPCION_RESPUESTA]
+_EDUCATIVA_CONSULTA = [re.compile(patron) for patron in _PATRONES_EDUCATIVA_CONSULTA]
+
+
+def clasificar_localmente(query, respuesta=None):
+    """
+    Clasifica por palabras clave, sin llamar al LLM.
+
+    Retorna PRESCRIPCION si la consulta pide una receta o la respuesta indica
+    qué tomar, EDUCATIVA si la consulta es claramente informativa y la
+    respuesta no prescribe nada, o None si el caso es ambiguo y debe
+    revisarlo el LLM. Con respuesta=None solo se mira la consulta.
+    """
+    consulta = normalizar_texto(query) or ""
+    texto = normalizar_texto(respuesta) or ""
+
+    if any(patron.search(consulta) for patron in _PRESCRIPCION_CONSULTA):
+        return PRESCRIPCION
+    if texto and any(patron.search(texto) for patron in _PRESCRIPCION_RESPUESTA):
+        return PRESCRIPCION
+    if any(patron.search(consulta) for patron in _EDUCATIVA_CONSULTA):
+        return EDUCATIVA
+    return None
+
+
+def parsear_respuesta_inline(salida):
+    """
+    Extrae (respuesta, clasificacion) de la salida JSON del PROMPT_INLINE.
+
+    Tolera texto alrededor del objeto (por ejemplo bloques ```json). Si no
+    hay un JSON válido, retorna la salida como respuesta y clasificación
+    None para que se revise por otra vía.
+    """
+    texto = str(salida).strip()
+    inicio, fin = texto.find("{"), texto.rfind("}")
+    if inicio != -1 and fin > inicio:
+        try:
+            datos = json.loads(texto[inicio:fin + 1])
+        except ValueError:
+            datos = None
+        if isinstance(datos, dict) and isinstance(datos.get("respuesta"), str):
+            clasificacion = _CLASIFICACIONES.get(normalizar_texto(str(datos.get("clasificacion", ""))))
+            return datos["respuesta"], clasificacion
+    return texto, None
@@ -0,0 +1,227 @@
+import codecs
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Estados posibles de una descarga
+DESCARGADO = "descargado"
+NO_MODIFICADO = "no_modificado"
+ERROR = "error"
+
+# Códigos HTTP que vale la pena reintentar
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+# Tamaño de los fragmentos leídos del cuerpo HTTP en modo streaming
+TAMANO_FRAGMENTO = 64 * 1024
+
+
+def iterar_objetos_json(fragmentos):
+    """
+    Parsea incrementalmente un arreglo JSON de objetos.
+
+    Recibe un iterable de fragmentos de bytes (por ejemplo
+    response.iter_content()) y entrega cada objeto del arreglo apenas está
+    completo, de modo que en memoria solo vive el objeto actual y el
+    fragmento pendiente, sin importar el tamaño total del feed.
+    """
+    decodificador = json.JSONDecoder()
+    texto = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    pos = 0
+    dentro_del_arreglo = False
+
+    for fragmento in fragmentos:
+        buffer = buffer[pos:] + texto.decode(fragmento)
+        pos = 0
+        while True:
+            # Saltar espacios y separadores entre elementos
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not dentro_del_arreglo:
+                if buffer[pos] != "[":
+                    raise ValueError("Se esperaba un arreglo JSON")
+                dentro_del_arreglo = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            if buffer[pos] != "{":
+                raise ValueError(f"Se esperaba un objeto JSON en la posición {pos}")
+            try:
+                objeto, pos = decodificador.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Objeto incompleto: esperar el siguiente fragmento
+                break
+            yield objeto
+
+    raise ValueError("El arreglo JSON terminó de forma inesperada")
+
+
+class ResultadoDescarga:
+    """Resultado de descargar un feed: estado, datos y validadores HTTP"""
+
+    def __init__(self, url, estado, datos=None, etag=None, last_modified=None, error=None):
+        self.url = url
+        self.estado = estado
+        self.datos = datos
+        self.etag = etag
+        self.last_modified = last_modified
+        self.error = error
+
+    def __repr__(self):
+        return f"ResultadoDescarga({self.url!r}, {self.estado!r})"
+
+
+class ClienteMinsal:
+    """Cliente HTTP para los feeds de farmacias del MINSAL.
+
+    Usa una sesión keep-alive compartida, negocia gzip, envía
+    If-None-Match/If-Modified-Since con los validadores de la última descarga
+    confirmada y reintenta con backoff exponencial y jitter ante errores de
+    red o respuestas 429/5xx.
+    """
+
+    def __init__(self, timeout=(5, 30), reintentos=3, espera_base=1.0,
+                 validadores=None, directorio_grabacion=None):
+        """
+        Args:
+            timeout (tuple): (conexión, lectura) en segundos para cada intento
+            reintentos (int): Intentos adicionales después del primero
+            espera_base (float): Espera base en segundos del backoff
+            validadores (dict, opcional): url -> (etag, last_modified) de la
+                última descarga confirmada
+            directorio_grabacion (str, opcional): Si se indica, se guarda ahí
+                el cuerpo de cada respuesta para reproducirlo con
+                servidor_minsal_local.py
+        """
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.validadores = dict(validadores or {})
+        self.directorio_grabacion = directorio_grabacion
+
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount("https://", adaptador)
+        self.session.mount("http://", adaptador)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def obtener(self, url, condicional=True, streaming=False) -> ResultadoDescarga:
+        """Descarga un feed; con condicional=True puede retornar NO_MODIFICADO.
+
+        Con streaming=True los datos son un generador que parsea el cuerpo a
+        medida que llega, en vez de una lista con el feed completo. Los
+        reintentos cubren hasta recibir los headers; un error a mitad del
+        cuerpo se propaga al consumir el generador.
+        """
+        headers = {}
+        if condicional and url in self.validadores:
+            etag, last_modified = self.validadores[url]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        ultimo_error = None
+        for intento in range(self.reintentos + 1):
+            if intento:
+                time.sleep(self.espera_base * (2 ** (intento - 1)) * random.uniform(0.5, 1.5))
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout, stream=streaming)
+
+                if response.status_code == 304:
+                    response.close()
+                    logging.info(f"Feed sin cambios: {url}")
+                    return ResultadoDescarga(url, NO_MODIFICADO)
+
+                if response.status_code in CODIGOS_REINTENTABLES:
+                    response.close()
+                    ultimo_error = f"HTTP {response.status_code}"
+                    logging.warning(f"{url} respondió {response.status_code} (intento {intento + 1})")
+                    continue
+
+                response.raise_for_status()
+                if streaming:
+                    datos = self._iterar_respuesta(url, response)
+                else:
+                    self._grabar(url, response.content)
+                    datos = response.json()
+                return ResultadoDescarga(
+                    url,
+                    DESCARGADO,
+                    datos=datos,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                ultimo_error = str(e)
+                logging.warning(f"Error de red obteniendo {url} (intento {intento + 1}): {e}")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # Errores HTTP no reintentables o JSON inválido
+                logging.error(f"Error obteniendo datos de {url}: {e}")
+                return ResultadoDescarga(url, ERROR, error=str(e))
+
+        logging.error(f"Error obteniendo datos de {url} tras {self.reintentos + 1} intentos: {ultimo_error}")
+        return ResultadoDescarga(url, ERROR, error=ultimo_error)
+
+    def obtener_varios(self, urls, condicional=True, streaming=False) -> dict:
+        """Descarga varios feeds en paralelo y retorna url -> ResultadoDescarga"""
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            resultados = executor.map(lambda url: self.obtener(url, condicional, streaming), urls)
+            return dict(zip(urls, resultados))
+
+    def confirmar(self, resultado: ResultadoDescarga):
+        """Guarda los validadores de una descarga ya procesada correctamente"""
+        if resultado.estado == DESCARGADO:
+            self.validadores[resultado.url] = (resultado.etag, resultado.last_modified)
+
+    def cerrar(self):
+        """Cierra la sesión HTTP y sus conexiones"""
+        self.session.close()
+
+    def _iterar_respuesta(self, url, response):
+        """Entrega los objetos del cuerpo de una respuesta abierta en streaming"""
+        archivo = self._abrir_grabacion(url)
+        try:
+            fragmentos = response.iter_content(chunk_size=TAMANO_FRAGMENTO)
+            if archivo:
+                fragmentos = self._copiar_fragmentos(fragmentos, archivo)
+            yield from iterar_objetos_json(fragmentos)
+        finally:
+            response.close()
+            if archivo:
+                archivo.close()
+
+    @staticmethod
+    def _copiar_fragmentos(fragmentos, archivo):
+        for fragmento in fragmentos:
+            archivo.write(fragmento)
+            yield fragmento
+
+    def _abrir_grabacion(self, url):
+        if not self.directorio_grabacion:
+            return None
+        os.makedirs(self.directorio_grabacion, exist_ok=True)
+        nombre = url.rstrip("/").rsplit("/", 1)[-1] + ".json"
+        return open(os.path.join(self.directorio_grabacion, nombre), "wb")
+
+    def _grabar(self, url, contenido):
+        archivo = self._abrir_grabacion(url)
+        if archivo:
+            with archivo:
+                archivo.write(contenido)
@@ -1,52 +1,88 @@
+import asyncio
 import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
-from langchain_qdrant import Qdrant
-from langchain_openai import ChatOpenAI
 from langchain.chains import RetrievalQA
-from qdrant_client import QdrantClient
+from langchain.prompts import PromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain.chains.retrieval_qa.prompt import PROMPT as PROMPT_RAG
 from datetime import datetime
+from normalizacion import normalizar_texto
+from recursos_llm import recursos
+from cache_semantico import CacheSemantico, UMBRAL_SIMILITUD, terminos_distintivos
+from bd_historial import BaseHistorial
+from detector_comunas import DetectorComunasBD
+from router_intenciones import RouterIntenciones, ClasificadorEmbeddings, FARMACIA, MEDICAMENTO, VER_MAS
+from clasificador_seguridad import (
+    PRESCRIPCION, EDUCATIVA, PROMPT_INLINE, clasificar_localmente, parsear_respuesta_inline
+)
+from horarios import resolver_minuto, filtro_abierta, minutos_del_dia
+from esquema import origen_farmacias
+from busqueda_cercana import farmacias_cercanas, RADIO_POR_DEFECTO_KM, LIMITE_POR_DEFECTO
+from trazas import trazar, etapa, anotar, registrar_etapa, latencias
 
 # Cargar variables de entorno (si usas OpenAI)
 load_dotenv()
 
-# Función para inicializar la base de datos de historial
-def inicializar_bd_historial():
-    """Inicializa la base de datos para el historial de consultas"""
-    try:
-        # Obtener la ruta a la base de datos
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        base_dir = os.path.join(current_dir, 'Base')
-        
-        # Crear directorio Base si no existe
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
-            
-        db_path = os.path.join(base_dir, 'historial_consultas.db')
-        
-        # Conectar a la base de datos
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Crear tabla de historial si no existe
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS historial (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id TEXT NOT NULL,
-            consulta TEXT NOT NULL,
-            respuesta TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        
-        return db_path
-    except Exception as e:
-        print(f"Error al inicializar la base de datos de historial: {e}")
-        return None
+# Modos de revisión de seguridad de las respuestas sobre medicamentos:
+# - "doble": la respuesta del RAG se revisa con una segunda llamada al LLM
+# - "inline": el LLM responde y clasifica en la misma llamada (salida JSON)
+# - "local": un clasificador por palabras clave resuelve los casos claros y
+#   solo los ambiguos pasan a la revisión del LLM
+MODOS_SEGURIDAD = ("doble", "inline", "local")
+MODO_SEGURIDAD_POR_DEFECTO = "doble"
+
+# Base de historial: esquema creado una vez y una conexión WAL por hilo. Las
+# escrituras se aplican por lotes en segundo plano (HISTORIAL_DIFERIDO=0 las
+# vuelve síncronas)
+historial_bd = BaseHistorial(diferir=os.getenv("HISTORIAL_DIFERIDO", "1") != "0")
+DB_HISTORIAL_PATH = historial_bd.ruta
+
+# Base de farmacias que mantiene ActualizaFarmacias.py
+DB_FARMACIAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Base', 'farmacias_turno.db')
+
+# Farmacias por respuesta del chat; "ver más" pide la página siguiente
+FARMACIAS_POR_PAGINA = 10
+
+# Última búsqueda de farmacias de cada usuario, para continuarla con "ver más".
+# Se guarda el minuto ya resuelto, así las páginas siguientes usan el mismo
+# filtro de horario que la primera
+MAX_BUSQUEDAS_RECORDADAS = 10000
+ultimas_busquedas = OrderedDict()
+_lock_busquedas = threading.Lock()
+
+def recordar_busqueda(usuario_id, busqueda):
+    with _lock_busquedas:
+        ultimas_busquedas[usuario_id] = busqueda
+        ultimas_busquedas.move_to_end(usuario_id)
+        while len(ultimas_busquedas) > MAX_BUSQUEDAS_RECORDADAS:
+            ultimas_busquedas.popitem(last=False)
+
+def obtener_busqueda(usuario_id):
+    with _lock_busquedas:
+        return ultimas_busquedas.get(usuario_id)
+
+def buscar_pagina_farmacias(usuario_id, comuna, solo_turno=False, minuto=None, desplazamiento=0):
+    """
+    Consulta y formatea una página de farmacias, y la recuerda como la última
+    búsqueda del usuario
+    """
+    with etapa("farmacias_sql"):
+        farmacias, total = consultar_farmacias(comuna, solo_turno=solo_turno, abierta_a=minuto,
+                                               desplazamiento=desplazamiento)
+    recordar_busqueda(usuario_id, {
+        'comuna': comuna,
+        'solo_turno': solo_turno,
+        'minuto': minuto,
+        'desplazamiento': desplazamiento + len(farmacias),
+    })
+    return formatear_resultados_farmacias(farmacias, comuna, solo_turno=solo_turno,
+                                          total=total, desplazamiento=desplazamiento)
+
 def guardar_info_usuario(usuario_id, nombre=None):
     """
     Guarda o actualiza la información de un usuario
@@ -56,49 +92,11 @@ def guardar_info_usuario(usuario_id, nombre=None):
         nombre (str, opcional): Nombre del usuario
     """
     try:
-        conn = sqlite3.connect(DB_HISTORIAL_PATH)
-        cursor = conn.cursor()
-        
-        # Crear tabla de usuarios si no existe
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id TEXT PRIMARY KEY,
-            nombre TEXT,
-            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            ultima_actividad TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Verificar si el usuario ya existe
-        cursor.execute("SELECT id FROM usuarios WHERE id = ?", (usuario_id,))
-        resultado = cursor.fetchone()
-        
-        current_time = datetime.now().isoformat()
-        
-        # Si no existe, lo registramos
-        if not resultado:
-            cursor.execute(
-                "INSERT INTO usuarios (id, nombre, fecha_creacion, ultima_actividad) VALUES (?, ?, ?, ?)",
-                (usuario_id, nombre, current_time, current_time)
-            )
-        else:
-            # Si existe y se proporciona un nombre, lo actualizamos
-            if nombre:
-                cursor.execute(
-                    "UPDATE usuarios SET nombre = ?, ultima_actividad = ? WHERE id = ?",
-                    (nombre, current_time, usuario_id)
-                )
-            else:
-                # Solo actualizamos la última actividad
-                cursor.execute(
-                    "UPDATE usuarios SET ultima_actividad = ? WHERE id = ?",
-                    (current_time, usuario_id)
-                )
-        
-        conn.commit()
-        conn.close()
+        with etapa("usuario"):
+            historial_bd.guardar_usuario(usuario_id, nombre)
         print(f"Información del usuario {usuario_id} guardada/actualizada")
     except Exception as e:
+        historial_bd.registrar_error("guardar usuario", e)
         print(f"Error al guardar información de usuario: {e}")
 
 def obtener_info_usuario(usuario_id):
@@ -113,16 +111,8 @@ def obtener_info_usuario(usuario_id):
               o None si el usuario no existe
     """
     try:
-        conn = sqlite3.connect(DB_HISTORIAL_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT nombre, fecha_creacion, ultima_actividad FROM usuarios WHERE id = ?",
-            (usuario_id,)
-        )
-        
-        resultado = cursor.fetchone()
-        conn.close()
+        with etapa("usuario"):
+            resultado = historial_bd.obtener_usuario(usuario_id)
         
         if resultado:
             nombre, fecha_creacion, ultima_actividad = resultado
@@ -134,11 +124,13 @@ def obtener_info_usuario(usuario_id):
         else:
             return None
     except Exception as e:
+        historial_bd.registrar_error("obtener usuario", e)
         print(f"Error al obtener información de usuario: {e}")
         return None
 
 # Modifica la función procesar_consulta para manejar el nombre del usuario
-def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=True):
+@trazar("procesar_consulta")
+def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=True, intencion=None):
     """
     Función principal para procesar consultas de un usuario específico.
     
@@ -147,6 +139,7 @@ def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=T
         query (str): La consulta del usuario
         nombre_usuario (str, opcional): Nombre del usuario
         guardar_historia (bool, opcional): Si se debe guardar la consulta en el historial
+        intencion (Intencion, opcional): Resultado de enrutar_consulta, si ya se calculó
         
     Returns:
         str: La respuesta generada
@@ -157,13 +150,16 @@ def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=T
         
         # Obtener información del usuario
         info_usuario = obtener_info_usuario(usuario_id)
-        nombre = info_usuario['nombre'] if info_usuario and info_usuario['nombre'] else None
-        
-        # El resto de la función es igual...
-        # Detectar si es sobre farmacias o medicamentos
-        if es_consulta_farmacia(query):
+        # El nombre recién recibido puede estar aún en la cola de escritura
+        nombre = nombre_usuario or (info_usuario['nombre'] if info_usuario and info_usuario['nombre'] else None)
+        
+        # Detectar si es sobre farmacias o medicamentos (y la comuna y el
+        # turno, en la misma pasada)
+        intencion = intencion or enrutar_consulta(query)
+        anotar(intencion=intencion.tipo)
+        if intencion.tipo == FARMACIA:
             # Es una consulta sobre farmacias
-            comuna = detectar_comuna(query)
+            comuna = intencion.comuna
             if not comuna:
                 saludo = f"Hola {nombre}, " if nombre else ""
                 respuesta = f"{saludo}para buscar farmacias necesito que me indiques la comuna específica. Por ejemplo: 'Farmacias en Providencia'."
@@ -174,14 +170,11 @@ def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=T
                     
                 return respuesta
             
-            # Detectar si es de turno
-            es_turno = "turno" in query.lower()
-            
-            # Consultar farmacias
-            farmacias = consultar_farmacias(comuna, solo_turno=es_turno)
+            es_turno = intencion.turno
             
-            # Formatear resultados
-            respuesta_base = formatear_resultados_farmacias(farmacias, comuna, solo_turno=es_turno)
+            # Consultar y formatear la primera página de farmacias
+            minuto = resolver_minuto(detectar_horario(query))
+            respuesta_base = buscar_pagina_farmacias(usuario_id, comuna, solo_turno=es_turno, minuto=minuto)
             
             # Añadir saludo personalizado si tenemos el nombre
             if nombre:
@@ -196,20 +189,26 @@ def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=T
                 
             return respuesta
             
-        elif es_consulta_medicamento(query):
-            # Es una consulta sobre medicamentos - usar el RAG original
-            llm = obtener_llm()
-            qdrant = obtener_qdrant()
-            
-            # Crear la cadena RAG
-            retriever = qdrant.as_retriever(search_type="similarity", search_kwargs={"k": 3})
-            qa_chain = crear_rag(llm, retriever)
+        elif intencion.tipo == VER_MAS:
+            # Siguiente página de la última búsqueda de farmacias del usuario
+            busqueda = obtener_busqueda(usuario_id)
+            if busqueda is None:
+                respuesta = "No tengo una búsqueda de farmacias anterior que continuar. Por ejemplo: 'Farmacias en Providencia'."
+            else:
+                respuesta = buscar_pagina_farmacias(usuario_id, busqueda['comuna'], solo_turno=busqueda['solo_turno'],
+                                                    minuto=busqueda['minuto'],
+                                                    desplazamiento=busqueda['desplazamiento'])
             
-            # Realizar la consulta y obtener la respuesta
-            respuesta_raw = realizar_consulta(query, qa_chain)
+            if guardar_historia:
+                guardar_historial(usuario_id, query, respuesta)
+                
+            return respuesta
             
-            # Verificar la respuesta (pasando también la consulta original)
-            respuesta_base = verificar_respuesta_con_llm(respuesta_raw, query)
+        elif intencion.tipo == MEDICAMENTO:
+            # Es una consulta sobre medicamentos - usar el RAG original
+            # Generar y verificar la respuesta según MODO_SEGURIDAD (o reutilizar
+            # la de una consulta equivalente desde el caché semántico)
+            respuesta_base = responder_medicamento_con_cache(query)
             
             # Añadir saludo personalizado si tenemos el nombre
             if nombre:
@@ -246,8 +245,70 @@ def procesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=T
                 pass
                 
         return respuesta
-# Inicializar la base de datos al cargar el módulo
-DB_HISTORIAL_PATH = inicializar_bd_historial()
+@trazar("procesar_consulta_stream")
+def procesar_consulta_stream(usuario_id, query, nombre_usuario=None, guardar_historia=True):
+    """
+    Como procesar_consulta, pero genera la respuesta por partes: tuplas
+    ("token", fragmento) mientras se produce y ("final", respuesta) al
+    terminar (ver transmitir_medicamento). Solo las consultas de
+    medicamentos se transmiten token a token; las demás no llaman al LLM y
+    llegan directamente en el evento final.
+    """
+    intencion = enrutar_consulta(query)
+    anotar(intencion=intencion.tipo)
+    if intencion.tipo != MEDICAMENTO:
+        yield ("final", procesar_consulta(usuario_id, query, nombre_usuario, guardar_historia, intencion))
+        return
+
+    try:
+        guardar_info_usuario(usuario_id, nombre_usuario)
+        info_usuario = obtener_info_usuario(usuario_id)
+        nombre = nombre_usuario or (info_usuario['nombre'] if info_usuario and info_usuario['nombre'] else None)
+        saludo = f"Hola {nombre}, " if nombre else ""
+        if saludo:
+            yield ("token", saludo)
+
+        for tipo, texto in transmitir_medicamento(query):
+            if tipo == "final":
+                respuesta = f"{saludo}{texto}"
+                yield ("final", respuesta)
+            else:
+                yield (tipo, texto)
+    except Exception as e:
+        respuesta = f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
+        yield ("final", respuesta)
+
+    if guardar_historia:
+        guardar_historial(usuario_id, query, respuesta)
+
+@trazar("aprocesar_consulta")
+async def aprocesar_consulta(usuario_id, query, nombre_usuario=None, guardar_historia=True):
+    """
+    Versión asíncrona de procesar_consulta. Las consultas de medicamentos
+    usan los clientes asíncronos de OpenAI y Qdrant, así que cientos de
+    conversaciones pueden esperar al LLM a la vez en un solo event loop. Las
+    de farmacias son solo SQLite local y corren en un hilo del pool, igual
+    que el enrutamiento (detector de comunas en SQLite y, si está
+    configurado, el modelo local de embeddings del router).
+    """
+    intencion = await asyncio.to_thread(enrutar_consulta, query)
+    anotar(intencion=intencion.tipo)
+    if intencion.tipo != MEDICAMENTO:
+        return await asyncio.to_thread(procesar_consulta, usuario_id, query, nombre_usuario, guardar_historia, intencion)
+
+    try:
+        # Las escrituras del historial solo se encolan (ver bd_historial)
+        guardar_info_usuario(usuario_id, nombre_usuario)
+        info_usuario = await asyncio.to_thread(obtener_info_usuario, usuario_id)
+        nombre = nombre_usuario or (info_usuario['nombre'] if info_usuario and info_usuario['nombre'] else None)
+        saludo = f"Hola {nombre}, " if nombre else ""
+        respuesta = f"{saludo}{await aresponder_medicamento_con_cache(query)}"
+    except Exception as e:
+        respuesta = f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
+
+    if guardar_historia:
+        guardar_historial(usuario_id, query, respuesta)
+    return respuesta
 
 def guardar_historial(usuario_id, consulta, respuesta):
     """
@@ -259,19 +320,11 @@ def guardar_historial(usuario_id, consulta, respuesta):
         respuesta (str): Texto de la respuesta
     """
     try:
-        conn = sqlite3.connect(DB_HISTORIAL_PATH)
-        cursor = conn.cursor()
-        
-        # Insertar la consulta y respuesta
-        cursor.execute(
-            "INSERT INTO historial (usuario_id, consulta, respuesta) VALUES (?, ?, ?)",
-            (usuario_id, consulta, respuesta)
-        )
-        
-        conn.commit()
-        conn.close()
+        with etapa("historial"):
+            historial_bd.guardar_historial(usuario_id, consulta, respuesta)
         print(f"Historial guardado para usuario {usuario_id}")
     except Exception as e:
+        historial_bd.registrar_error("guardar historial", e)
         print(f"Error al guardar historial: {e}")
 
 def obtener_historial(usuario_id, limite=10):
@@ -286,22 +339,22 @@ def obtener_historial(usuario_id, limite=10):
         list: Lista de tuplas (consulta, respuesta, timestamp)
     """
     try:
-        conn = sqlite3.connect(DB_HISTORIAL_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT consulta, respuesta, timestamp FROM historial WHERE usuario_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (usuario_id, limite)
-        )
-        
-        resultados = cursor.fetchall()
-        conn.close()
-        
-        return resultados
+        return historial_bd.obtener_historial(usuario_id, limite)
     except Exception as e:
+        historial_bd.registrar_error("obtener historial", e)
         print(f"Error al obtener historial: {e}")
         return []
 
+def obtener_estadisticas_escrituras():
+    """Cola, lotes y contrapresión de las escrituras diferidas del historial"""
+    if historial_bd.escrituras is None:
+        return {'diferidas': False}
+    return dict(historial_bd.escrituras.estadisticas(), diferidas=True)
+
+def obtener_estadisticas_trazas():
+    """Histogramas de latencia por etapa y muestras de consultas lentas"""
+    return latencias.estadisticas()
+
 def verificar_respuesta_con_llm(respuesta, query):
     """
     Usa el LLM para revisar la respuesta generada, con un enfoque más matizado.
@@ -313,8 +366,11 @@ def verificar_respuesta_con_llm(respuesta, query):
     else:
         texto_respuesta = str(respuesta)
     
-    # Prompt para revisar la respuesta generada con contexto de la consulta
-    prompt_revision = f"""
+    return aplicar_clasificacion(texto_respuesta, clasificar_respuesta_con_llm(texto_respuesta, query))
+
+def armar_prompt_revision(texto_respuesta, query):
+    """Prompt con que el LLM clasifica la respuesta (PRESCRIPCION o EDUCATIVA)"""
+    return f"""
     Analiza esta consulta del usuario y la respuesta generada por un sistema sobre medicamentos:
     
     Consulta: "{query}"
@@ -332,11 +388,24 @@ def verificar_respuesta_con_llm(respuesta, query):
     Responde ÚNICAMENTE con una de estas dos opciones.
     """
 
-    llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
-    revision_respuesta = llm.invoke(prompt_revision).content.strip()
-    
-    # Si el LLM considera que es una prescripción médica, la bloqueamos
-    if "PRESCRIPCIÓN_MÉDICA" in revision_respuesta:
+def clasificar_respuesta_con_llm(texto_respuesta, query):
+    """Pide al LLM que clasifique la respuesta; retorna PRESCRIPCION o EDUCATIVA"""
+    prompt_revision = armar_prompt_revision(texto_respuesta, query)
+    with etapa("revision"):
+        revision_respuesta = recursos.usar('llm', lambda llm: llm.invoke(prompt_revision)).content.strip()
+    return PRESCRIPCION if PRESCRIPCION in revision_respuesta else EDUCATIVA
+
+async def aclasificar_respuesta_con_llm(texto_respuesta, query):
+    """Versión asíncrona de clasificar_respuesta_con_llm"""
+    prompt_revision = armar_prompt_revision(texto_respuesta, query)
+    with etapa("revision"):
+        revision_respuesta = (await recursos.ausar('llm', lambda llm: llm.ainvoke(prompt_revision))).content.strip()
+    return PRESCRIPCION if PRESCRIPCION in revision_respuesta else EDUCATIVA
+
+def aplicar_clasificacion(texto_respuesta, clasificacion):
+    """Arma la respuesta final según la clasificación de seguridad"""
+    # Si es una prescripción médica, la bloqueamos
+    if clasificacion == PRESCRIPCION:
         return "Lo siento, no estoy autorizado para recetar medicamentos o dar consejos de prescripción específicos. Esta información es educativa general. Para tratamientos personalizados, por favor consulte con un profesional de la salud."
     else:
         # Si es información educativa, la permitimos con un disclaimer
@@ -347,37 +416,355 @@ def verificar_respuesta_con_llm(respuesta, query):
 
 def obtener_llm():
     """
-    Inicializa el LLM (Modelo de Lenguaje) usando OpenAI.
+    Retorna el LLM (Modelo de Lenguaje) de OpenAI compartido por el proceso.
     """
-    llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
-    return llm
+    return recursos.obtener('llm')
 
 def obtener_qdrant():
     """
-    Establece la conexión a Qdrant, usando la colección existente.
+    Retorna la conexión a Qdrant (colección existente) compartida por el proceso.
     """
-    client = QdrantClient(url="http://localhost:6333")
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
-    qdrant = Qdrant(client=client, collection_name="remedios_collection", embeddings=embeddings)
-    return qdrant
+    return recursos.obtener('qdrant')
 
-def crear_rag(llm, retriever):
+PROMPT_RAG_INLINE = PromptTemplate(template=PROMPT_INLINE, input_variables=["context", "question"])
+
+def crear_rag(llm, retriever, prompt=None):
     """
     Crea la cadena de Retrieval Augmented Generation (RAG) con el LLM y el retriever (Qdrant).
+    Con `prompt` se reemplaza el prompt por defecto de la cadena "stuff".
     """
     qa_chain = RetrievalQA.from_chain_type(
         llm=llm,
         chain_type="stuff",
-        retriever=retriever
+        retriever=retriever,
+        chain_type_kwargs={"prompt": prompt} if prompt else {}
     )
     return qa_chain
 
+def crear_cadena_rag(config, llm, qdrant):
+    """Fábrica de la cadena RAG para el registro de recursos"""
+    retriever = qdrant.as_retriever(search_type="similarity", search_kwargs={"k": 3})
+    return crear_rag(llm, retriever)
+
+def crear_cadena_rag_inline(config, llm, qdrant):
+    """Fábrica de la cadena RAG que responde y clasifica en una sola llamada"""
+    retriever = qdrant.as_retriever(search_type="similarity", search_kwargs={"k": 3})
+    return crear_rag(llm, retriever, PROMPT_RAG_INLINE)
+
+def armar_prompt_rag(documentos, query, plantilla=PROMPT_RAG):
+    """Prompt "stuff" de la cadena RAG: los fragmentos recuperados y la pregunta"""
+    return plantilla.format(
+        context="\n\n".join(documento.page_content for documento in documentos),
+        question=query
+    )
+
+async def arealizar_consulta(query, plantilla=PROMPT_RAG):
+    """
+    Versión asíncrona de la cadena RAG: busca en Qdrant y llama al LLM sin
+    ocupar un hilo mientras esperan la red.
+    """
+    with etapa("recuperacion"):
+        documentos = await recursos.ausar('qdrant', lambda qdrant: qdrant.asimilarity_search(query, k=3))
+    prompt = armar_prompt_rag(documentos, query, plantilla)
+    with etapa("generacion"):
+        return (await recursos.ausar('llm', lambda llm: llm.ainvoke(prompt))).content
+
+recursos.registrar('cadena_rag', crear_cadena_rag, dependencias=('llm', 'qdrant'))
+recursos.registrar('cadena_rag_inline', crear_cadena_rag_inline, dependencias=('llm', 'qdrant'))
+
+def responder_medicamento(query, modo=None):
+    """
+    Responde una consulta sobre medicamentos con el RAG y aplica la revisión
+    de seguridad según el modo (ver MODOS_SEGURIDAD).
+
+    Args:
+        query (str): Consulta del usuario
+        modo (str, opcional): "doble", "inline" o "local"; por defecto el
+            de la variable de entorno MODO_SEGURIDAD
+
+    Returns:
+        str: La respuesta final, bloqueada si es una prescripción
+    """
+    modo = modo or os.environ.get("MODO_SEGURIDAD", MODO_SEGURIDAD_POR_DEFECTO)
+    if modo not in MODOS_SEGURIDAD:
+        raise ValueError(f"Modo de seguridad desconocido: {modo}")
+    anotar(modo=modo)
+
+    if modo == "inline":
+        salida = recursos.usar('cadena_rag_inline', lambda qa_chain: realizar_consulta(query, qa_chain))
+        texto_respuesta, clasificacion = parsear_respuesta_inline(salida)
+        if clasificacion is None:
+            # Salida sin JSON válido: se clasifica por la vía local o la del LLM
+            clasificacion = clasificar_localmente(query, texto_respuesta) or clasificar_respuesta_con_llm(texto_respuesta, query)
+        return aplicar_clasificacion(texto_respuesta, clasificacion)
+
+    if modo == "local":
+        # Una consulta que pide una receta se bloquea sin llamar al LLM
+        if clasificar_localmente(query) == PRESCRIPCION:
+            return aplicar_clasificacion("", PRESCRIPCION)
+        texto_respuesta = recursos.usar('cadena_rag', lambda qa_chain: realizar_consulta(query, qa_chain))
+        clasificacion = clasificar_localmente(query, texto_respuesta) or clasificar_respuesta_con_llm(texto_respuesta, query)
+        return aplicar_clasificacion(texto_respuesta, clasificacion)
+
+    # Modo doble: la respuesta del RAG se revisa con una segunda llamada al LLM
+    respuesta_raw = recursos.usar('cadena_rag', lambda qa_chain: realizar_consulta(query, qa_chain))
+    return verificar_respuesta_con_llm(respuesta_raw, query)
+
+async def aresponder_medicamento(query, modo=None):
+    """Versión asíncrona de responder_medicamento, con los mismos modos de seguridad"""
+    modo = modo or os.environ.get("MODO_SEGURIDAD", MODO_SEGURIDAD_POR_DEFECTO)
+    if modo not in MODOS_SEGURIDAD:
+        raise ValueError(f"Modo de seguridad desconocido: {modo}")
+    anotar(modo=modo)
+
+    if modo == "inline":
+        texto_respuesta, clasificacion = parsear_respuesta_inline(await arealizar_consulta(query, PROMPT_RAG_INLINE))
+        if clasificacion is None:
+            clasificacion = clasificar_localmente(query, texto_respuesta) or await aclasificar_respuesta_con_llm(texto_respuesta, query)
+        return aplicar_clasificacion(texto_respuesta, clasificacion)
+
+    if modo == "local" and clasificar_localmente(query) == PRESCRIPCION:
+        return aplicar_clasificacion("", PRESCRIPCION)
+
+    texto_respuesta = await arealizar_consulta(query)
+    clasificacion = clasificar_localmente(query, texto_respuesta) if modo == "local" else None
+    return aplicar_clasificacion(texto_respuesta, clasificacion or await aclasificar_respuesta_con_llm(texto_respuesta, query))
+
+def precalentar_recursos():
+    """
+    Construye los clientes del chat y abre sus conexiones antes de la primera
+    consulta, para que no pague el handshake TLS ni la construcción de objetos.
+    """
+    recursos.precalentar(
+        ['llm', 'qdrant', 'cadena_rag'],
+        verificar={
+            'llm': lambda llm: llm.root_client.models.list(),
+            'qdrant': lambda qdrant: qdrant.client.get_collection(qdrant.collection_name),
+        }
+    )
+
+recursos.registrar(
+    'cache_semantico',
+    lambda config: CacheSemantico(
+        coleccion=config['QDRANT_COLECCION'],
+        umbral=float(config['CACHE_SEMANTICO_UMBRAL'] or UMBRAL_SIMILITUD),
+    ),
+    claves_config=('QDRANT_COLECCION', 'CACHE_SEMANTICO_UMBRAL'),
+    cerrar=lambda cache: cache.cerrar()
+)
+
+recursos.registrar(
+    'detector_comunas',
+    lambda config: DetectorComunasBD(DB_FARMACIAS_PATH),
+    cerrar=lambda detector: detector.cerrar()
+)
+
+def grupo_cache(query, modo):
+    """
+    Grupo del caché semántico para la consulta: modo de seguridad, clase
+    según el clasificador local y términos distintivos. Una respuesta solo
+    se reutiliza dentro de su grupo. Retorna None para las consultas que
+    piden una receta, que nunca se sirven ni se guardan en el caché.
+    """
+    clase = clasificar_localmente(query)
+    if clase == PRESCRIPCION:
+        return None
+    return f"{modo}|{clase or ''}|{terminos_distintivos(query)}"
+
+def responder_medicamento_con_cache(query, modo=None):
+    """
+    Como responder_medicamento, pero antes busca en el caché semántico una
+    respuesta a una consulta equivalente (por similitud de embeddings, ver
+    grupo_cache). Con CACHE_SEMANTICO=0 el caché se omite.
+    """
+    modo = modo or os.environ.get("MODO_SEGURIDAD", MODO_SEGURIDAD_POR_DEFECTO)
+    grupo = grupo_cache(query, modo)
+    if os.environ.get("CACHE_SEMANTICO", "1") == "0" or grupo is None:
+        return responder_medicamento(query, modo)
+
+    try:
+        cache = recursos.obtener('cache_semantico')
+        with etapa("embedding"):
+            vector = recursos.usar('embeddings', lambda embeddings: embeddings.embed_query(query))
+        with etapa("cache_semantico"):
+            respuesta = cache.buscar(vector, grupo)
+    except Exception as e:
+        # El caché nunca debe impedir responder
+        print(f"Error consultando el caché semántico: {e}")
+        return responder_medicamento(query, modo)
+    anotar(cache=respuesta is not None)
+    if respuesta is not None:
+        return respuesta
+
+    inicio = time.perf_counter()
+    respuesta = responder_medicamento(query, modo)
+    try:
+        with etapa("cache_semantico"):
+            cache.guardar(query, vector, respuesta, (time.perf_counter() - inicio) * 1000, grupo)
+    except Exception as e:
+        print(f"Error guardando en el caché semántico: {e}")
+    return respuesta
+
+def transmitir_medicamento(query, modo=None):
+    """
+    Versión por streaming de responder_medicamento_con_cache. Genera tuplas
+    (tipo, texto):
+    - ("token", fragmento) a medida que el LLM produce la respuesta
+    - ("final", respuesta) una sola vez al terminar, con la respuesta ya
+      revisada: el cliente reemplaza lo que mostró por este texto, así que
+      la revisión de seguridad puede retirar la respuesta o anotarla.
+
+    El modo "inline" responde JSON, que no sirve para mostrar parcialmente;
+    en ese modo la respuesta llega completa en el evento final.
+    """
+    modo = modo or os.environ.get("MODO_SEGURIDAD", MODO_SEGURIDAD_POR_DEFECTO)
+    if modo not in MODOS_SEGURIDAD:
+        raise ValueError(f"Modo de seguridad desconocido: {modo}")
+    anotar(modo=modo)
+
+    cache = vector = None
+    grupo = grupo_cache(query, modo)
+    if os.environ.get("CACHE_SEMANTICO", "1") != "0" and grupo is not None:
+        try:
+            cache = recursos.obtener('cache_semantico')
+            with etapa("embedding"):
+                vector = recursos.usar('embeddings', lambda embeddings: embeddings.embed_query(query))
+            with etapa("cache_semantico"):
+                respuesta = cache.buscar(vector, grupo)
+        except Exception as e:
+            print(f"Error consultando el caché semántico: {e}")
+            cache = respuesta = None
+        anotar(cache=respuesta is not None)
+        if respuesta is not None:
+            yield ("final", respuesta)
+            return
+
+    inicio = time.perf_counter()
+    if modo == "inline":
+        respuesta = responder_medicamento(query, modo)
+    elif modo == "local" and clasificar_localmente(query) == PRESCRIPCION:
+        respuesta = aplicar_clasificacion("", PRESCRIPCION)
+    else:
+        with etapa("recuperacion"):
+            documentos = recursos.usar('qdrant', lambda qdrant: qdrant.similarity_search(query, k=3))
+        prompt = armar_prompt_rag(documentos, query)
+        fragmentos = []
+        inicio_generacion = time.perf_counter()
+        for fragmento in recursos.transmitir('llm', lambda llm: llm.stream(prompt)):
+            if fragmento.content:
+                if not fragmentos:
+                    registrar_etapa("primer_token", (time.perf_counter() - inicio_generacion) * 1000)
+                fragmentos.append(fragmento.content)
+                yield ("token", fragmento.content)
+        # Incluye el tiempo que el cliente tardó en consumir cada fragmento
+        registrar_etapa("generacion", (time.perf_counter() - inicio_generacion) * 1000)
+        texto_respuesta = "".join(fragmentos)
+
+        # La revisión corre sobre la respuesta completa, antes del evento final
+        clasificacion = clasificar_localmente(query, texto_respuesta) if modo == "local" else None
+        respuesta = aplicar_clasificacion(texto_respuesta, clasificacion or clasificar_respuesta_con_llm(texto_respuesta, query))
+
+    if cache is not None:
+        try:
+            with etapa("cache_semantico"):
+                cache.guardar(query, vector, respuesta, (time.perf_counter() - inicio) * 1000, grupo)
+        except Exception as e:
+            print(f"Error guardando en el caché semántico: {e}")
+    yield ("final", respuesta)
+
+async def aresponder_medicamento_con_cache(query, modo=None):
+    """
+    Versión asíncrona de responder_medicamento_con_cache. El caché es SQLite
+    y numpy en memoria, así que sus lecturas y escrituras van a un hilo.
+    """
+    modo = modo or os.environ.get("MODO_SEGURIDAD", MODO_SEGURIDAD_POR_DEFECTO)
+    grupo = grupo_cache(query, modo)
+    if os.environ.get("CACHE_SEMANTICO", "1") == "0" or grupo is None:
+        return await aresponder_medicamento(query, modo)
+
+    try:
+        cache = recursos.obtener('cache_semantico')
+        with etapa("embedding"):
+            vector = await recursos.ausar('embeddings', lambda embeddings: embeddings.aembed_query(query))
+        with etapa("cache_semantico"):
+            respuesta = await asyncio.to_thread(cache.buscar, vector, grupo)
+    except Exception as e:
+        print(f"Error consultando el caché semántico: {e}")
+        return await aresponder_medicamento(query, modo)
+    anotar(cache=respuesta is not None)
+    if respuesta is not None:
+        return respuesta
+
+    inicio = time.perf_counter()
+    respuesta = await aresponder_medicamento(query, modo)
+    try:
+        with etapa("cache_semantico"):
+            await asyncio.to_thread(cache.guardar, query, vector, respuesta, (time.perf_counter() - inicio) * 1000, grupo)
+    except Exception as e:
+        print(f"Error guardando en el caché semántico: {e}")
+    return respuesta
+
+def obtener_estadisticas_cache():
+    """Tasa de aciertos y latencia ahorrada del caché semántico"""
+    return recursos.obtener('cache_semantico').estadisticas()
+
+def obtener_estadisticas_caches():
+    """
+    Estadísticas de los cachés que ya están en uso (semántico y de
+    embeddings); a diferencia de obtener_estadisticas_cache, nunca los crea
+    """
+    estadisticas = {}
+    for nombre in ('cache_semantico', 'embeddings'):
+        recurso = recursos.existente(nombre)
+        if recurso is not None:
+            estadisticas[nombre] = recurso.estadisticas()
+    return estadisticas
+
+class ManejadorEtapas(BaseCallbackHandler):
+    """
+    Callbacks de LangChain que miden las etapas dentro de una cadena: el
+    retriever como "recuperacion" y cada llamada al modelo como "generacion".
+    """
+
+    def __init__(self):
+        self._inicios = {}
+
+    def _iniciar(self, run_id):
+        self._inicios[run_id] = time.perf_counter()
+
+    def _terminar(self, nombre, run_id):
+        inicio = self._inicios.pop(run_id, None)
+        if inicio is not None:
+            registrar_etapa(nombre, (time.perf_counter() - inicio) * 1000)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._iniciar(run_id)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._terminar("recuperacion", run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._terminar("recuperacion", run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._iniciar(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._iniciar(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._terminar("generacion", run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._terminar("generacion", run_id)
+
 def realizar_consulta(query, qa_chain):
     """
     Realiza una consulta al sistema RAG (Qdrant + LLM) y obtiene la respuesta.
     """
-    # Ejecutar la consulta y manejar tanto si devuelve un string como un dict
-    resultado = qa_chain.invoke(query)
+    # Ejecutar la consulta y manejar tanto si devuelve un string como un dict.
+    # El manejador separa en las trazas la búsqueda en Qdrant de la generación
+    resultado = qa_chain.invoke(query, config={'callbacks': [ManejadorEtapas()]})
     
     # En versiones recientes de LangChain, puede devolver un dict
     if isinstance(resultado, dict):
@@ -392,148 +779,161 @@ def realizar_consulta(query, qa_chain):
         # Si es un string, lo devolvemos directamente
         return resultado
 
+def crear_router_intenciones(config, detector_comunas):
+    """
+    Router de intenciones del chat; con ROUTER_EMBEDDINGS_MODELO (un modelo
+    local de sentence-transformers) clasifica también las consultas sin
+    ninguna palabra clave.
+    """
+    clasificador = None
+    if config.get('ROUTER_EMBEDDINGS_MODELO'):
+        clasificador = ClasificadorEmbeddings(config['ROUTER_EMBEDDINGS_MODELO'])
+    return RouterIntenciones(detector_comunas, clasificador)
+
+recursos.registrar(
+    'router_intenciones', crear_router_intenciones,
+    dependencias=('detector_comunas',), claves_config=('ROUTER_EMBEDDINGS_MODELO',)
+)
+
+def enrutar_consulta(query):
+    """
+    Clasifica la consulta en una sola pasada (ver router_intenciones).
+    Retorna una Intencion con tipo (FARMACIA, MEDICAMENTO u OTRA), comuna y
+    si pide farmacias de turno.
+    """
+    with etapa("enrutar"):
+        return recursos.obtener('router_intenciones').enrutar(query)
+
 def es_consulta_farmacia(query):
     """Determina si la consulta es sobre farmacias"""
-    query_lower = query.lower()
-    palabras_farmacia = [
-        "farmacia", "farmacias", "comprar", "cerca", "cercana", 
-        "turno", "dirección", "donde", "dónde", "ubicación"
-    ]
-    return any(palabra in query_lower for palabra in palabras_farmacia)
+    return enrutar_consulta(query).tipo == FARMACIA
 
 def es_consulta_medicamento(query):
     """Determina si la consulta es sobre medicamentos"""
+    return enrutar_consulta(query).tipo == MEDICAMENTO
+
+def detectar_horario(query):
+    """
+    Detecta si la consulta pide farmacias abiertas ("abierta ahora",
+    "abiertas a las 23:30"). Retorna "ahora", "HH:MM" o None.
+    """
     query_lower = query.lower()
-    palabras_medicamento = [
-        "medicamento", "medicina", "remedio", "pastilla", "comprimido", 
-        "para qué sirve", "efectos secundarios", "tratamiento", "droga",
-        "fármaco", "antibiótico", "analgésico", "tratar", "cura", "curar"
-    ]
-    return any(palabra in query_lower for palabra in palabras_medicamento)
+    if "abiert" not in query_lower:
+        return None
+    coincidencia = re.search(r"a las (\d{1,2}(?::\d{2})?)", query_lower)
+    if coincidencia and minutos_del_dia(coincidencia.group(1)) is not None:
+        return coincidencia.group(1)
+    return "ahora"
 
 def detectar_comuna(query):
-    """Detecta la comuna mencionada en la consulta"""
-    query_lower = query.lower()
-    comunas = [
-        "limache","tolten","pedro aguirre cerda","cabrero","ancud","antuco",
-        "la calera","cunco","peñaflor","maria pinto","castro","yumbel",
-        "quillota","gorbea","peñalolen","pencahue","puerto montt","quilleco",
-        "la cruz","villarrica","providencia","quemchi","tocopilla","tucapel",
-        "quilpue","lautaro","vitacura","caldera","mejillones","andacollo",
-        "quintero","pitrufquen","pudahuel","maullin","puerto varas","mafil",
-        "viña del mar","collipulli","puente alto","lota","la serena","corral",
-        "valparaiso","loncoche","quilicura","san pablo","combarbala","ninhue",
-        "casablanca","rancagua","quinta normal","coihueco","salamanca","algarrobo",
-        "el tabo","ovalle","recoleta","santa barbara","calbuco","chillan viejo",
-        "san antonio","vicuña","renca","mulchen","los muermos","quinchao",
-        "cabildo","illapel","san joaquin","cartagena","osorno","purranque",
-        "catemu","coquimbo","san miguel","rio negro","llanquihue","quinta de tilcoco",
-        "la ligua","los vilos","san ramon","nogales","aysen","punta arenas",
-        "los andes","san fernando","talagante","puqueldon","coyhaique","puerto natales",
-        "papudo","graneros","arauco","quilaco","pica","arica",
-        "putaendo","las cabras","bulnes","padre las casas","fresia","puren",
-        "santa maria","peralillo","cañete","victoria","calama","paredones",
-        "zapallar","pichidegua","chiguayante","carahue","chonchi","angol",
-        "llay llay","chimbarongo","chillan","lonquimay","antofagasta","traiguen",
-        "juan fernandez","doñihue","coelemu","frutillar","nueva imperial","curacautin",
-        "iquique","litueche","concepcion","calera de tango","lanco","san pedro",
-        "puchuncavi","marchigue","tome","tirua","paillaco","teodoro schmidt",
-        "concon","nancagua","coronel","renaico","rio bueno","san juan de la costa",
-        "alto hospicio","navidad","curanilahue","el quisco","panguipulli","pucon",
-        "hijuelas","requinoa","hualpen","vilcun","la union","puerto octay",
-        "rinconada","san francisco de mostazal","hualqui","vallenar","valdivia","alto bio bio",
-        "panquehue","santa cruz","lebu","tierra amarilla","temuco","hualaihue",
-        "san esteban","peumo","los alamos","colbun","quellon","san rosendo",
-        "buin","machali","penco","villa alemana","dalcahue","negrete",
-        "cerrillos","san vicente","pinto","pozo almonte","lo barnechea","lolol",
-        "cerro navia","pichilemu","quillon","huara","lo espejo","licanten",
-        "colina","rengo","quirihue","alhue","lo prado","maule",
-        "conchali","retiro","san carlos","los sauces","macul","til-til",
-        "curacavi","hualañe","san pedro de la paz","galvarino","maipu","taltal",
-        "el bosque","teno","talcahuano","puerto saavedra","melipilla","pelluhue",
-        "el monte","san clemente","yungay","huasco","ñuñoa","isla de pascua",
-        "estacion central","san javier","los angeles","alto del carmen","padre hurtado","longavi",
-        "santiago","molina","nacimiento","san nicolas","paine","puyehue",
-        "san bernardo","parral","laja","pirque","chañaral","lumaco",
-        "huechuraba","cauquenes","florida","chanco","lago ranco","san rafael",
-        "independencia","linares","santa juana","romeral","los lagos","yerbas buenas",
-        "isla de maipo","constitucion","san felipe","sagrada familia","mariquina","san fabian",
-        "la cisterna","curico","copiapo","vichuquen","futrono","freirina",
-        "la florida","talca","diego de almagro","perquenco","las condes","rauco",
-        "la granja","cochrane","la pintana","el carmen","la reina","san ignacio",
-        "lampa","petorca"
-    ]
-    for comuna in comunas:
-        if comuna in query_lower:
-            return comuna
-    return query_lower
-
-def consultar_farmacias(comuna, solo_turno=False):
-    """Consulta la base de datos de farmacias"""
+    """
+    Detecta la comuna mencionada en la consulta (match más largo, sin
+    distinguir tildes ni mayúsculas, y si no hay ninguno exacto, tolerando
+    errores de tipeo). Retorna el nombre de la comuna tal como está en la
+    base, o None si no menciona ninguna.
+    """
+    return recursos.obtener('detector_comunas').detectar(query)
+
+def consultar_farmacias(comuna, solo_turno=False, abierta_a=None, limite=FARMACIAS_POR_PAGINA, desplazamiento=0):
+    """
+    Consulta una página de farmacias de la comuna, las de turno primero
+
+    Args:
+        comuna (str): Nombre de la comuna (se normaliza)
+        solo_turno (bool): Si es True, solo farmacias de turno
+        abierta_a: Filtra las farmacias abiertas a esa hora: "ahora", True,
+            "HH:MM" o minutos desde medianoche (ver horarios.resolver_minuto)
+        limite (int): Farmacias por página
+        desplazamiento (int): Farmacias que se saltan (páginas anteriores)
+
+    Returns:
+        tuple: (farmacias de la página, total de farmacias que cumplen el filtro).
+            Cada farmacia es (nombre, dirección, apertura, cierre, teléfono,
+            url, de_turno); las de turno muestran su horario de turno.
+    """
     try:
-        # Obtener la ruta a la base de datos
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        db_path = os.path.join(current_dir, 'Base', 'farmacias_turno.db')
-        
         # Conectar a la base de datos
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(DB_FARMACIAS_PATH)
         cursor = conn.cursor()
+        # En una base sin migrar las columnas nuevas se calculan al vuelo (ver esquema)
+        origen = origen_farmacias(conn)
         
-        # Construir consulta SQL
+        # Igualdad sobre la clave normalizada: recorre idx_farmacias_clave_turno_nombre
+        # ya en orden (turno primero, luego nombre) y se detiene en el LIMIT
+        condiciones = "comuna_clave = ?"
+        parametros = [normalizar_texto(comuna)]
         if solo_turno:
-            sql = """
-            SELECT 
-                local_nombre, 
-                local_direccion, 
-                funcionamiento_hora_apertura, 
-                funcionamiento_hora_cierre, 
-                local_telefono, 
-                URL_direccion
-            FROM farmacias
-            WHERE comuna_nombre LIKE ? AND de_turno = 1
-            """
-        else:
-            sql = """
+            condiciones += " AND de_turno = 1"
+        
+        # Filtro por horario: rango sobre los minutos precalculados en la ingesta
+        minuto = resolver_minuto(abierta_a)
+        if minuto is not None:
+            condicion, parametros_horario = filtro_abierta(minuto)
+            condiciones += f" AND {condicion}"
+            parametros.extend(parametros_horario)
+        
+        cursor.execute(f"""
             SELECT 
                 local_nombre, 
                 local_direccion, 
-                funcionamiento_hora_apertura, 
-                funcionamiento_hora_cierre, 
+                COALESCE(turno_hora_apertura, funcionamiento_hora_apertura), 
+                COALESCE(turno_hora_cierre, funcionamiento_hora_cierre), 
                 local_telefono, 
                 URL_direccion,
                 de_turno
-            FROM farmacias
-            WHERE comuna_nombre LIKE ?
-            """
-        
-        # Ejecutar consulta
-        cursor.execute(sql, (f"%{comuna}%",))
+            FROM {origen}
+            WHERE {condiciones}
+            ORDER BY de_turno DESC, local_nombre
+            LIMIT ? OFFSET ?
+        """, parametros + [limite, desplazamiento])
         farmacias = cursor.fetchall()
         
+        # Una primera página incompleta ya es el total; si no, se cuenta aparte
+        if desplazamiento == 0 and len(farmacias) < limite:
+            total = len(farmacias)
+        else:
+            total = cursor.execute(f"SELECT COUNT(*) FROM {origen} WHERE {condiciones}", parametros).fetchone()[0]
+        
         conn.close()
-        return farmacias
+        return farmacias, total
     except Exception as e:
         print(f"Error al consultar farmacias: {e}")
+        return [], 0
+
+def consultar_farmacias_cercanas(lat, lng, radio_km=RADIO_POR_DEFECTO_KM,
+                                 limite=LIMITE_POR_DEFECTO, solo_turno=False):
+    """Consulta las farmacias más cercanas a un punto (ver busqueda_cercana)"""
+    try:
+        conn = sqlite3.connect(DB_FARMACIAS_PATH)
+        try:
+            return farmacias_cercanas(conn, lat, lng, radio_km, limite, solo_turno)
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Error al consultar farmacias cercanas: {e}")
         return []
 
-def formatear_resultados_farmacias(farmacias, comuna, solo_turno=False):
-    """Formatea los resultados de farmacias para presentación"""
+def formatear_resultados_farmacias(farmacias, comuna, solo_turno=False, total=None, desplazamiento=0):
+    """
+    Formatea una página de resultados de farmacias para presentación.
+    `total` es el número de farmacias que cumplen el filtro (por defecto,
+    las de la página) y `desplazamiento` cuántas se mostraron antes.
+    """
+    tipo = "de turno " if solo_turno else ""
+    if total is None:
+        total = len(farmacias)
     if not farmacias:
-        tipo = "de turno " if solo_turno else ""
+        if desplazamiento:
+            return f"No hay más farmacias {tipo}en {comuna}."
         return f"No se encontraron farmacias {tipo}en {comuna}."
     
-    tipo = "de turno " if solo_turno else ""
-    resultado = f"Encontré {len(farmacias)} farmacias {tipo}en {comuna}:\n\n"
-    
-    # Limitar a 10 farmacias para evitar respuestas muy largas
-    farmacias_mostradas = farmacias[:10]
+    if desplazamiento:
+        resultado = f"Farmacias {tipo}en {comuna} ({desplazamiento + 1} a {desplazamiento + len(farmacias)} de {total}):\n\n"
+    else:
+        resultado = f"Encontré {total} farmacias {tipo}en {comuna}:\n\n"
     
-    for i, farmacia in enumerate(farmacias_mostradas, 1):
-        if solo_turno:
-            nombre, direccion, hora_apertura, hora_cierre, telefono, url = farmacia
-            es_turno = True
-        else:
-            nombre, direccion, hora_apertura, hora_cierre, telefono, url, es_turno = farmacia
+    for i, farmacia in enumerate(farmacias, desplazamiento + 1):
+        nombre, direccion, hora_apertura, hora_cierre, telefono, url, es_turno = farmacia
         
         resultado += f"{i}. {nombre}"
         if es_turno:
@@ -554,8 +954,9 @@ def formatear_resultados_farmacias(farmacias, comuna, solo_turno=False):
         
         resultado += "\n"
     
-    if len(farmacias) > 10:
-        resultado += f"...y {len(farmacias) - 10} farmacias más.\n"
+    restantes = total - desplazamiento - len(farmacias)
+    if restantes > 0:
+        resultado += f"...y {restantes} farmacias más. Escribe \"ver más\" para verlas.\n"
     
     return resultado
 
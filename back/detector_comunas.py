@@ -0,0 +1,116 @@
+"""
+Detección de comunas en el texto de una consulta.
+
+Las comunas se cargan de la tabla `comunas` de farmacias_turno.db y se
+guardan en un trie de tokens normalizados (sin tildes ni mayúsculas), así
+que "nunoa" encuentra ÑUÑOA y "la florida" gana sobre "florida" por ser el
+match más largo. Recorrer la consulta cuesta O(tokens × largo máximo de un
+nombre), sin importar cuántas comunas haya. Si el trie no encuentra nada,
+DetectorComunasBD intenta con el índice de trigramas de busqueda_difusa, que
+tolera errores de tipeo ("penalolen", "puerto mont").
+"""
+import sqlite3
+import threading
+from typing import Optional
+
+from busqueda_difusa import IndiceDifuso, TIPO_COMUNA
+from normalizacion import tokenizar
+
+# Marca de fin de nombre dentro de un nodo del trie
+_FIN = ""
+
+
+class DetectorComunas:
+    """Trie de tokens con los nombres de comuna; retorna el match más largo"""
+
+    def __init__(self, nombres=()):
+        self.raiz = {}
+        self.profundidad_maxima = 0
+        for nombre in nombres:
+            self.agregar(nombre)
+
+    def agregar(self, nombre):
+        tokens = tokenizar(nombre)
+        if not tokens:
+            return
+        nodo = self.raiz
+        for token in tokens:
+            nodo = nodo.setdefault(token, {})
+        nodo[_FIN] = nombre
+        self.profundidad_maxima = max(self.profundidad_maxima, len(tokens))
+
+    def detectar(self, texto) -> Optional[str]:
+        """
+        Retorna el nombre (tal como se registró) de la comuna mencionada en
+        el texto, o None si no hay ninguna. Si hay varias, gana la de más
+        tokens y, a igual largo, la que aparece primero.
+        """
+        tokens = tokenizar(texto)
+        mejor = None
+        mejor_largo = 0
+        for inicio in range(len(tokens)):
+            nodo = self.raiz
+            for posicion in range(inicio, min(len(tokens), inicio + self.profundidad_maxima)):
+                nodo = nodo.get(tokens[posicion])
+                if nodo is None:
+                    break
+                largo = posicion - inicio + 1
+                if _FIN in nodo and largo > mejor_largo:
+                    mejor, mejor_largo = nodo[_FIN], largo
+        return mejor
+
+
+class DetectorComunasBD:
+    """
+    DetectorComunas cargado desde la tabla comunas, que se recarga solo
+    cuando la base cambió (PRAGMA data_version) desde la última consulta.
+    Con `tolerar_errores` recurre al índice difuso cuando no hay match exacto.
+    """
+
+    def __init__(self, db_path, tolerar_errores=True):
+        self.db_path = db_path
+        self.tolerar_errores = tolerar_errores
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._version = None
+        self.detector = DetectorComunas()
+        self.indice_difuso = IndiceDifuso()
+
+    def detectar(self, texto, tolerar_errores=None) -> Optional[str]:
+        """
+        Como DetectorComunas.detectar; `tolerar_errores` reemplaza para esta
+        llamada el valor dado al construir el detector.
+        """
+        if tolerar_errores is None:
+            tolerar_errores = self.tolerar_errores
+        with self._lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._version:
+                self._recargar()
+                self._version = version
+            detector, indice_difuso = self.detector, self.indice_difuso
+        comuna = detector.detectar(texto)
+        if comuna is None and tolerar_errores:
+            encontrada = indice_difuso.buscar_en_texto(texto, TIPO_COMUNA)
+            if encontrada:
+                comuna = encontrada[0]
+        return comuna
+
+    def _recargar(self):
+        try:
+            nombres = [fila[0] for fila in self.conn.execute("SELECT nombre FROM comunas")]
+        except sqlite3.OperationalError:
+            # Base aún sin tablas de referencia (ActualizaFarmacias no ha corrido)
+            nombres = [fila[0] for fila in self.conn.execute(
+                "SELECT DISTINCT comuna_nombre FROM farmacias WHERE comuna_nombre IS NOT NULL"
+            )]
+        self.detector = DetectorComunas(nombres)
+        if self.tolerar_errores:
+            try:
+                self.indice_difuso = IndiceDifuso.desde_bd(self.conn)
+            except sqlite3.OperationalError:
+                # Base creada antes del esquema 5, sin índice de trigramas
+                self.indice_difuso = IndiceDifuso.desde_nombres((TIPO_COMUNA, nombre) for nombre in nombres)
+
+    def cerrar(self):
+        self.conn.close()
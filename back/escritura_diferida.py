@@ -0,0 +1,202 @@
+"""
+Escritura diferida (write-behind) para SQLite.
+
+Las sentencias se encolan en una cola acotada y un hilo escritor las aplica
+en lotes, cada uno en una sola transacción, cuando junta `tamano_lote`
+sentencias o pasan `intervalo` segundos desde la primera pendiente. Así la
+respuesta al usuario no espera el fsync y SQLite ve pocas transacciones
+grandes en vez de muchas chicas.
+
+Si la cola se llena, quien encola espera hasta `espera_maxima` segundos y,
+si sigue llena, espera a que se escriba lo ya encolado y escribe él mismo
+de forma síncrona: nunca se descarta una escritura por falta de espacio ni
+se adelanta a las anteriores. Al cerrar (o al salir del proceso) se
+escribe todo lo pendiente.
+
+Los lectores que necesitan ver lo recién encolado usan `instantanea()`, que
+entrega las sentencias aún sin commit sin esperar a que se vacíe la cola.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+CAPACIDAD = 10000
+TAMANO_LOTE = 200
+INTERVALO_SEGUNDOS = 0.5
+ESPERA_MAXIMA_SEGUNDOS = 1.0
+
+# Marca de fin para el hilo escritor
+_FIN = object()
+
+
+class EscrituraDiferida:
+    """Cola acotada de sentencias SQL con un hilo que las escribe por lotes"""
+
+    def __init__(self, transaccion, nombre="escritura_diferida", capacidad=CAPACIDAD,
+                 tamano_lote=TAMANO_LOTE, intervalo=INTERVALO_SEGUNDOS,
+                 espera_maxima=ESPERA_MAXIMA_SEGUNDOS):
+        """
+        Args:
+            transaccion: Función sin argumentos que retorna un context manager
+                que entrega una conexión y hace commit al salir (o rollback si
+                hubo error)
+        """
+        self.transaccion = transaccion
+        self.nombre = nombre
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self.espera_maxima = espera_maxima
+        self._cola = queue.Queue(maxsize=capacidad)
+        self._lock = threading.Lock()
+        self._cerrada = False
+        # Sentencias encoladas que aún no tienen commit, en orden de llegada
+        # (id del item -> item). El escritor toma _escribiendo mientras hace
+        # commit de un lote y lo quita de aquí, así instantanea() nunca ve
+        # una sentencia a la vez en la base y como pendiente.
+        self._pendientes = {}
+        self._escribiendo = threading.Lock()
+
+        # Métricas de contrapresión y de escritura
+        self.encoladas = 0
+        self.escritas = 0
+        self.lotes = 0
+        self.maximo_en_cola = 0
+        self.esperas_cola_llena = 0
+        self.escrituras_sincronas = 0
+        self.errores = 0
+        self.perdidas = 0
+
+        self._hilo = threading.Thread(target=self._escribir, name=nombre, daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def encolar(self, sql, parametros=()):
+        """Agrega una sentencia; retorna de inmediato salvo que la cola esté llena"""
+        if self._cerrada:
+            self._escribir_sincrono([(sql, parametros)])
+            return
+        item = (sql, parametros)
+        with self._lock:
+            self._pendientes[id(item)] = item
+        try:
+            self._cola.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.esperas_cola_llena += 1
+            try:
+                self._cola.put(item, timeout=self.espera_maxima)
+            except queue.Full:
+                logging.warning(f"{self.nombre}: cola llena, se escribe de forma síncrona")
+                with self._lock:
+                    del self._pendientes[id(item)]
+                # Lo encolado antes va primero
+                self.vaciar()
+                self._escribir_sincrono([item])
+                return
+        with self._lock:
+            self.encoladas += 1
+            self.maximo_en_cola = max(self.maximo_en_cola, self._cola.qsize())
+
+    def vaciar(self):
+        """Espera a que todo lo encolado hasta ahora esté escrito"""
+        if not self._cerrada:
+            self._cola.join()
+
+    @contextmanager
+    def instantanea(self):
+        """
+        Entrega la lista de (sql, parametros) encolados que aún no tienen
+        commit. Mientras dura el bloque el escritor no confirma lotes, así
+        que lo leído de la base dentro del bloque más esta lista es el
+        estado completo, sin repetidos ni faltantes. El bloque debe ser
+        breve: una consulta, no más.
+        """
+        with self._escribiendo:
+            with self._lock:
+                pendientes = list(self._pendientes.values())
+            yield pendientes
+
+    def _escribir(self):
+        """Bucle del hilo escritor"""
+        while True:
+            primero = self._cola.get()
+            if primero is _FIN:
+                self._cola.task_done()
+                return
+            lote = [primero]
+            limite = time.monotonic() + self.intervalo
+            fin = False
+            while len(lote) < self.tamano_lote:
+                restante = limite - time.monotonic()
+                try:
+                    item = self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _FIN:
+                    fin = True
+                    break
+                lote.append(item)
+
+            with self._escribiendo:
+                self._escribir_lote(lote)
+                with self._lock:
+                    for item in lote:
+                        self._pendientes.pop(id(item), None)
+            for _ in range(len(lote) + fin):
+                self._cola.task_done()
+            if fin:
+                return
+
+    def _escribir_lote(self, lote):
+        """Escribe el lote en una transacción; si falla, reintenta una vez"""
+        for intento in range(2):
+            try:
+                with self.transaccion() as conn:
+                    for sql, parametros in lote:
+                        conn.execute(sql, parametros)
+                with self._lock:
+                    self.escritas += len(lote)
+                    self.lotes += 1
+                return
+            except Exception as e:
+                with self._lock:
+                    self.errores += 1
+                if intento == 0:
+                    logging.warning(f"{self.nombre}: error al escribir un lote de {len(lote)}, se reintenta: {e}")
+                    time.sleep(0.1)
+                else:
+                    with self._lock:
+                        self.perdidas += len(lote)
+                    logging.error(f"{self.nombre}: se perdieron {len(lote)} escrituras: {e}")
+
+    def _escribir_sincrono(self, lote):
+        with self._lock:
+            self.escrituras_sincronas += len(lote)
+        self._escribir_lote(lote)
+
+    def cerrar(self, timeout=10):
+        """Escribe lo pendiente y detiene el hilo escritor"""
+        if self._cerrada:
+            return
+        self._cerrada = True
+        self._cola.put(_FIN)
+        self._hilo.join(timeout)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'en_cola': self._cola.qsize(),
+                'capacidad': self._cola.maxsize,
+                'maximo_en_cola': self.maximo_en_cola,
+                'encoladas': self.encoladas,
+                'escritas': self.escritas,
+                'lotes': self.lotes,
+                'promedio_por_lote': self.escritas / self.lotes if self.lotes else 0.0,
+                'esperas_cola_llena': self.esperas_cola_llena,
+                'escrituras_sincronas': self.escrituras_sincronas,
+                'errores': self.errores,
+                'perdidas': self.perdidas,
+            }
@@ -0,0 +1,63 @@
+"""
+Lectura de farmacias_turno.db con o sin el esquema migrado.
+
+La base que trae el repositorio (y la de una instalación donde aún no corre
+ActualizaFarmacias.py) no tiene comuna_clave, las columnas turno_* ni
+horario_*, ni las tablas derivadas. `origen_farmacias` entrega la tabla
+farmacias tal cual si ya está migrada, o una subconsulta que calcula esas
+columnas al vuelo con las mismas funciones que usa la ingesta, así que las
+consultas se escriben una sola vez contra el esquema nuevo.
+"""
+from horarios import intervalo_apertura
+from normalizacion import normalizar_texto
+
+# Columnas que agrega migrar_esquema y que leen las consultas
+COLUMNAS_MIGRADAS = ('comuna_clave', 'turno_hora_apertura', 'turno_hora_cierre', 'horario_inicio', 'horario_fin')
+
+# Subconsulta con las columnas migradas calculadas desde las originales;
+# en el esquema anterior las filas de turno ya traen su horario de turno
+# en funcionamiento_*
+FARMACIAS_SIN_MIGRAR = """(
+    SELECT *,
+           normalizar(comuna_nombre) AS comuna_clave,
+           NULL AS turno_hora_apertura,
+           NULL AS turno_hora_cierre,
+           horario_inicio(funcionamiento_hora_apertura, funcionamiento_hora_cierre) AS horario_inicio,
+           horario_fin(funcionamiento_hora_apertura, funcionamiento_hora_cierre) AS horario_fin
+    FROM farmacias
+) AS farmacias"""
+
+
+def columnas(conn, tabla):
+    """Nombres de las columnas de la tabla (vacío si no existe)"""
+    return {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}
+
+
+def existe_tabla(conn, tabla):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (tabla,)
+    ).fetchone() is not None
+
+
+def esta_migrada(conn):
+    """Si la tabla farmacias ya tiene todas las columnas que leen las consultas"""
+    return set(COLUMNAS_MIGRADAS) <= columnas(conn, 'farmacias')
+
+
+def origen_farmacias(conn):
+    """
+    Texto para el FROM de las consultas sobre farmacias: la tabla misma o,
+    en una base sin migrar, la subconsulta FARMACIAS_SIN_MIGRAR (registra en
+    `conn` las funciones que esta necesita). En ambos casos se llama
+    `farmacias`.
+    """
+    if esta_migrada(conn):
+        return "farmacias"
+    conn.create_function("normalizar", 1, normalizar_texto, deterministic=True)
+    conn.create_function(
+        "horario_inicio", 2, lambda apertura, cierre: intervalo_apertura(apertura, cierre)[0], deterministic=True
+    )
+    conn.create_function(
+        "horario_fin", 2, lambda apertura, cierre: intervalo_apertura(apertura, cierre)[1], deterministic=True
+    )
+    return FARMACIAS_SIN_MIGRAR
@@ -0,0 +1,93 @@
+import re
+from datetime import datetime
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        ZONA_HORARIA = ZoneInfo("America/Santiago")
+    except ZoneInfoNotFoundError:
+        ZONA_HORARIA = None
+except ImportError:
+    ZONA_HORARIA = None
+
+MINUTOS_DIA = 24 * 60
+
+_HORA = re.compile(r"^\s*(\d{1,2})(?::(\d{2}))?(?::\d{2})?\s*$")
+
+
+def minutos_del_dia(texto):
+    """
+    Convierte "HH:MM" o "HH:MM:SS" en minutos desde medianoche.
+
+    Retorna None si el texto está vacío o no es una hora válida.
+    """
+    if texto is None:
+        return None
+    coincidencia = _HORA.match(str(texto))
+    if not coincidencia:
+        return None
+    horas = int(coincidencia.group(1))
+    minutos = int(coincidencia.group(2) or 0)
+    if horas > 24 or minutos > 59 or (horas == 24 and minutos):
+        return None
+    return horas * 60 + minutos
+
+
+def intervalo_apertura(apertura, cierre):
+    """
+    Convierte un horario de texto en el intervalo [inicio, fin) en minutos.
+
+    Los turnos que pasan la medianoche (por ejemplo 09:00 a 08:59) quedan
+    con fin > MINUTOS_DIA. Un cierre en el minuto :59 se considera abierto
+    hasta el minuto siguiente (23:59 cubre todo el día) y apertura igual a
+    cierre se interpreta como 24 horas. Retorna (None, None) si alguna de
+    las horas no es válida.
+    """
+    inicio = minutos_del_dia(apertura)
+    fin = minutos_del_dia(cierre)
+    if inicio is None or fin is None:
+        return None, None
+    if fin % 60 == 59:
+        fin += 1
+    if fin <= inicio:
+        fin += MINUTOS_DIA
+    return inicio, fin
+
+
+def minuto_actual():
+    """Minutos desde medianoche en la hora de Chile (o la hora local si no hay tzdata)"""
+    ahora = datetime.now(ZONA_HORARIA)
+    return ahora.hour * 60 + ahora.minute
+
+
+def resolver_minuto(valor):
+    """
+    Traduce el filtro "abierta a" de la API a minutos desde medianoche.
+
+    Acepta None (sin filtro), True o "ahora" (hora actual), un entero en
+    minutos o un texto "HH:MM". Lanza ValueError si el texto no es una hora.
+    """
+    if valor is None or valor is False:
+        return None
+    if valor is True or (isinstance(valor, str) and valor.strip().lower() == "ahora"):
+        return minuto_actual()
+    if isinstance(valor, int):
+        return valor % MINUTOS_DIA
+    minuto = minutos_del_dia(valor)
+    if minuto is None:
+        raise ValueError(f"Hora no válida: {valor}")
+    return minuto % MINUTOS_DIA
+
+
+def filtro_abierta(minuto, prefijo=""):
+    """
+    Condición SQL (y sus parámetros) para farmacias abiertas en `minuto`.
+
+    Además de los intervalos que contienen el minuto, cuenta los que
+    empezaron el día anterior y cruzan la medianoche (fin > minuto + un día).
+    """
+    sql = (
+        f"(({prefijo}horario_inicio <= ? AND {prefijo}horario_fin > ?)"
+        f" OR {prefijo}horario_fin > ?)"
+    )
+    return sql, (minuto, minuto, minuto + MINUTOS_DIA)
@@ -8,6 +8,9 @@ from langchain.vectorstores import Qdrant
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import Distance, VectorParams
 
+from cache_semantico import marcar_reindexado
+from cache_embeddings import EmbeddingsConCache
+
 # 1. Cargar variables de entorno del archivo .env
 load_dotenv()  
 
@@ -27,15 +30,15 @@ def load_and_split_pdf(pdf_path, chunk_size=1000, chunk_overlap=100):
 
 def create_embeddings_openai():
     """
-    Retorna un objeto embeddings usando OpenAI. 
+    Retorna un objeto embeddings usando OpenAI, con caché persistente de vectores.
     """
-    return OpenAIEmbeddings(model="text-embedding-ada-002")
+    return EmbeddingsConCache(OpenAIEmbeddings(model="text-embedding-ada-002"))
 
 def create_embeddings_sentence_transformer(model_name="all-MiniLM-L6-v2"):
     """
-    Retorna un objeto embeddings usando SentenceTransformers.
+    Retorna un objeto embeddings usando SentenceTransformers, con caché persistente de vectores.
     """
-    return SentenceTransformerEmbeddings(model_name=model_name)
+    return EmbeddingsConCache(SentenceTransformerEmbeddings(model_name=model_name))
 
 def get_qdrant_client(host="localhost", port=6333):
     """
@@ -98,6 +101,9 @@ def index_pdf_in_qdrant(pdf_path, collection_name="remedios_collection", embeddi
         prefer_grpc=False
     )
     print("Indexación completada.")
+
+    # Las respuestas cacheadas se generaron con el índice anterior
+    marcar_reindexado(collection_name)
     return qdrant
 
 def query_qdrant(qdrant, query, k=3):
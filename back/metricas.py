@@ -0,0 +1,193 @@
+"""
+Métricas en el formato de texto de Prometheus.
+
+El camino de cada solicitud solo suma contadores y cubetas en memoria (un
+lock y unas pocas operaciones). Los valores que viven en otros objetos
+(sesiones abiertas, cachés, colas de escritura, antigüedad de los datos) se
+leen recién al exportar, con indicadores calculados o colectores.
+
+Los histogramas reutilizan trazas.Histograma, que guarda milisegundos; al
+exportar se convierten a segundos, como espera Prometheus.
+"""
+import logging
+import threading
+
+from trazas import Histograma, CUBETAS_MS
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def formatear_etiquetas(nombres, valores, extra=None):
+    pares = [f'{nombre}="{escapar(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        pares.extend(f'{nombre}="{escapar(valor)}"' for nombre, valor in extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def formatear_numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def lineas_histograma(nombre, etiquetas, valores, histograma):
+    """Líneas _bucket, _sum y _count de un histograma en milisegundos, en segundos"""
+    lineas = []
+    for limite, acumulado in histograma.acumulados():
+        le = "+Inf" if limite == float("inf") else f"{limite / 1000:g}"
+        lineas.append(f"{nombre}_bucket{formatear_etiquetas(etiquetas, valores, [('le', le)])} {acumulado}")
+    lineas.append(f"{nombre}_sum{formatear_etiquetas(etiquetas, valores)} {histograma.suma_ms / 1000!r}")
+    lineas.append(f"{nombre}_count{formatear_etiquetas(etiquetas, valores)} {histograma.cuenta}")
+    return lineas
+
+
+def lineas_familia(nombre, tipo, ayuda, muestras):
+    """Líneas de una métrica calculada al exportar; muestras = [(dict de etiquetas, valor)]"""
+    lineas = [f"# HELP {nombre} {escapar(ayuda)}", f"# TYPE {nombre} {tipo}"]
+    for etiquetas, valor in muestras:
+        lineas.append(f"{nombre}{formatear_etiquetas(list(etiquetas), list(etiquetas.values()))} {formatear_numero(valor)}")
+    return lineas
+
+
+def colector_etapas(latencias):
+    """Colector con los histogramas por etapa de trazas.RegistroLatencias"""
+    def colector(prefijo):
+        nombre = f"{prefijo}_etapa_duracion_segundos" if prefijo else "etapa_duracion_segundos"
+        lineas = [
+            f"# HELP {nombre} Duración de cada etapa de las consultas del chat",
+            f"# TYPE {nombre} histogram",
+        ]
+        for etapa, histograma in sorted(latencias.instantanea().items()):
+            lineas.extend(lineas_histograma(nombre, ("etapa",), (etapa,), histograma))
+        return lineas
+    return colector
+
+
+class Metrica:
+    """Base de las métricas con etiquetas: un valor por combinación de etiquetas"""
+
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def encabezado(self):
+        return [f"# HELP {self.nombre} {escapar(self.ayuda)}", f"# TYPE {self.nombre} {self.tipo}"]
+
+    def exportar(self):
+        with self._lock:
+            valores = sorted(self._valores.items())
+        lineas = self.encabezado()
+        for etiquetas, valor in valores:
+            lineas.append(f"{self.nombre}{formatear_etiquetas(self.etiquetas, etiquetas)} {formatear_numero(valor)}")
+        return lineas
+
+
+class Contador(Metrica):
+    tipo = "counter"
+
+    def sumar(self, *etiquetas, valor=1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+
+class Indicador(Metrica):
+    """Valor que sube y baja; con `funcion` se calcula al exportar"""
+
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+
+    def sumar(self, *etiquetas, valor=1):
+        with self._lock:
+            self._valores[etiquetas] = self._valores.get(etiquetas, 0) + valor
+
+    def fijar(self, *etiquetas, valor):
+        with self._lock:
+            self._valores[etiquetas] = valor
+
+    def exportar(self):
+        if self.funcion is not None:
+            self.fijar(valor=self.funcion())
+        return super().exportar()
+
+
+class HistogramaEtiquetado(Metrica):
+    """Histograma de duraciones (en milisegundos) por combinación de etiquetas"""
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_MS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.cubetas = cubetas
+
+    def observar(self, *etiquetas, ms):
+        with self._lock:
+            histograma = self._valores.get(etiquetas)
+            if histograma is None:
+                histograma = self._valores[etiquetas] = Histograma(self.cubetas)
+            histograma.observar(ms)
+
+    def exportar(self):
+        with self._lock:
+            valores = sorted(self._valores.items())
+            lineas = self.encabezado()
+            for etiquetas, histograma in valores:
+                lineas.extend(lineas_histograma(self.nombre, self.etiquetas, etiquetas, histograma))
+        return lineas
+
+
+class RegistroMetricas:
+    """Métricas del proceso y colectores que se consultan al exportar"""
+
+    def __init__(self, prefijo=""):
+        self.prefijo = prefijo
+        self._metricas = []
+        self._colectores = []
+
+    def _nombre(self, nombre):
+        return f"{self.prefijo}_{nombre}" if self.prefijo else nombre
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._agregar(Contador(self._nombre(nombre), ayuda, etiquetas))
+
+    def indicador(self, nombre, ayuda, etiquetas=(), funcion=None):
+        return self._agregar(Indicador(self._nombre(nombre), ayuda, etiquetas, funcion))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_MS):
+        return self._agregar(HistogramaEtiquetado(self._nombre(nombre), ayuda, etiquetas, cubetas))
+
+    def agregar_colector(self, colector):
+        """
+        `colector(prefijo)` retorna líneas ya formateadas (con sus # HELP y
+        # TYPE); se llama en cada exportación.
+        """
+        self._colectores.append(colector)
+
+    def _agregar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def exportar(self):
+        lineas = []
+        for metrica in self._metricas:
+            try:
+                lineas.extend(metrica.exportar())
+            except Exception as e:
+                logging.warning(f"No se pudo exportar la métrica {metrica.nombre}: {e}")
+        for colector in self._colectores:
+            try:
+                lineas.extend(colector(self.prefijo))
+            except Exception as e:
+                logging.warning(f"Error en un colector de métricas: {e}")
+        return "\n".join(lineas) + "\n"
@@ -0,0 +1,25 @@
+import re
+import unicodedata
+
+_ESPACIOS = re.compile(r"\s+")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def normalizar_texto(texto):
+    """
+    Normaliza un texto para comparaciones: minúsculas, sin tildes ni
+    diéresis (ñ -> n) y con los espacios colapsados.
+
+    Es la forma en que se guarda farmacias.comuna_clave / comunas.clave, así
+    que cualquier búsqueda por comuna debe pasar por esta función.
+    """
+    if texto is None:
+        return None
+    descompuesto = unicodedata.normalize("NFKD", str(texto).lower())
+    sin_tildes = "".join(c for c in descompuesto if not unicodedata.combining(c))
+    return _ESPACIOS.sub(" ", sin_tildes).strip()
+
+
+def tokenizar(texto):
+    """Tokens normalizados, sin puntuación ("O'Higgins" -> ["o", "higgins"])"""
+    return _TOKEN.findall(normalizar_texto(texto) or "")
@@ -0,0 +1,435 @@
+"""
+Registro de los clientes caros de construir (LLM, embeddings, Qdrant).
+
+Cada recurso se crea una sola vez por proceso, la primera vez que se pide,
+y se comparte entre hilos. Se reconstruye solo cuando cambia su
+configuración (variables de entorno), cuando se reconstruye algo de lo que
+depende o cuando se invalida tras un error de conexión. Un recurso
+reemplazado que aún está en uso por usar/ausar/transmitir (en otro hilo o
+tarea) no se cierra hasta que el último de esos usos termina.
+
+Los clientes de OpenAI y Qdrant reciben también su variante asíncrona
+(httpx.AsyncClient, AsyncQdrantClient), que usan ainvoke/asimilarity_search
+desde consultas_llm.aprocesar_consulta.
+"""
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+
+import httpx
+import openai
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_qdrant import Qdrant
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.http.exceptions import ResponseHandlingException
+
+from cache_embeddings import EmbeddingsConCache
+
+# Variables de entorno reconocidas y su valor por defecto
+CONFIGURACION_POR_DEFECTO = {
+    'OPENAI_API_KEY': None,
+    'OPENAI_BASE_URL': None,
+    'LLM_MODELO': 'gpt-3.5-turbo',
+    'EMBEDDINGS_MODELO': 'text-embedding-ada-002',
+    'QDRANT_URL': 'http://localhost:6333',
+    'QDRANT_COLECCION': 'remedios_collection',
+    'HTTP_MAX_CONEXIONES': '20',
+    # Modelo local de sentence-transformers para el router de intenciones (opcional)
+    'ROUTER_EMBEDDINGS_MODELO': None,
+    # Similitud mínima del caché semántico (por defecto cache_semantico.UMBRAL_SIMILITUD)
+    'CACHE_SEMANTICO_UMBRAL': None,
+}
+
+# Errores que indican una conexión rota: el recurso se descarta y se reintenta
+ERRORES_CONEXION = (
+    httpx.TransportError,
+    openai.APIConnectionError,
+    ResponseHandlingException,
+    ConnectionError,
+)
+
+# Cliente asíncrono -> event loop en que se usó; sus conexiones pertenecen a
+# ese loop y deben cerrarse en él (ver cerrar_cliente_async)
+_loops_clientes = weakref.WeakKeyDictionary()
+
+
+def leer_configuracion():
+    """Lee la configuración actual desde las variables de entorno"""
+    return {
+        clave: os.environ.get(clave, por_defecto)
+        for clave, por_defecto in CONFIGURACION_POR_DEFECTO.items()
+    }
+
+
+class DefinicionRecurso:
+    """Cómo construir un recurso: fábrica, dependencias y configuración usada"""
+
+    def __init__(self, fabrica, dependencias=(), claves_config=(), cerrar=None):
+        """
+        Args:
+            fabrica: Función fabrica(config, *dependencias) -> recurso
+            dependencias (tuple): Nombres de los recursos que recibe la fábrica
+            claves_config (tuple): Claves de configuración que usa la fábrica
+            cerrar: Función opcional cerrar(recurso) para liberar conexiones
+        """
+        self.fabrica = fabrica
+        self.dependencias = tuple(dependencias)
+        self.claves_config = tuple(claves_config)
+        self.cerrar = cerrar
+
+
+class RegistroRecursos:
+    """Crea, comparte y reconstruye los recursos registrados"""
+
+    def __init__(self, definiciones=None, leer_config=leer_configuracion):
+        self._definiciones = dict(definiciones or {})
+        self._leer_config = leer_config
+        # nombre -> (firma, recurso); la firma incluye la configuración usada
+        # y la identidad de las dependencias con que se construyó
+        self._recursos = {}
+        # id(recurso) -> usos en curso, y recursos ya reemplazados que se
+        # cierran cuando sus usos llegan a 0: id(recurso) -> (nombre, recurso)
+        self._usos = {}
+        self._retirados = {}
+        self._lock = threading.RLock()
+
+    def registrar(self, nombre, fabrica, dependencias=(), claves_config=(), cerrar=None):
+        """Registra (o reemplaza) la fábrica de un recurso; el anterior se descarta"""
+        with self._lock:
+            self._definiciones[nombre] = DefinicionRecurso(fabrica, dependencias, claves_config, cerrar)
+            self._descartar(nombre)
+
+    def obtener(self, nombre):
+        """Retorna el recurso, construyéndolo si falta o si su firma cambió"""
+        return self._obtener(nombre, self._leer_config())
+
+    def _obtener(self, nombre, config):
+        definicion = self._definiciones.get(nombre)
+        if definicion is None:
+            raise KeyError(f"Recurso no registrado: {nombre}")
+
+        dependencias = [self._obtener(dependencia, config) for dependencia in definicion.dependencias]
+        firma = (
+            tuple(config.get(clave) for clave in definicion.claves_config),
+            tuple(id(dependencia) for dependencia in dependencias),
+        )
+
+        actual = self._recursos.get(nombre)
+        if actual is not None and actual[0] == firma:
+            return actual[1]
+
+        with self._lock:
+            actual = self._recursos.get(nombre)
+            if actual is not None and actual[0] == firma:
+                return actual[1]
+            if actual is not None:
+                logging.info(f"Reconstruyendo recurso '{nombre}' (cambió su configuración o una dependencia)")
+                self._retirar(nombre, actual[1])
+            recurso = definicion.fabrica(config, *dependencias)
+            self._recursos[nombre] = (firma, recurso)
+            return recurso
+
+    def existente(self, nombre):
+        """Retorna el recurso si ya se construyó, o None; nunca lo construye"""
+        actual = self._recursos.get(nombre)
+        return actual[1] if actual is not None else None
+
+    def invalidar(self, nombre=None):
+        """
+        Descarta un recurso (o todos si nombre es None); se reconstruye en el
+        próximo obtener(). Sus dependencias, que pueden compartir otros
+        recursos (como los clientes http), se conservan; lo que depende de él
+        se reconstruye solo porque cambia su firma. Si está en uso, se
+        cierra cuando termina el último uso.
+        """
+        with self._lock:
+            if nombre is None:
+                for nombre_recurso in list(self._recursos):
+                    self._descartar(nombre_recurso)
+                return
+            self._descartar(nombre)
+
+    def usar(self, nombre, funcion):
+        """
+        Ejecuta funcion(recurso). Si falla por un error de conexión, invalida
+        el recurso y reintenta una vez con uno nuevo.
+        """
+        try:
+            with self._prestado(nombre) as recurso:
+                return funcion(recurso)
+        except ERRORES_CONEXION as e:
+            logging.warning(f"Error de conexión usando '{nombre}', se reconstruye: {e}")
+            self.invalidar(nombre)
+            with self._prestado(nombre) as recurso:
+                return funcion(recurso)
+
+    async def ausar(self, nombre, funcion):
+        """Como usar(), para una función que retorna un awaitable"""
+        try:
+            with self._prestado(nombre, self._obtener_en_loop) as recurso:
+                return await funcion(recurso)
+        except ERRORES_CONEXION as e:
+            logging.warning(f"Error de conexión usando '{nombre}', se reconstruye: {e}")
+            self.invalidar(nombre)
+            with self._prestado(nombre, self._obtener_en_loop) as recurso:
+                return await funcion(recurso)
+
+    def transmitir(self, nombre, funcion):
+        """
+        Como usar(), para una función que retorna un iterador (por ejemplo
+        llm.stream). Si la conexión falla antes del primer elemento, el
+        recurso se invalida y se reintenta una vez; una vez entregado algo a
+        quien consume, los errores se propagan para no repetir fragmentos.
+        El recurso cuenta como en uso hasta que la transmisión termina.
+        """
+        entregado = False
+        try:
+            with self._prestado(nombre) as recurso:
+                for fragmento in funcion(recurso):
+                    entregado = True
+                    yield fragmento
+            return
+        except ERRORES_CONEXION as e:
+            if entregado:
+                raise
+            logging.warning(f"Error de conexión iniciando la transmisión de '{nombre}', se reconstruye: {e}")
+            self.invalidar(nombre)
+        with self._prestado(nombre) as recurso:
+            yield from funcion(recurso)
+
+    @contextmanager
+    def _prestado(self, nombre, obtener=None):
+        """
+        Entrega el recurso marcándolo en uso, junto con sus dependencias,
+        mientras dura el bloque: si entretanto se reemplaza, su cierre espera
+        a que el bloque termine.
+        """
+        obtener = obtener or self.obtener
+        while True:
+            recurso = obtener(nombre)
+            with self._lock:
+                actual = self._recursos.get(nombre)
+                # Si otro hilo lo reemplazó justo después de obtenerlo, se pide de nuevo
+                if actual is not None and actual[1] is recurso:
+                    prestados = self._tomar(nombre)
+                    break
+        try:
+            yield recurso
+        finally:
+            self._soltar(prestados)
+
+    def _tomar(self, nombre):
+        """Suma un uso al recurso y a sus dependencias; retorna los recursos tomados"""
+        prestados = []
+        pendientes = [nombre]
+        while pendientes:
+            nombre_recurso = pendientes.pop()
+            actual = self._recursos.get(nombre_recurso)
+            if actual is None:
+                continue
+            self._usos[id(actual[1])] = self._usos.get(id(actual[1]), 0) + 1
+            prestados.append(actual[1])
+            pendientes.extend(self._definiciones[nombre_recurso].dependencias)
+        return prestados
+
+    def _soltar(self, prestados):
+        """Resta el uso tomado y cierra los recursos retirados que quedan libres"""
+        with self._lock:
+            for recurso in prestados:
+                usos = self._usos.get(id(recurso), 0) - 1
+                if usos > 0:
+                    self._usos[id(recurso)] = usos
+                    continue
+                self._usos.pop(id(recurso), None)
+                retirado = self._retirados.pop(id(recurso), None)
+                if retirado is not None:
+                    self._cerrar(*retirado)
+
+    def _obtener_en_loop(self, nombre):
+        """obtener() que además asocia el recurso y sus dependencias al loop actual"""
+        recurso = self.obtener(nombre)
+        loop = asyncio.get_running_loop()
+        pendientes = [nombre]
+        while pendientes:
+            nombre_recurso = pendientes.pop()
+            actual = self._recursos.get(nombre_recurso)
+            if actual is None:
+                continue
+            try:
+                _loops_clientes[actual[1]] = loop
+            except TypeError:
+                pass
+            pendientes.extend(self._definiciones[nombre_recurso].dependencias)
+        return recurso
+
+    def precalentar(self, nombres=None, verificar=None):
+        """
+        Construye los recursos indicados (o todos) antes de la primera
+        consulta. `verificar` es un diccionario opcional nombre -> función
+        que recibe el recurso y abre sus conexiones. Nunca lanza excepciones:
+        los errores solo se registran y el recurso se construye al usarse.
+        """
+        nombres = list(nombres or self._definiciones)
+        verificar = verificar or {}
+        for nombre in nombres:
+            try:
+                recurso = self.obtener(nombre)
+                if nombre in verificar:
+                    verificar[nombre](recurso)
+                logging.info(f"Recurso '{nombre}' precalentado")
+            except Exception as e:
+                logging.warning(f"No se pudo precalentar '{nombre}': {e}")
+                self.invalidar(nombre)
+
+    def cerrar(self):
+        """Cierra las conexiones de todos los recursos construidos, aunque estén en uso"""
+        with self._lock:
+            for nombre in list(self._recursos):
+                self._cerrar(nombre, self._recursos.pop(nombre)[1])
+            for nombre, recurso in self._retirados.values():
+                self._cerrar(nombre, recurso)
+            self._retirados.clear()
+            self._usos.clear()
+
+    def _descartar(self, nombre):
+        actual = self._recursos.pop(nombre, None)
+        if actual is not None:
+            self._retirar(nombre, actual[1])
+
+    def _retirar(self, nombre, recurso):
+        """Cierra un recurso reemplazado, o lo deja pendiente si aún está en uso"""
+        if id(recurso) in self._usos:
+            self._retirados[id(recurso)] = (nombre, recurso)
+        else:
+            self._cerrar(nombre, recurso)
+
+    def _cerrar(self, nombre, recurso):
+        definicion = self._definiciones.get(nombre)
+        if definicion and definicion.cerrar:
+            try:
+                definicion.cerrar(recurso)
+            except Exception as e:
+                logging.warning(f"Error cerrando recurso '{nombre}': {e}")
+
+
+def crear_cliente_http(config):
+    """Cliente httpx con pool de conexiones keep-alive compartido por los clientes OpenAI"""
+    maximo = int(config['HTTP_MAX_CONEXIONES'])
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=maximo, max_keepalive_connections=maximo),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
+
+def crear_cliente_http_async(config):
+    """Como crear_cliente_http, para las llamadas asíncronas (ainvoke, aembed_query)"""
+    maximo = int(config['HTTP_MAX_CONEXIONES'])
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=maximo, max_keepalive_connections=maximo),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
+
+def cerrar_cliente_async(cliente):
+    """
+    Cierra un cliente asíncrono en el event loop en que se usó. Si ese loop
+    corre en otro hilo, el cierre se le encarga con run_coroutine_threadsafe;
+    si ya terminó, sus conexiones murieron con él y no hay nada que cerrar.
+    Un cliente que nunca se usó no tiene conexiones y se cierra en un loop
+    propio.
+    """
+    cierre = getattr(cliente, 'aclose', None) or cliente.close
+    loop = _loops_clientes.pop(cliente, None)
+    try:
+        actual = asyncio.get_running_loop()
+    except RuntimeError:
+        actual = None
+
+    if loop is None:
+        if actual is not None:
+            actual.create_task(cierre())
+        else:
+            asyncio.run(cierre())
+    elif loop is actual:
+        loop.create_task(cierre())
+    elif not loop.is_closed() and loop.is_running():
+        asyncio.run_coroutine_threadsafe(cierre(), loop)
+    else:
+        logging.info("El event loop del cliente asíncrono ya terminó; se omite su cierre")
+
+
+def crear_llm(config, cliente_http, cliente_http_async):
+    return ChatOpenAI(
+        model=config['LLM_MODELO'],
+        temperature=0,
+        api_key=config['OPENAI_API_KEY'],
+        base_url=config['OPENAI_BASE_URL'],
+        http_client=cliente_http,
+        http_async_client=cliente_http_async,
+    )
+
+
+def crear_embeddings(config, cliente_http, cliente_http_async):
+    """Embeddings de OpenAI con caché persistente de vectores (ver cache_embeddings)"""
+    return EmbeddingsConCache(OpenAIEmbeddings(
+        model=config['EMBEDDINGS_MODELO'],
+        api_key=config['OPENAI_API_KEY'],
+        base_url=config['OPENAI_BASE_URL'],
+        http_client=cliente_http,
+        http_async_client=cliente_http_async,
+    ))
+
+
+def crear_cliente_qdrant(config):
+    return QdrantClient(url=config['QDRANT_URL'])
+
+
+def crear_cliente_qdrant_async(config):
+    return AsyncQdrantClient(url=config['QDRANT_URL'])
+
+
+def crear_qdrant(config, cliente_qdrant, cliente_qdrant_async, embeddings):
+    return Qdrant(
+        client=cliente_qdrant,
+        async_client=cliente_qdrant_async,
+        collection_name=config['QDRANT_COLECCION'],
+        embeddings=embeddings,
+    )
+
+
+def crear_registro():
+    """Registro con las definiciones por defecto de los clientes del chat"""
+    claves_openai = ('OPENAI_API_KEY', 'OPENAI_BASE_URL')
+    return RegistroRecursos({
+        'http': DefinicionRecurso(
+            crear_cliente_http, claves_config=('HTTP_MAX_CONEXIONES',), cerrar=lambda cliente: cliente.close()
+        ),
+        'http_async': DefinicionRecurso(
+            crear_cliente_http_async, claves_config=('HTTP_MAX_CONEXIONES',), cerrar=cerrar_cliente_async
+        ),
+        'llm': DefinicionRecurso(
+            crear_llm, dependencias=('http', 'http_async'), claves_config=('LLM_MODELO',) + claves_openai
+        ),
+        'embeddings': DefinicionRecurso(
+            crear_embeddings, dependencias=('http', 'http_async'),
+            claves_config=('EMBEDDINGS_MODELO',) + claves_openai,
+            cerrar=lambda embeddings: embeddings.cerrar()
+        ),
+        'cliente_qdrant': DefinicionRecurso(
+            crear_cliente_qdrant, claves_config=('QDRANT_URL',), cerrar=lambda cliente: cliente.close()
+        ),
+        'cliente_qdrant_async': DefinicionRecurso(
+            crear_cliente_qdrant_async, claves_config=('QDRANT_URL',), cerrar=cerrar_cliente_async
+        ),
+        'qdrant': DefinicionRecurso(
+            crear_qdrant, dependencias=('cliente_qdrant', 'cliente_qdrant_async', 'embeddings'),
+            claves_config=('QDRANT_COLECCION',)
+        ),
+    })
+
+
+# Registro compartido por todo el proceso
+recursos = crear_registro()
@@ -0,0 +1,269 @@
+"""
+Enrutamiento de consultas del chat: farmacias, medicamentos u otra cosa.
+
+La consulta se normaliza una sola vez y todas las palabras clave se buscan
+en una sola pasada con una expresión regular compilada. Cada intención suma
+los pesos de sus palabras y gana la de mayor puntaje, sin importar el orden
+en que se revisen ("dónde compro un antibiótico" empata y se resuelve como
+medicamento). Nombrar una comuna suma a farmacias solo si ya hay alguna
+palabra de farmacias o si no hay ninguna palabra clave: varias comunas son
+palabras comunes (Pica, Tomé, Retiro, Primavera) y "me pica la garganta,
+qué remedio tomo" debe seguir siendo una consulta de medicamentos. Si
+ninguna palabra clave aparece, se puede consultar un clasificador local por
+embeddings.
+"""
+import logging
+import re
+import threading
+from typing import Optional
+
+import numpy as np
+
+from normalizacion import normalizar_texto
+
+FARMACIA = "farmacia"
+MEDICAMENTO = "medicamento"
+OTRA = "otra"
+# "ver más": siguiente página de la última búsqueda de farmacias
+VER_MAS = "ver_mas"
+
+# Palabra clave normalizada (sin tildes) -> (intención, peso). Los plurales
+# se aceptan con una "s" final opcional.
+PALABRAS_CLAVE = {
+    "farmacia": (FARMACIA, 3),
+    "turno": (FARMACIA, 3),
+    "abierta": (FARMACIA, 2),
+    "abierto": (FARMACIA, 2),
+    "cerca": (FARMACIA, 2),
+    "cercana": (FARMACIA, 2),
+    "cercano": (FARMACIA, 2),
+    "direccion": (FARMACIA, 2),
+    "ubicacion": (FARMACIA, 2),
+    "donde": (FARMACIA, 1),
+    "comprar": (FARMACIA, 1),
+    "compro": (FARMACIA, 1),
+    "medicamento": (MEDICAMENTO, 2),
+    "medicina": (MEDICAMENTO, 2),
+    "remedio": (MEDICAMENTO, 2),
+    "pastilla": (MEDICAMENTO, 2),
+    "comprimido": (MEDICAMENTO, 2),
+    "para que sirve": (MEDICAMENTO, 3),
+    "efectos secundarios": (MEDICAMENTO, 3),
+    "efecto secundario": (MEDICAMENTO, 3),
+    "contraindicaciones": (MEDICAMENTO, 3),
+    "dosis": (MEDICAMENTO, 2),
+    "tratamiento": (MEDICAMENTO, 2),
+    "droga": (MEDICAMENTO, 2),
+    "farmaco": (MEDICAMENTO, 2),
+    "antibiotico": (MEDICAMENTO, 2),
+    "analgesico": (MEDICAMENTO, 2),
+    "jarabe": (MEDICAMENTO, 2),
+    "tratar": (MEDICAMENTO, 1),
+    "cura": (MEDICAMENTO, 1),
+    "curar": (MEDICAMENTO, 1),
+    "sintoma": (MEDICAMENTO, 1),
+    "dolor": (MEDICAMENTO, 1),
+    "duele": (MEDICAMENTO, 1),
+    "fiebre": (MEDICAMENTO, 1),
+    "tos": (MEDICAMENTO, 1),
+}
+
+# Puntaje que suma a farmacias mencionar una comuna (ver enrutar: no cuenta
+# si solo hay palabras de medicamentos)
+PESO_COMUNA = 3
+
+_PATRON = re.compile(
+    r"\b(" + "|".join(
+        re.escape(palabra) + ("s?" if " " not in palabra and not palabra.endswith("s") else "")
+        for palabra in sorted(PALABRAS_CLAVE, key=len, reverse=True)
+    ) + r")\b"
+)
+
+_VER_MAS = re.compile(
+    r"^(?:ver|mostrar|muestrame|muestra|dame|quiero ver)? ?"
+    r"(?:mas|las siguientes|siguientes|otras)(?: farmacias)?(?: por favor)?$"
+)
+_PALABRAS = re.compile(r"[a-z0-9]+")
+
+
+def _palabra_base(coincidencia):
+    """Palabra clave a la que corresponde el texto encontrado (plural -> singular)"""
+    if coincidencia in PALABRAS_CLAVE:
+        return coincidencia
+    return coincidencia[:-1]
+
+
+class Intencion:
+    """Resultado del enrutamiento de una consulta"""
+
+    def __init__(self, tipo, comuna=None, turno=False, puntajes=None, origen="palabras_clave"):
+        self.tipo = tipo
+        self.comuna = comuna
+        self.turno = turno
+        self.puntajes = puntajes or {}
+        # "palabras_clave" o "embeddings", según qué decidió la intención
+        self.origen = origen
+
+    def __repr__(self):
+        return f"Intencion({self.tipo!r}, comuna={self.comuna!r}, turno={self.turno}, puntajes={self.puntajes})"
+
+
+class RouterIntenciones:
+    """Clasifica consultas con las palabras clave y, opcionalmente, un clasificador local"""
+
+    def __init__(self, detector_comunas=None, clasificador=None):
+        """
+        Args:
+            detector_comunas: Objeto con detectar(texto, tolerar_errores=...)
+                (ver DetectorComunasBD); sin él no se detectan comunas
+            clasificador: Objeto opcional con clasificar(texto) -> intención o
+                None, usado solo cuando ninguna palabra clave aparece
+        """
+        self.detector_comunas = detector_comunas
+        self.clasificador = clasificador
+
+    def enrutar(self, query) -> Intencion:
+        texto = normalizar_texto(query) or ""
+        if _VER_MAS.match(" ".join(_PALABRAS.findall(texto))):
+            return Intencion(VER_MAS)
+
+        puntajes = {FARMACIA: 0, MEDICAMENTO: 0}
+        turno = False
+        for coincidencia in _PATRON.finditer(texto):
+            palabra = _palabra_base(coincidencia.group(1))
+            intencion, peso = PALABRAS_CLAVE[palabra]
+            puntajes[intencion] += peso
+            turno = turno or palabra == "turno"
+
+        # El trie exacto es barato; la búsqueda difusa solo se paga si la
+        # consulta resulta ser de farmacias
+        comuna = self._detectar_comuna(texto, tolerar_errores=False)
+        if comuna and (puntajes[FARMACIA] > 0 or puntajes[MEDICAMENTO] == 0):
+            puntajes[FARMACIA] += PESO_COMUNA
+
+        origen = "palabras_clave"
+        if puntajes[FARMACIA] == 0 and puntajes[MEDICAMENTO] == 0:
+            tipo = self._clasificar(query)
+            origen = "embeddings" if tipo != OTRA else origen
+        elif puntajes[FARMACIA] > puntajes[MEDICAMENTO]:
+            tipo = FARMACIA
+        else:
+            # Ante un empate se prefiere explicar el medicamento antes que
+            # pedir una comuna que el usuario no mencionó
+            tipo = MEDICAMENTO
+
+        if tipo == FARMACIA and comuna is None:
+            comuna = self._detectar_comuna(texto, tolerar_errores=True)
+        return Intencion(tipo, comuna, turno, puntajes, origen)
+
+    def _detectar_comuna(self, texto, tolerar_errores):
+        if self.detector_comunas is None:
+            return None
+        return self.detector_comunas.detectar(texto, tolerar_errores=tolerar_errores)
+
+    def _clasificar(self, query):
+        if self.clasificador is None:
+            return OTRA
+        try:
+            return self.clasificador.clasificar(query) or OTRA
+        except Exception as e:
+            logging.warning(f"Error en el clasificador de intenciones: {e}")
+            return OTRA
+
+
+# Frases de ejemplo por intención para el clasificador por embeddings
+EJEMPLOS_POR_DEFECTO = {
+    FARMACIA: [
+        "necesito una farmacia abierta",
+        "qué local atiende esta noche en mi barrio",
+        "dónde queda la botica más próxima",
+        "busco un lugar para comprar remedios ahora",
+    ],
+    MEDICAMENTO: [
+        "me duele mucho la cabeza qué puedo tomar",
+        "el ibuprofeno me puede caer mal al estómago",
+        "cada cuántas horas se toma el paracetamol",
+        "tengo fiebre y tos seca",
+        "es seguro mezclar alcohol con antialérgicos",
+    ],
+    OTRA: [
+        "hola cómo estás",
+        "cuál es la capital de francia",
+        "cuéntame un chiste",
+        "gracias por la ayuda",
+    ],
+}
+
+
+class ClasificadorEmbeddings:
+    """
+    Clasificador por centroides sobre un modelo local de sentence-transformers:
+    la consulta se asigna a la intención cuyo centroide de ejemplos es el más
+    similar, si la similitud coseno supera `umbral`. El modelo se carga en la
+    primera consulta.
+    """
+
+    def __init__(self, modelo, ejemplos=None, umbral=0.45):
+        self.nombre_modelo = modelo
+        self.ejemplos = ejemplos or EJEMPLOS_POR_DEFECTO
+        self.umbral = umbral
+        self._modelo = None
+        self._intenciones = None
+        self._centroides = None
+        self._lock = threading.Lock()
+
+    def _cargar(self):
+        from sentence_transformers import SentenceTransformer
+
+        self._modelo = SentenceTransformer(self.nombre_modelo)
+        self._intenciones = list(self.ejemplos)
+        centroides = []
+        for intencion in self._intenciones:
+            vectores = self._modelo.encode(self.ejemplos[intencion], normalize_embeddings=True)
+            centroide = np.mean(vectores, axis=0)
+            centroides.append(centroide / np.linalg.norm(centroide))
+        self._centroides = np.vstack(centroides)
+
+    def clasificar(self, texto) -> Optional[str]:
+        with self._lock:
+            if self._modelo is None:
+                self._cargar()
+        vector = self._modelo.encode([texto], normalize_embeddings=True)[0]
+        similitudes = self._centroides @ vector
+        posicion = int(np.argmax(similitudes))
+        if similitudes[posicion] < self.umbral:
+            return None
+        return self._intenciones[posicion]
+
+
+# Consultas y la intención esperada, para revisar el router contra la base
+# real tras cambiar pesos o palabras clave
+CASOS_REGRESION = [
+    ("me pica la piel, qué remedio tomo", MEDICAMENTO),
+    ("qué medicamento tomo si me pica la garganta", MEDICAMENTO),
+    ("dosis de paracetamol para la fiebre en navidad", MEDICAMENTO),
+    ("jarabe para la tos, estoy en el retiro", MEDICAMENTO),
+    ("farmacias en pica", FARMACIA),
+    ("farmacia de turno en tome", FARMACIA),
+    ("providencia", FARMACIA),
+    ("dónde compro un antibiótico", MEDICAMENTO),
+    ("farmacias abiertas ahora en las condes", FARMACIA),
+    ("hola, cómo estás", OTRA),
+]
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+
+    from detector_comunas import DetectorComunasBD
+
+    db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Base', 'farmacias_turno.db')
+    router = RouterIntenciones(DetectorComunasBD(db_path))
+    fallos = 0
+    for consulta, esperada in CASOS_REGRESION:
+        intencion = router.enrutar(consulta)
+        estado = "ok" if intencion.tipo == esperada else "FALLA"
+        fallos += intencion.tipo != esperada
+        print(f"{estado:<6} {consulta!r}: {intencion} (esperada {esperada})")
+    sys.exit(1 if fallos else 0)
@@ -0,0 +1,117 @@
+"""
+Servidor HTTP local que reemplaza a midas.minsal.cl para pruebas offline.
+
+Sirve los payloads grabados por ClienteMinsal (un archivo <endpoint>.json por
+feed, por ejemplo getLocales.php.json) bajo /farmacia_v2/WS/<endpoint>, con
+ETag, Last-Modified, respuestas 304 y compresión gzip. Opcionalmente agrega
+latencia y errores 503 para simular un upstream lento.
+
+Uso:
+    python servidor_minsal_local.py --directorio grabaciones --puerto 8765
+    MINSAL_BASE_URL=http://localhost:8765/farmacia_v2/WS python ActualizaFarmacias.py
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ManejadorMinsal(BaseHTTPRequestHandler):
+    """Responde los feeds grabados con soporte de peticiones condicionales"""
+
+    directorio = "grabaciones"
+    retardo = 0.0
+    tasa_error = 0.0
+
+    def do_GET(self):
+        if self.retardo:
+            time.sleep(self.retardo)
+        if random.random() < self.tasa_error:
+            self.send_error(503, "Error simulado")
+            return
+
+        nombre = self.path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        ruta = os.path.join(self.directorio, nombre + ".json")
+        if not nombre or not os.path.isfile(ruta):
+            self.send_error(404, "Payload no grabado")
+            return
+
+        with open(ruta, "rb") as archivo:
+            contenido = archivo.read()
+        etag = '"' + hashlib.sha1(contenido).hexdigest() + '"'
+        modificado = int(os.path.getmtime(ruta))
+        last_modified = formatdate(modificado, usegmt=True)
+
+        if self._no_modificado(etag, modificado):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            contenido = gzip.compress(contenido)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def _no_modificado(self, etag, modificado):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [valor.strip() for valor in if_none_match.split(",")]
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return modificado <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+def iniciar_servidor(directorio, puerto=0, retardo=0.0, tasa_error=0.0):
+    """
+    Inicia el servidor en un hilo de fondo y lo retorna.
+
+    Con puerto=0 se usa un puerto libre; la URL base queda en
+    f"http://127.0.0.1:{servidor.server_port}/farmacia_v2/WS".
+    """
+    manejador = type("ManejadorConfigurado", (ManejadorMinsal,), {
+        "directorio": directorio,
+        "retardo": retardo,
+        "tasa_error": tasa_error,
+    })
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), manejador)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor local con los feeds grabados del MINSAL")
+    parser.add_argument("--directorio", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "grabaciones"))
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--retardo", type=float, default=0.0, help="Segundos de latencia por respuesta")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de respuestas 503")
+    args = parser.parse_args()
+
+    servidor = iniciar_servidor(args.directorio, args.puerto, args.retardo, args.tasa_error)
+    print(f"Sirviendo {args.directorio} en http://127.0.0.1:{servidor.server_port}/farmacia_v2/WS")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
@@ -0,0 +1,271 @@
+"""
+Trazas por etapa de las consultas del chat.
+
+Cada consulta abre una Traza con un id de solicitud y cada etapa del camino
+(usuario, enrutamiento, SQLite, embedding, caché, Qdrant, generación,
+revisión, historial) se mide con `etapa(nombre)`. Las duraciones se agregan
+en histogramas de cubetas fijas, uno por etapa más el total, que se pueden
+consultar en cualquier momento (ver RegistroLatencias.estadisticas).
+
+La traza activa vive en una ContextVar: la heredan los hilos lanzados con
+asyncio.to_thread y las corrutinas de la misma tarea, así que las funciones
+intermedias no necesitan recibirla como argumento. Fuera de una traza,
+`etapa` solo alimenta los histogramas.
+
+Con TRAZAS_LENTAS_MS se registran en el log "trazas" (y en TRAZAS_ARCHIVO,
+si se indica) las consultas que tardan al menos esos milisegundos, con el
+detalle de sus etapas.
+"""
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+# Límites superiores (ms) de las cubetas de los histogramas; la última es +inf
+CUBETAS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# Muestras de consultas lentas que se conservan en memoria
+MAX_MUESTRAS_LENTAS = 50
+# Etapa con la duración completa de cada traza
+TOTAL = "total"
+
+_traza_actual = contextvars.ContextVar("traza_actual", default=None)
+
+log_trazas = logging.getLogger("trazas")
+if os.getenv("TRAZAS_ARCHIVO"):
+    _manejador = logging.FileHandler(os.getenv("TRAZAS_ARCHIVO"))
+    _manejador.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    log_trazas.addHandler(_manejador)
+
+
+def _umbral_lentas():
+    valor = os.getenv("TRAZAS_LENTAS_MS")
+    return float(valor) if valor else None
+
+
+class Histograma:
+    """Conteo de duraciones por cubeta, con suma y máximo"""
+
+    def __init__(self, cubetas=CUBETAS_MS):
+        self.cubetas = tuple(cubetas)
+        self.conteos = [0] * (len(self.cubetas) + 1)
+        self.cuenta = 0
+        self.suma_ms = 0.0
+        self.maximo_ms = 0.0
+
+    def observar(self, ms):
+        self.conteos[bisect.bisect_left(self.cubetas, ms)] += 1
+        self.cuenta += 1
+        self.suma_ms += ms
+        if ms > self.maximo_ms:
+            self.maximo_ms = ms
+
+    def percentil(self, p):
+        """Estimación del percentil p (0-100) interpolando dentro de la cubeta"""
+        if not self.cuenta:
+            return 0.0
+        objetivo = self.cuenta * p / 100
+        acumulado = 0
+        for i, conteo in enumerate(self.conteos):
+            if conteo and acumulado + conteo >= objetivo:
+                inferior = self.cubetas[i - 1] if i > 0 else 0.0
+                superior = self.cubetas[i] if i < len(self.cubetas) else self.maximo_ms
+                superior = min(superior, self.maximo_ms)
+                return inferior + (superior - inferior) * (objetivo - acumulado) / conteo
+            acumulado += conteo
+        return self.maximo_ms
+
+    def acumulados(self):
+        """Pares (límite superior, observaciones <= límite), terminando en +inf"""
+        resultado = []
+        acumulado = 0
+        for limite, conteo in zip(self.cubetas + (float("inf"),), self.conteos):
+            acumulado += conteo
+            resultado.append((limite, acumulado))
+        return resultado
+
+    def estadisticas(self):
+        return {
+            'cuenta': self.cuenta,
+            'promedio_ms': round(self.suma_ms / self.cuenta, 3) if self.cuenta else 0.0,
+            'p50_ms': round(self.percentil(50), 3),
+            'p90_ms': round(self.percentil(90), 3),
+            'p99_ms': round(self.percentil(99), 3),
+            'maximo_ms': round(self.maximo_ms, 3),
+            'suma_ms': round(self.suma_ms, 3),
+            'cubetas': {f"<={limite:g}": conteo for limite, conteo in self.acumulados()},
+        }
+
+
+class RegistroLatencias:
+    """Histogramas por etapa y muestras recientes de consultas lentas"""
+
+    def __init__(self, cubetas=CUBETAS_MS):
+        self.cubetas = cubetas
+        self.histogramas = {}
+        self.lentas = deque(maxlen=MAX_MUESTRAS_LENTAS)
+        self._lock = threading.Lock()
+
+    def observar(self, etapa, ms):
+        with self._lock:
+            histograma = self.histogramas.get(etapa)
+            if histograma is None:
+                histograma = self.histogramas[etapa] = Histograma(self.cubetas)
+            histograma.observar(ms)
+
+    def registrar_lenta(self, muestra):
+        with self._lock:
+            self.lentas.append(muestra)
+
+    def instantanea(self):
+        """Copia de los histogramas, para leerlos sin retener el lock"""
+        with self._lock:
+            copias = {}
+            for etapa, histograma in self.histogramas.items():
+                copia = Histograma(histograma.cubetas)
+                copia.conteos = list(histograma.conteos)
+                copia.cuenta = histograma.cuenta
+                copia.suma_ms = histograma.suma_ms
+                copia.maximo_ms = histograma.maximo_ms
+                copias[etapa] = copia
+            return copias
+
+    def estadisticas(self):
+        with self._lock:
+            lentas = list(self.lentas)
+        return {
+            'etapas': {etapa: h.estadisticas() for etapa, h in sorted(self.instantanea().items())},
+            'lentas': lentas,
+            'umbral_lentas_ms': _umbral_lentas(),
+        }
+
+    def reiniciar(self):
+        with self._lock:
+            self.histogramas = {}
+            self.lentas.clear()
+
+
+latencias = RegistroLatencias()
+
+
+class Traza:
+    """Etapas medidas de una consulta, en el orden en que terminaron"""
+
+    def __init__(self, nombre, id_solicitud=None):
+        self.nombre = nombre
+        self.id_solicitud = id_solicitud or uuid.uuid4().hex
+        self.inicio = time.perf_counter()
+        self.etapas = []
+        self.atributos = {}
+        self.total_ms = None
+
+    def registrar(self, etapa, ms):
+        self.etapas.append((etapa, ms))
+
+    def anotar(self, **atributos):
+        """Agrega datos de la consulta (intención, modo, acierto de caché...)"""
+        self.atributos.update(atributos)
+
+    def como_dict(self):
+        return {
+            'id': self.id_solicitud,
+            'nombre': self.nombre,
+            'total_ms': round(self.total_ms, 3) if self.total_ms is not None else None,
+            'etapas': [[etapa, round(ms, 3)] for etapa, ms in self.etapas],
+            'atributos': self.atributos,
+        }
+
+
+def traza_actual() -> Optional[Traza]:
+    return _traza_actual.get()
+
+
+def anotar(**atributos):
+    """Anota la traza activa, si la hay"""
+    traza = _traza_actual.get()
+    if traza is not None:
+        traza.anotar(**atributos)
+
+
+@contextmanager
+def traza(nombre, id_solicitud=None):
+    """
+    Abre una traza para la consulta. Si ya hay una activa (por ejemplo, la
+    de la ruta que llamó a procesar_consulta) se reutiliza esa, así cada
+    solicitud se cuenta una sola vez.
+    """
+    actual = _traza_actual.get()
+    if actual is not None:
+        yield actual
+        return
+
+    nueva = Traza(nombre, id_solicitud)
+    token = _traza_actual.set(nueva)
+    try:
+        yield nueva
+    finally:
+        _traza_actual.reset(token)
+        terminar(nueva)
+
+
+def terminar(traza_terminada):
+    traza_terminada.total_ms = (time.perf_counter() - traza_terminada.inicio) * 1000
+    latencias.observar(TOTAL, traza_terminada.total_ms)
+    umbral = _umbral_lentas()
+    if umbral is not None and traza_terminada.total_ms >= umbral:
+        muestra = traza_terminada.como_dict()
+        latencias.registrar_lenta(muestra)
+        log_trazas.warning(f"Consulta lenta: {json.dumps(muestra, ensure_ascii=False)}")
+
+
+@contextmanager
+def etapa(nombre):
+    """Mide el bloque como la etapa `nombre` (también si termina con error)"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_etapa(nombre, (time.perf_counter() - inicio) * 1000)
+
+
+def registrar_etapa(nombre, ms):
+    """Registra una duración ya medida en el histograma y en la traza activa"""
+    latencias.observar(nombre, ms)
+    traza_activa = _traza_actual.get()
+    if traza_activa is not None:
+        traza_activa.registrar(nombre, ms)
+
+
+def trazar(nombre):
+    """
+    Decorador que abre una traza alrededor de la función. Sirve para
+    funciones normales, corrutinas y generadores (la traza dura hasta que
+    el generador termina).
+    """
+    def decorador(funcion):
+        if asyncio.iscoroutinefunction(funcion):
+            @functools.wraps(funcion)
+            async def envoltura(*args, **kwargs):
+                with traza(nombre):
+                    return await funcion(*args, **kwargs)
+        elif inspect.isgeneratorfunction(funcion):
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                with traza(nombre):
+                    yield from funcion(*args, **kwargs)
+        else:
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                with traza(nombre):
+                    return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, jsonify, request, session
+from flask import Flask, render_template, jsonify, request, session, Response, stream_with_context, g
 from datetime import timedelta
 import uuid
 import sqlite3
@@ -7,15 +7,30 @@ import logging
 from datetime import datetime
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
 # Agregar el directorio 'back' al path para poder importar consultas_llm
 script_dir = os.path.dirname(os.path.abspath(__file__))
 back_dir = os.path.join(os.path.dirname(script_dir), 'back')
 sys.path.append(back_dir)
 
+from busqueda_cercana import farmacias_cercanas, RADIO_POR_DEFECTO_KM, LIMITE_POR_DEFECTO
+from horarios import resolver_minuto, filtro_abierta
+from esquema import origen_farmacias
+from busqueda_difusa import IndiceDifusoBD, TIPO_COMUNA, TIPO_FARMACIA
+from escritura_diferida import EscrituraDiferida
+from trazas import traza, etapa, latencias
+from metricas import RegistroMetricas, TIPO_CONTENIDO, colector_etapas, lineas_familia
+
 # Importar el sistema RAG
 try:
-    from consultas_llm import procesar_consulta, obtener_historial_usuario
+    from consultas_llm import (
+        procesar_consulta, procesar_consulta_stream, obtener_historial_usuario, precalentar_recursos,
+        obtener_estadisticas_cache, obtener_estadisticas_escrituras, obtener_estadisticas_trazas,
+        obtener_estadisticas_caches
+    )
     print("Módulo RAG importado correctamente")
 except ImportError as e:
     print(f"Error al importar el módulo RAG: {e}")
@@ -35,11 +50,88 @@ app.secret_key = 'Pajaritos3nIaIuna'  # Cambia esto por una clave segura
 # Configura el tiempo de vida de la sesión
 app.permanent_session_lifetime = timedelta(minutes=60)
 
+DB_FARMACIAS = '/Base/farmacias_turno.db'
+
 def get_db_connection():
-    conn = sqlite3.connect('/Base/farmacias_turno.db')
+    conn = sqlite3.connect(DB_FARMACIAS)
     conn.row_factory = sqlite3.Row
     return conn
 
+# Índice de trigramas para tolerar errores de tipeo; se carga en la primera búsqueda
+indice_difuso = None
+indice_difuso_lock = threading.Lock()
+
+def obtener_indice_difuso():
+    global indice_difuso
+    with indice_difuso_lock:
+        if indice_difuso is None:
+            indice_difuso = IndiceDifusoBD(DB_FARMACIAS)
+        return indice_difuso
+
+# Consultas de los selectores: sobre las tablas regiones y comunas y, si la
+# base aún no las tiene (ActualizaFarmacias.py no la ha migrado), derivadas
+# de farmacias como antes de existir esas tablas
+SQL_REGIONES = {
+    True: 'SELECT nombre FROM regiones ORDER BY nombre',
+    False: '''
+        SELECT DISTINCT nombre_region AS nombre
+        FROM farmacias
+        WHERE nombre_region IS NOT NULL
+        ORDER BY nombre_region
+    ''',
+}
+SQL_COMUNAS = {
+    True: '''
+        SELECT nombre
+        FROM comunas
+        WHERE fk_region = (SELECT id FROM regiones WHERE nombre = ?)
+        ORDER BY nombre
+    ''',
+    False: '''
+        SELECT DISTINCT comuna_nombre AS nombre
+        FROM farmacias
+        WHERE nombre_region = ? AND comuna_nombre IS NOT NULL
+        ORDER BY comuna_nombre
+    ''',
+}
+SQL_ID_COMUNA = {
+    True: '''
+        SELECT c.id
+        FROM comunas c
+        JOIN regiones r ON r.id = c.fk_region
+        WHERE r.nombre = ? AND c.nombre = ?
+    ''',
+    False: '''
+        SELECT fk_comuna AS id
+        FROM farmacias
+        WHERE nombre_region = ? AND comuna_nombre = ? AND fk_comuna IS NOT NULL
+        LIMIT 1
+    ''',
+}
+
+def tiene_tablas_referencia(conn):
+    """Si la base ya tiene las tablas regiones y comunas (esquema migrado)"""
+    return conn.execute('''
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name IN ('regiones', 'comunas')
+    ''').fetchone()[0] == 2
+
+def resolver_comuna(conn, region, comuna):
+    """
+    Id de la comuna de la región con ese nombre; si no existe, el de la
+    comuna de la región más parecida según el índice difuso (o None).
+    """
+    consulta = SQL_ID_COMUNA[tiene_tablas_referencia(conn)]
+    fila = conn.execute(consulta, (region, comuna)).fetchone()
+    if fila:
+        return fila['id']
+    for nombre, distancia in obtener_indice_difuso().buscar_similares(comuna, TIPO_COMUNA):
+        fila = conn.execute(consulta, (region, nombre)).fetchone()
+        if fila:
+            logging.info(f"Comuna '{comuna}' interpretada como '{nombre}' (distancia {distancia})")
+            return fila['id']
+    return None
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -47,43 +139,76 @@ def index():
 @app.route('/get_regions')
 def get_regions():
     conn = get_db_connection()
-    regions = conn.execute('''
-        SELECT DISTINCT nombre_region 
-        FROM farmacias 
-        WHERE nombre_region IS NOT NULL 
-        ORDER BY nombre_region
-    ''').fetchall()
+    regions = conn.execute(SQL_REGIONES[tiene_tablas_referencia(conn)]).fetchall()
     conn.close()
-    return jsonify([region['nombre_region'] for region in regions])
+    return jsonify([region['nombre'] for region in regions])
 
 @app.route('/get_comunas/<region>')
 def get_comunas(region):
     conn = get_db_connection()
-    comunas = conn.execute('''
-        SELECT DISTINCT comuna_nombre 
-        FROM farmacias 
-        WHERE nombre_region = ? 
-        AND comuna_nombre IS NOT NULL 
-        ORDER BY comuna_nombre
-    ''', (region,)).fetchall()
+    comunas = conn.execute(SQL_COMUNAS[tiene_tablas_referencia(conn)], (region,)).fetchall()
     conn.close()
-    return jsonify([comuna['comuna_nombre'] for comuna in comunas])
+    return jsonify([comuna['nombre'] for comuna in comunas])
 
 @app.route('/search_farmacias/<region>/<comuna>')
 def search_farmacias(region, comuna):
+    # ?abierta=ahora o ?abierta=HH:MM deja solo las farmacias abiertas a esa hora
+    try:
+        minuto = resolver_minuto(request.args.get('abierta') or None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     conn = get_db_connection()
-    farmacias = conn.execute('''
+    filtro_horario = ''
+    parametros = [resolver_comuna(conn, region, comuna)]
+    if minuto is not None:
+        condicion, parametros_horario = filtro_abierta(minuto)
+        filtro_horario = f'AND {condicion}'
+        parametros.extend(parametros_horario)
+
+    farmacias = conn.execute(f'''
         SELECT local_nombre, localidad_nombre, local_direccion, 
                de_turno, URL_direccion as url_direccion
-        FROM farmacias 
-        WHERE nombre_region = ? 
-        AND comuna_nombre = ?
+        FROM {origen_farmacias(conn)}
+        WHERE fk_comuna = ?
+        {filtro_horario}
         ORDER BY de_turno DESC, local_nombre
-    ''', (region, comuna)).fetchall()
+    ''', parametros).fetchall()
     conn.close()
     
     return jsonify([dict(farmacia) for farmacia in farmacias])
 
+@app.route('/sugerencias')
+def sugerencias():
+    """Comunas y farmacias con nombre parecido a ?q=, tolerando errores de tipeo"""
+    texto = request.args.get('q', '').strip()
+    if not texto:
+        return jsonify({'error': 'Se requiere el parámetro q'}), 400
+    indice = obtener_indice_difuso()
+    return jsonify({
+        'comunas': [nombre for nombre, _ in indice.buscar_similares(texto, TIPO_COMUNA)],
+        'farmacias': [nombre for nombre, _ in indice.buscar_similares(texto, TIPO_FARMACIA)],
+    })
+
+@app.route('/farmacias_cercanas')
+def buscar_farmacias_cercanas():
+    """Farmacias más cercanas a lat/lng, opcionalmente solo las de turno"""
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        radio_km = float(request.args.get('radio_km', RADIO_POR_DEFECTO_KM))
+        limite = int(request.args.get('k', LIMITE_POR_DEFECTO))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Se requieren lat y lng numéricos'}), 400
+    solo_turno = request.args.get('solo_turno', '').lower() in ('1', 'true', 'si', 'sí')
+
+    conn = get_db_connection()
+    try:
+        farmacias = farmacias_cercanas(conn, lat, lng, radio_km, limite, solo_turno)
+    finally:
+        conn.close()
+    return jsonify(farmacias)
+
 class ChatSession:
     def __init__(self):
         self.conversation_history = []
@@ -129,6 +254,10 @@ def cleanup_old_sessions():
         if session_age > timedelta(minutes=60):
             del chat_sessions[sid]
 
+def obtener_id_solicitud():
+    """Id de la solicitud para las trazas: el de X-Request-ID o uno nuevo"""
+    return request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -156,35 +285,40 @@ def chat():
             print(f"No user_id provided, generated: {user_id}")
         
         print(f"Processing request for user_id: {user_id}")
+        id_solicitud = obtener_id_solicitud()
 
-        # Obtener la sesión de chat
-        chat_session, session_id = get_or_create_chat_session(user_id)
-        
-        # Aquí llamamos al sistema RAG para procesar la consulta
-        try:
-            # Procesar la consulta con el sistema RAG usando el ID proporcionado
-            rag_response = procesar_consulta(user_id, user_message)
-            print(f"RAG response for user {user_id}: {rag_response[:100]}...")  # Para debug
-        except Exception as rag_error:
-            error_msg = f"Error en el sistema RAG: {str(rag_error)}"
-            print(error_msg)
-            logging.error(f"User {user_id}: {error_msg}")
-            rag_response = f"Lo siento, ocurrió un error al procesar tu consulta: {str(rag_error)}"
-        
-        # Agregar mensajes al historial de la sesión de Flask
-        chat_session.add_message('user', user_message)
-        chat_session.add_message('assistant', rag_response)
-        
-        # Guardar el historial de chat en la base de datos de Flask
-        save_chat_history(user_id, chat_session.get_history())
+        with traza('chat', id_solicitud):
+            # Obtener la sesión de chat
+            chat_session, session_id = get_or_create_chat_session(user_id)
+            
+            # Aquí llamamos al sistema RAG para procesar la consulta
+            try:
+                # Procesar la consulta con el sistema RAG usando el ID proporcionado
+                rag_response = procesar_consulta(user_id, user_message)
+                print(f"RAG response for user {user_id}: {rag_response[:100]}...")  # Para debug
+            except Exception as rag_error:
+                error_msg = f"Error en el sistema RAG: {str(rag_error)}"
+                print(error_msg)
+                logging.error(f"User {user_id} [{id_solicitud}]: {error_msg}")
+                rag_response = f"Lo siento, ocurrió un error al procesar tu consulta: {str(rag_error)}"
+            
+            # Agregar mensajes al historial de la sesión de Flask
+            chat_session.add_message('user', user_message)
+            chat_session.add_message('assistant', rag_response)
+            
+            # Guardar el historial de chat en la base de datos de Flask
+            with etapa('chat_history'):
+                save_chat_history(user_id, chat_session.get_history())
         
-        logging.info(f"User {user_id} - Message: {user_message}")
-        logging.info(f"User {user_id} - Response: {rag_response[:100]}...")
+        logging.info(f"User {user_id} [{id_solicitud}] - Message: {user_message}")
+        logging.info(f"User {user_id} [{id_solicitud}] - Response: {rag_response[:100]}...")
 
-        return jsonify({
+        respuesta = jsonify({
             'response': rag_response,
             'user_id': user_id  # Devolvemos el ID para que el cliente lo almacene si fue generado
         })
+        respuesta.headers['X-Request-ID'] = id_solicitud
+        return respuesta
 
     except Exception as e:
         error_msg = f"Error in chat endpoint: {str(e)}"
@@ -192,31 +326,87 @@ def chat():
         logging.error(error_msg)
         return jsonify({'error': str(e)}), 500
 
+def evento_sse(evento, datos):
+    """Formatea un evento Server-Sent Events con datos JSON"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Como /chat, pero responde con Server-Sent Events: eventos "token" con
+    cada fragmento a medida que se genera y un evento "final" con la
+    respuesta revisada, que reemplaza a lo mostrado hasta ese momento.
+    """
+    data = request.get_json(silent=True)
+    if not data or not (data.get('message') or '').strip():
+        return jsonify({'error': 'No message provided'}), 400
+
+    user_message = data['message'].strip()
+    user_id = data.get('user_id') or str(uuid.uuid4())
+    chat_session, session_id = get_or_create_chat_session(user_id)
+    id_solicitud = obtener_id_solicitud()
+    logging.info(f"User {user_id} [{id_solicitud}] - Streaming message: {user_message}")
+
+    def generar():
+        with traza('chat_stream', id_solicitud):
+            yield evento_sse('inicio', {'user_id': user_id, 'request_id': id_solicitud})
+            respuesta = None
+            try:
+                for tipo, texto in procesar_consulta_stream(user_id, user_message):
+                    if tipo == 'final':
+                        respuesta = texto
+                        yield evento_sse('final', {'response': texto, 'user_id': user_id})
+                    else:
+                        yield evento_sse(tipo, {'text': texto})
+            except Exception as e:
+                logging.error(f"User {user_id} [{id_solicitud}]: Error en el streaming: {e}")
+                respuesta = f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
+                yield evento_sse('final', {'response': respuesta, 'user_id': user_id})
+
+            chat_session.add_message('user', user_message)
+            chat_session.add_message('assistant', respuesta)
+            with etapa('chat_history'):
+                save_chat_history(user_id, chat_session.get_history())
+        logging.info(f"User {user_id} [{id_solicitud}] - Response: {respuesta[:100]}...")
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype='text/event-stream',
+        # Sin caché ni buffering de proxies, para que cada evento llegue al instante
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Request-ID': id_solicitud}
+    )
+
+@contextmanager
+def transaccion_chat():
+    """Conexión para un lote de escrituras de chat_history (commit al salir)"""
+    conn = get_db_connection()
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+# Las escrituras de chat_history se aplican por lotes en segundo plano; la
+# tabla se crea con la primera de ellas
+escrituras_chat = EscrituraDiferida(transaccion_chat, nombre="chat_history")
+escrituras_chat.encolar('''
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        history TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+''')
+
 def save_chat_history(session_id, history):
-    """Guarda el historial del chat en la base de datos"""
+    """Encola el guardado del historial del chat en la base de datos"""
     try:
-        conn = get_db_connection()
-        
-        # Crear tabla si no existe
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                history TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Actualizar o insertar el historial
-        conn.execute('''
+        escrituras_chat.encolar('''
             INSERT OR REPLACE INTO chat_history (session_id, history, updated_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
         ''', (session_id, json.dumps(history)))
         
-        conn.commit()
-        conn.close()
-        
-        logging.info(f"Chat history saved for session {session_id}")
+        logging.info(f"Chat history queued for session {session_id}")
     except Exception as e:
         error_msg = f"Error saving chat history: {str(e)}"
         logging.error(f"Session {session_id}: {error_msg}")
@@ -295,6 +485,102 @@ def clear_chat_history():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Métricas para Prometheus (ver /metrics). Cada solicitud solo actualiza
+# contadores en memoria; lo demás se lee al exportar
+metricas = RegistroMetricas(prefijo='pharmago')
+solicitudes_http = metricas.contador(
+    'http_solicitudes_total', 'Solicitudes HTTP por ruta, método y código de estado', ('ruta', 'metodo', 'estado')
+)
+duracion_http = metricas.histograma(
+    'http_duracion_segundos', 'Duración de las solicitudes HTTP (las de streaming, hasta el último evento)',
+    ('ruta', 'metodo')
+)
+chats_en_curso = metricas.indicador('chat_en_curso', 'Solicitudes de chat que se están atendiendo')
+metricas.indicador('chat_sesiones', 'Sesiones de chat en memoria', funcion=lambda: len(chat_sessions))
+metricas.agregar_colector(colector_etapas(latencias))
+
+# Endpoints cuyas solicitudes cuentan como chats en curso
+ENDPOINTS_CHAT = ('chat', 'chat_stream')
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_solicitud = time.perf_counter()
+    if request.endpoint in ENDPOINTS_CHAT:
+        chats_en_curso.sumar()
+        g.chat_en_curso = True
+
+@app.after_request
+def contar_solicitud(respuesta):
+    g.estado_respuesta = respuesta.status_code
+    return respuesta
+
+@app.teardown_request
+def terminar_medicion(error=None):
+    # Con stream_with_context el teardown llega cuando termina el stream, así
+    # que la duración de /chat/stream incluye toda la respuesta
+    inicio = g.pop('inicio_solicitud', None)
+    if inicio is None:
+        return
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    estado = g.pop('estado_respuesta', 500)
+    solicitudes_http.sumar(ruta, request.method, str(estado))
+    duracion_http.observar(ruta, request.method, ms=(time.perf_counter() - inicio) * 1000)
+    if g.pop('chat_en_curso', False):
+        chats_en_curso.sumar(valor=-1)
+
+def antiguedad_datos_farmacias():
+    """Segundos desde la última actualización aplicada a la base de farmacias"""
+    conn = get_db_connection()
+    try:
+        try:
+            fila = conn.execute(
+                "SELECT (julianday('now') - julianday(MAX(fecha_actualizacion))) * 86400 FROM estado_feeds"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            fila = None
+        if fila is None or fila[0] is None:
+            # Bases anteriores a estado_feeds: la fila modificada más reciente
+            fila = conn.execute(
+                "SELECT (julianday('now') - julianday(MAX(fecha_actualizacion))) * 86400 FROM farmacias"
+            ).fetchone()
+        return fila[0]
+    finally:
+        conn.close()
+
+def colector_estado(prefijo):
+    """Cachés, colas de escritura y antigüedad de los datos, leídos al exportar"""
+    lineas = []
+    consultas = []
+    tasas = []
+    for nombre, estadisticas in obtener_estadisticas_caches().items():
+        aciertos = estadisticas.get('aciertos')
+        if aciertos is None:
+            aciertos = estadisticas['aciertos_memoria'] + estadisticas['aciertos_disco']
+        consultas.append(({'cache': nombre, 'resultado': 'acierto'}, aciertos))
+        consultas.append(({'cache': nombre, 'resultado': 'fallo'}, estadisticas['fallos']))
+        tasas.append(({'cache': nombre}, estadisticas['tasa_aciertos']))
+    lineas += lineas_familia(f'{prefijo}_cache_consultas_total', 'counter',
+                             'Consultas a los cachés del chat por resultado', consultas)
+    lineas += lineas_familia(f'{prefijo}_cache_tasa_aciertos', 'gauge',
+                             'Fracción de consultas resueltas por el caché', tasas)
+
+    colas = {'historial': obtener_estadisticas_escrituras(), 'chat_history': escrituras_chat.estadisticas()}
+    colas = {nombre: estadisticas for nombre, estadisticas in colas.items() if 'en_cola' in estadisticas}
+    lineas += lineas_familia(f'{prefijo}_escrituras_en_cola', 'gauge', 'Escrituras diferidas pendientes',
+                             [({'cola': nombre}, e['en_cola']) for nombre, e in colas.items()])
+    lineas += lineas_familia(f'{prefijo}_escrituras_perdidas_total', 'counter',
+                             'Escrituras diferidas descartadas tras fallar',
+                             [({'cola': nombre}, e['perdidas']) for nombre, e in colas.items()])
+
+    antiguedad = antiguedad_datos_farmacias()
+    if antiguedad is not None:
+        lineas += lineas_familia(f'{prefijo}_farmacias_antiguedad_segundos', 'gauge',
+                                 'Segundos desde la última actualización de la base de farmacias',
+                                 [({}, antiguedad)])
+    return lineas
+
+metricas.agregar_colector(colector_estado)
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Endpoint para verificar la salud del sistema"""
@@ -323,8 +609,43 @@ def health_check():
             'message': str(e)
         }), 500
 
+@app.route('/api/cache/estadisticas', methods=['GET'])
+def cache_statistics():
+    """Tasa de aciertos y latencia ahorrada por el caché semántico de respuestas"""
+    try:
+        return jsonify(obtener_estadisticas_cache())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/escrituras/estadisticas', methods=['GET'])
+def write_statistics():
+    """Cola, lotes y contrapresión de las escrituras diferidas"""
+    try:
+        return jsonify({
+            'historial': obtener_estadisticas_escrituras(),
+            'chat_history': escrituras_chat.estadisticas(),
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/trazas/estadisticas', methods=['GET'])
+def trace_statistics():
+    """Latencia por etapa del chat (p50/p90/p99 e histograma) y consultas lentas"""
+    try:
+        return jsonify(obtener_estadisticas_trazas())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas del front en el formato de texto de Prometheus"""
+    return Response(metricas.exportar(), content_type=TIPO_CONTENIDO)
+
 if __name__ == '__main__':
     # Código existente
     
+    # Crear los clientes del LLM y Qdrant en segundo plano mientras arranca el servidor
+    threading.Thread(target=precalentar_recursos, daemon=True).start()
+
     print("Iniciando servidor Flask...")
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
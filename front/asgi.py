@@ -0,0 +1,119 @@
+"""
+Punto de entrada ASGI del front.
+
+POST /chat se atiende de forma nativa con consultas_llm.aprocesar_consulta:
+mientras una consulta espera al LLM no ocupa ningún hilo, así que un solo
+proceso sostiene cientos de conversaciones a la vez. Todas las demás rutas
+pasan a la aplicación Flask de WebPharmaGo.py a través de WsgiToAsgi.
+
+Uso:
+    uvicorn asgi:app --app-dir front --host 0.0.0.0 --port 5000
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+
+from asgiref.wsgi import WsgiToAsgi
+
+import WebPharmaGo as web
+from consultas_llm import aprocesar_consulta, precalentar_recursos
+from trazas import traza, etapa
+
+app_wsgi = WsgiToAsgi(web.app)
+
+
+async def leer_cuerpo(receive):
+    cuerpo = b""
+    while True:
+        mensaje = await receive()
+        cuerpo += mensaje.get("body", b"")
+        if not mensaje.get("more_body"):
+            return cuerpo
+
+
+async def responder_json(send, datos, estado=200, cabeceras=()):
+    cuerpo = json.dumps(datos, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": estado,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(cuerpo)).encode()),
+                    *cabeceras],
+    })
+    await send({"type": "http.response.body", "body": cuerpo})
+    return estado
+
+
+def obtener_id_solicitud(scope):
+    """Id de la solicitud para las trazas: el de X-Request-ID o uno nuevo"""
+    for nombre, valor in scope.get("headers", []):
+        if nombre == b"x-request-id" and valor:
+            return valor.decode("latin-1")
+    return uuid.uuid4().hex
+
+
+async def chat(scope, receive, send):
+    """Igual que /chat de WebPharmaGo.py, pero sin bloquear un hilo por consulta"""
+    try:
+        data = json.loads(await leer_cuerpo(receive) or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'message' not in data:
+        return await responder_json(send, {'error': 'No message provided'}, 400)
+
+    user_message = str(data['message']).strip()
+    if not user_message:
+        return await responder_json(send, {'error': 'Empty message'}, 400)
+
+    user_id = data.get('user_id') or str(uuid.uuid4())
+    id_solicitud = obtener_id_solicitud(scope)
+    with traza("chat", id_solicitud):
+        chat_session, _ = web.get_or_create_chat_session(user_id)
+        try:
+            rag_response = await aprocesar_consulta(user_id, user_message)
+        except Exception as e:
+            logging.error(f"User {user_id} [{id_solicitud}]: Error en el sistema RAG: {e}")
+            rag_response = f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
+
+        chat_session.add_message('user', user_message)
+        chat_session.add_message('assistant', rag_response)
+        with etapa("chat_history"):
+            web.save_chat_history(user_id, chat_session.get_history())
+    logging.info(f"User {user_id} [{id_solicitud}] - Message: {user_message}")
+
+    return await responder_json(send, {'response': rag_response, 'user_id': user_id},
+                         cabeceras=[(b"x-request-id", id_solicitud.encode("latin-1"))])
+
+
+async def ciclo_de_vida(receive, send):
+    """Eventos lifespan: al iniciar se precalientan los clientes en segundo plano"""
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "lifespan.startup":
+            threading.Thread(target=precalentar_recursos, daemon=True).start()
+            await send({"type": "lifespan.startup.complete"})
+        elif mensaje["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def chat_medido(scope, receive, send):
+    """/chat con las mismas métricas que las rutas de Flask (ver WebPharmaGo.metricas)"""
+    inicio = time.perf_counter()
+    estado = 500
+    web.chats_en_curso.sumar()
+    try:
+        estado = await chat(scope, receive, send)
+    finally:
+        web.chats_en_curso.sumar(valor=-1)
+        web.solicitudes_http.sumar("/chat", "POST", str(estado))
+        web.duracion_http.observar("/chat", "POST", ms=(time.perf_counter() - inicio) * 1000)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await ciclo_de_vida(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/chat" and scope["method"] == "POST":
+        return await chat_medido(scope, receive, send)
+    await app_wsgi(scope, receive, send)
@@ -33,7 +33,7 @@ document.addEventListener('DOMContentLoaded', function() {
             addUserMessage(message);
             userInput.value = '';
 
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -41,16 +41,11 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: JSON.stringify({ message: message })
             });
 
-            const data = await response.json();
-            
-            // Mostrar SID en consola
-            console.log(`Chat Session ID: ${data.session_id}`);
-            
-            if (data.error) {
+            if (!response.ok || !response.body) {
                 addSystemMessage("Lo siento, hubo un error. Por favor, intenta de nuevo.");
-                console.error('Error:', data.error);
+                console.error('Error:', response.status);
             } else {
-                addBotMessage(data.response);
+                await readStream(response, addBotMessage(''));
             }
 
         } catch (error) {
@@ -78,6 +73,43 @@ document.addEventListener('DOMContentLoaded', function() {
         div.textContent = message;
         chatMessages.appendChild(div);
         scrollToBottom();
+        return div;
+    }
+
+    // Lee los eventos SSE de /chat/stream: cada "token" se agrega al mensaje
+    // y el "final" lo reemplaza por la respuesta ya revisada
+    async function readStream(response, div) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let separator;
+            while ((separator = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separator);
+                buffer = buffer.slice(separator + 2);
+
+                let eventName = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) eventName = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (!data) continue;
+
+                const payload = JSON.parse(data);
+                if (eventName === 'token') {
+                    div.textContent += payload.text;
+                } else if (eventName === 'final') {
+                    div.textContent = payload.response;
+                }
+                scrollToBottom();
+            }
+        }
     }
 
     function addSystemMessage(message) {